@@ -0,0 +1,157 @@
+"""
+Offline analysis of the sampled request traces
+
+Reads the JSON lines written by tracing.Tracer.emit (from files or stdin)
+and reports:
+
+* duration percentiles per span name (stage)
+* the critical path breakdown of a request: the fetch stage is only as
+  fast as its slowest source tile, anything on top of that is the cost of
+  the thread fan out
+* the slowest source tiles
+
+    python analyze_traces.py traces.log [more.log ...]
+"""
+
+from __future__ import print_function
+
+import argparse
+import fileinput
+import json
+from collections import defaultdict
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def read_traces(paths):
+    for line in fileinput.input(paths or ('-',)):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            trace = json.loads(line)
+        except ValueError:
+            # the traces can share a log with other output
+            continue
+        if isinstance(trace, dict) and 'spans' in trace:
+            yield trace
+
+
+def critical_path(trace):
+    """
+    Break a single request down into the stages on its critical path
+
+    Returns a list of (component, seconds) pairs. The fetch stage is split
+    into the slowest source tile fetch and the fan out overhead.
+    """
+    spans = trace['spans']
+    roots = [span for span in spans if span['parent'] is None]
+    if not roots:
+        return []
+    root = max(roots, key=lambda span: span['duration'])
+    children = defaultdict(list)
+    for span in spans:
+        children[span['parent']].append(span)
+
+    path = []
+    accounted = 0.0
+    for span in children[root['id']]:
+        if span['name'] == 'fetch':
+            fetch_tiles = children[span['id']]
+            slowest = max(
+                [tile_span['duration'] for tile_span in fetch_tiles] or [0.0])
+            path.append(('fetch:slowest-source', slowest))
+            path.append(('fetch:fan-out', span['duration'] - slowest))
+        else:
+            path.append((span['name'], span['duration']))
+        accounted += span['duration']
+    path.append(('other', max(0.0, root['duration'] - accounted)))
+    return path
+
+
+class TraceAnalysis(object):
+
+    def __init__(self):
+        self.num_traces = 0
+        self.stage_durations = defaultdict(list)
+        self.critical_path_totals = defaultdict(float)
+        self.request_total = 0.0
+        self.source_durations = defaultdict(list)
+
+    def add(self, trace):
+        self.num_traces += 1
+        for span in trace['spans']:
+            self.stage_durations[span['name']].append(span['duration'])
+            if span['name'] == 'fetch-tile':
+                attrs = span['attrs']
+                source_key = '%s/%s' % (attrs.get('tileset'), attrs['tile'])
+                self.source_durations[source_key].append(span['duration'])
+        for component, duration in critical_path(trace):
+            self.critical_path_totals[component] += duration
+            self.request_total += duration
+
+    def report(self, num_slowest):
+        lines = ['%d traces' % self.num_traces, '']
+
+        lines.append('Stage percentiles (ms)')
+        header = '%-20s %8s' % ('stage', 'count')
+        for pct in PERCENTILES:
+            header += ' %9s' % ('p%d' % pct)
+        header += ' %9s' % 'max'
+        lines.append(header)
+        for name in sorted(self.stage_durations):
+            durations = sorted(self.stage_durations[name])
+            line = '%-20s %8d' % (name, len(durations))
+            for pct in PERCENTILES:
+                line += ' %9.2f' % (percentile(durations, pct) * 1000.0)
+            line += ' %9.2f' % (durations[-1] * 1000.0)
+            lines.append(line)
+        lines.append('')
+
+        lines.append('Critical path breakdown')
+        for component, total in sorted(
+                self.critical_path_totals.items(),
+                key=lambda item: item[1], reverse=True):
+            share = total / self.request_total if self.request_total else 0
+            lines.append('%-22s %6.1f%%  mean %8.2f ms' % (
+                component, share * 100.0,
+                total / max(1, self.num_traces) * 1000.0))
+        lines.append('')
+
+        lines.append('Slowest source tiles (ms)')
+        slowest = sorted(
+            self.source_durations.items(),
+            key=lambda item: max(item[1]), reverse=True)[:num_slowest]
+        for source_key, durations in slowest:
+            durations = sorted(durations)
+            lines.append('%-30s max %8.2f  p50 %8.2f  n=%d' % (
+                source_key, durations[-1] * 1000.0,
+                percentile(durations, 50) * 1000.0, len(durations)))
+        return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Analyze the sampled request traces')
+    parser.add_argument('paths', nargs='*', help='trace logs, default stdin')
+    parser.add_argument('--slowest', type=int, default=10,
+                        help='number of slowest source tiles to list')
+    args = parser.parse_args(argv)
+
+    analysis = TraceAnalysis()
+    for trace in read_traces(args.paths):
+        analysis.add(trace)
+    print(analysis.report(args.slowest))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import (
+    format_server_timing,
+    observe_timing,
+    record_cache_lookup,
+    record_canvas_pool_event,
+    AsyncInstrumentedTileFetcher,
+    PROMETHEUS_CONTENT_TYPE,
+    REGISTRY,
+    REQUEST_ERRORS,
+    STAGE_DURATION,
+)
+from tracing import configure_trace_logging, make_tracer
+from zaloa import (
+    MAX_FETCH_CONCURRENCY,
+    negotiate_output_format,
+    OUTPUT_FORMATS,
+    parse_tile_path,
+    process_tile_async,
+    CanvasPool,
+    make_render_plan,
+    OutputMemo,
+    tileset_output_mode,
+    AsyncS3TileFetcher,
+    AsyncHttpTileFetcher,
+    Tile,
+)
+
+
+logger = logging.getLogger('zaloa.asgi')
+
+# the settings of the features only the flask app has, which the asgi app
+# refuses rather than serving the tiles without them
+FLASK_ONLY_SETTINGS = (
+    'OUTPUT_CACHE_SOFT_TTL',
+    'DISK_CACHE_DIR',
+    'OUTPUT_STORE',
+    'PEERS',
+    'PINNED_MAX_ZOOM',
+    'SOURCE_CACHE_SIZE',
+    'PREWARM_SOURCE_MAX_ZOOM',
+    'PREFETCH_MAX_TILES',
+    'PROFILE_TOKEN',
+    'PROFILE_SAMPLE_RATE',
+)
+
+
+def load_settings():
+    # mirror flask's app.config.from_object('config')
+    import config
+    return dict(
+        (key, getattr(config, key))
+        for key in dir(config) if key.isupper()
+    )
+
+
+class TileApp(object):
+    """
+    ASGI application exposing the tile routes of the flask app
+
+    Source tiles are fetched concurrently on the event loop with the
+    async fetchers, and the image decode/encode happens on a thread pool
+    executor.
+
+    Only the tiles, /health_check and /metrics are served, from the s3
+    and http origins, with the output memo and canvas pool. The batch,
+    elevation and peer routes, the multi fetch method, the output, disk,
+    source and pinned caches, the output store, prefetching and profiling
+    are only in the flask app, and their settings are refused.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        fetch_type = settings.get('TILES_FETCH_METHOD')
+        assert fetch_type in ('s3', 'http'), "Fetch method must be s3 or http"
+        flask_only = [key for key in FLASK_ONLY_SETTINGS if settings.get(key)]
+        if settings.get('CACHE_TYPE') not in (None, 'null', 'NullCache'):
+            flask_only.append('CACHE_TYPE')
+        assert not flask_only, \
+            "Only the flask app supports %s" % ', '.join(flask_only)
+        self.executor = ThreadPoolExecutor(
+            max_workers=settings.get('ASGI_EXECUTOR_WORKERS'))
+        self.tile_fetcher = None
+        self._client_context = None
+        self._startup_lock = None
+        self.output_memo = None
+        self.canvas_pool = None
+        if settings.get('CANVAS_POOL_SIZE'):
+            self.canvas_pool = CanvasPool(
+                settings.get('CANVAS_POOL_SIZE'), record_canvas_pool_event)
+        if settings.get('OUTPUT_MEMO_SIZE'):
+            self.output_memo = OutputMemo(
+                settings.get('OUTPUT_MEMO_SIZE'),
+                lambda hit: record_cache_lookup('memo', hit))
+        if settings.get('TRACE_SAMPLE_RATE'):
+            configure_trace_logging(settings.get('TRACE_LOG_PATH'))
+
+    async def startup(self):
+        """Create the tile fetcher, once however many requests start up"""
+        # created here to be bound to the running loop
+        if self._startup_lock is None:
+            self._startup_lock = asyncio.Lock()
+        async with self._startup_lock:
+            if self.tile_fetcher is None:
+                self.tile_fetcher = await self._create_tile_fetcher()
+
+    async def _create_tile_fetcher(self):
+        fetch_type = self.settings.get('TILES_FETCH_METHOD')
+        if fetch_type == 's3':
+            import aiobotocore.session
+            session = aiobotocore.session.get_session()
+            self._client_context = session.create_client('s3')
+            s3_client = await self._client_context.__aenter__()
+            bucket = self.settings.get('TILES_S3_BUCKET')
+            tile_fetcher = AsyncS3TileFetcher(s3_client, bucket)
+        elif fetch_type == 'http':
+            import aiohttp
+            connector = aiohttp.TCPConnector(
+                limit=self.settings.get('ASGI_HTTP_CONNECTION_LIMIT'))
+            self._client_context = aiohttp.ClientSession(connector=connector)
+            http_session = await self._client_context.__aenter__()
+            url_prefix = self.settings.get('TILES_HTTP_PREFIX')
+            tile_fetcher = AsyncHttpTileFetcher(http_session, url_prefix)
+        return AsyncInstrumentedTileFetcher(tile_fetcher, fetch_type)
+
+    async def shutdown(self):
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client_context = None
+        self.executor.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle_http(scope, send)
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.exception('Startup failed')
+                    await send(dict(
+                        type='lifespan.startup.failed', message=str(e)))
+                    return
+                await send(dict(type='lifespan.startup.complete'))
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send(dict(type='lifespan.shutdown.complete'))
+                return
+
+    async def handle_http(self, scope, send):
+        method = scope['method']
+        if method not in ('GET', 'HEAD'):
+            await self.respond(send, method, 405, b'Method Not Allowed')
+            return
+
+        if self.tile_fetcher is None:
+            # servers that don't support the lifespan protocol
+            await self.startup()
+
+        path = scope['path']
+        start = time.perf_counter()
+        try:
+            if path == '/health_check':
+                await self.render_tile('terrarium', 256, Tile(0, 0, 0))
+                await self.respond(send, method, 200, b'OK')
+                return
+
+            if path == '/metrics':
+                await self.respond(
+                    send, method, 200, REGISTRY.render().encode('utf-8'),
+                    content_type=PROMETHEUS_CONTENT_TYPE.encode('ascii'))
+                return
+
+            parse_result = parse_tile_path(path)
+            if parse_result.not_found_reason:
+                await self.respond(
+                    send, method, 404,
+                    parse_result.not_found_reason.encode('utf-8'))
+                return
+
+            output_format = parse_result.output_format
+            extra_headers = []
+            # the png urls can be served in the other formats the client
+            # accepts
+            negotiable = self.settings.get('NEGOTIATE_OUTPUT_FORMATS')
+            if output_format == 'png' and negotiable:
+                accept = dict(scope.get('headers') or ()).get(b'accept', b'')
+                output_format = negotiate_output_format(
+                    accept.decode('latin-1'), negotiable,
+                    parse_result.tileset)
+                extra_headers.append((b'vary', b'Accept'))
+
+            image_bytes, timing_metadata = await self.render_tile(
+                parse_result.tileset, parse_result.tilesize,
+                parse_result.tile, output_format)
+        except Exception:
+            logger.exception('Error handling %s', path)
+            await self.respond(send, method, 500, b'Internal Server Error')
+            return
+
+        fetch_type = self.settings.get('TILES_FETCH_METHOD')
+        total = time.perf_counter() - start
+        STAGE_DURATION.observe(total, (
+            'total', parse_result.tileset, parse_result.tilesize,
+            fetch_type))
+        server_timing = format_server_timing(
+            timing_metadata, [('total', total)])
+        extra_headers.append((b'server-timing', server_timing.encode('ascii')))
+        content_type = OUTPUT_FORMATS[output_format].content_type
+        await self.respond(
+            send, method, 200, image_bytes,
+            content_type=content_type.encode('ascii'),
+            extra_headers=extra_headers)
+
+    async def render_tile(self, tileset, tilesize, tile, output_format='png'):
+        plan = make_render_plan(
+            tileset, tilesize, tile, self.canvas_pool,
+            tileset_output_mode(self.settings.get('TILESET_MODES'), tileset),
+            output_format, self.settings.get('DERIVE_NORMALS'))
+        fetch_type = self.settings.get('TILES_FETCH_METHOD')
+        tracer = make_tracer(
+            self.settings.get('TRACE_SAMPLE_RATE'), 'handle_tile',
+            tileset=tileset, tilesize=tilesize, tile=str(tile),
+            backend=fetch_type)
+        try:
+            with tracer.span('handle_tile') as request_span:
+                image_bytes, timing_metadata, tile_coords = \
+                    await process_tile_async(
+                        plan.coords_generator, self.tile_fetcher,
+                        plan.image_reducer, plan.source_tileset, tile,
+                        executor=self.executor,
+                        tracer=tracer, parent_span=request_span,
+                        max_fetch_concurrency=self.settings.get(
+                            'MAX_FETCH_CONCURRENCY', MAX_FETCH_CONCURRENCY),
+                        output_memo=self.output_memo)
+        except Exception as e:
+            REQUEST_ERRORS.inc((tileset, tilesize, type(e).__name__))
+            raise
+        finally:
+            tracer.emit()
+        observe_timing(timing_metadata, tileset, tilesize, fetch_type)
+        return image_bytes, timing_metadata
+
+    async def respond(self, send, method, status, body,
+                      content_type=b'text/plain; charset=utf-8',
+                      extra_headers=()):
+        headers = [
+            (b'content-type', content_type),
+            (b'content-length', str(len(body)).encode('ascii')),
+        ]
+        headers.extend(extra_headers)
+        if self.settings.get('CORS_SEND_WILDCARD'):
+            headers.append((b'access-control-allow-origin', b'*'))
+        await send(dict(
+            type='http.response.start',
+            status=status,
+            headers=headers,
+        ))
+        await send(dict(
+            type='http.response.body',
+            body=body if method != 'HEAD' else b'',
+        ))
+
+
+def create_asgi_app(settings=None):
+    if settings is None:
+        settings = load_settings()
+    return TileApp(settings)
@@ -0,0 +1,373 @@
+"""
+Microbenchmarks for the tile merging hot paths
+
+Runs without any network access, using synthetic terrarium tiles. Times
+the CoordinatePlanner across interior and edge tiles,
+ImageReducer.reduce for each kind of crop, and ImageReducer.finalize for
+each tile size.
+
+Results are written as json, and can be compared against a stored
+baseline, failing when any benchmark regressed by more than the
+threshold:
+
+    python bench.py --output baseline.json
+    python bench.py --baseline baseline.json --threshold 0.2
+
+--startup also times importing wsgi_server in a fresh interpreter, which
+is what a cold start pays before the first request. --allocations counts
+the images Pillow allocates and the peak python allocations per render,
+with and without a CanvasPool. --modes compares the encode time and
+size of the outputs in each mode, for both tilesets.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import timeit
+import tracemalloc
+from io import BytesIO
+
+import PIL
+from PIL import Image
+
+from zaloa import (
+    CanvasPool,
+    COORDS_GENERATORS,
+    ImageInput,
+    ImageReducer,
+    ImageSpec,
+    Tile,
+)
+
+
+# the edge cases each have their own templates in the buffered planners
+COORDS_TILES = (
+    ('interior', Tile(10, 300, 400)),
+    ('top-left', Tile(10, 0, 0)),
+    ('top', Tile(10, 300, 0)),
+    ('right', Tile(10, 1023, 400)),
+    ('bottom-right', Tile(10, 1023, 1023)),
+    ('z0', Tile(0, 0, 0)),
+)
+
+# the kinds of crops that the coordinate plans use
+REDUCE_CROPS = (
+    ('full', None),
+    ('row', (0, 254, 256, 256)),
+    ('column', (254, 0, 256, 256)),
+    ('corner', (254, 254, 256, 256)),
+)
+
+_synthetic_tiles = {}
+
+
+def terrarium_pixel(elevation):
+    value = elevation + 32768
+    red = int(value // 256)
+    green = int(value) % 256
+    blue = int((value - math.floor(value)) * 256)
+    return red, green, blue
+
+
+def synthetic_terrarium_tile(tile, mode='RGB'):
+    """
+    A terrarium encoded png with smoothly varying terrain
+
+    The terrain is continuous across tile boundaries, so the merged
+    tiles compress like real data.
+    """
+    key = (tile.z, tile.x, tile.y, mode)
+    image_bytes = _synthetic_tiles.get(key)
+    if image_bytes is not None:
+        return image_bytes
+
+    pixels = bytearray()
+    for py in range(256):
+        world_y = tile.y * 256 + py
+        for px in range(256):
+            world_x = tile.x * 256 + px
+            elevation = (
+                1500 +
+                800 * math.sin(world_x / 37.0) * math.cos(world_y / 53.0) +
+                120 * math.sin((world_x + world_y) / 7.0)
+            )
+            pixels.extend(terrarium_pixel(elevation))
+            if mode == 'RGBA':
+                pixels.append(255)
+    image = Image.frombytes(mode, (256, 256), bytes(pixels))
+    fp = BytesIO()
+    image.save(fp, format='PNG')
+    image_bytes = _synthetic_tiles[key] = fp.getvalue()
+    return image_bytes
+
+
+def synthetic_image_inputs(coords_generator, tile, mode='RGB'):
+    return [
+        ImageInput(synthetic_terrarium_tile(tile_coords.tile, mode),
+                   tile_coords.image_spec, tile_coords.tile)
+        for tile_coords in coords_generator(tile)
+    ]
+
+
+def coords_benchmarks():
+    for size, planner in sorted(COORDS_GENERATORS.items()):
+        for tile_name, tile in COORDS_TILES:
+            name = 'plan/%s/%s' % (size, tile_name)
+            yield name, (lambda p=planner, t=tile: p(t)), 2000
+
+
+def reduce_benchmarks():
+    image_bytes = synthetic_terrarium_tile(Tile(10, 300, 400))
+    image_reducer = ImageReducer(260)
+    image_state = image_reducer.create_initial_state()
+    for crop_name, crop_bounds in REDUCE_CROPS:
+        image_input = ImageInput(
+            image_bytes, ImageSpec((2, 2), crop_bounds), Tile(10, 300, 400))
+        name = 'reduce/%s' % crop_name
+
+        def reduce_once(image_input=image_input):
+            image_reducer.reduce(image_state, image_input)
+        yield name, reduce_once, 50
+
+
+def finalize_benchmarks():
+    tile = Tile(10, 300, 400)
+    for size, coords_generator in sorted(COORDS_GENERATORS.items()):
+        image_reducer = ImageReducer(size)
+        image_state = image_reducer.create_initial_state()
+        for image_input in synthetic_image_inputs(coords_generator, tile):
+            image_reducer.reduce(image_state, image_input)
+        name = 'finalize/%s' % size
+
+        def finalize_once(image_reducer=image_reducer,
+                          image_state=image_state):
+            image_reducer.finalize(image_state)
+        yield name, finalize_once, 5
+
+
+def make_render(size, canvas_pool):
+    """A whole reduce and finalize of one output tile"""
+    coords_generator = COORDS_GENERATORS[size]
+    image_inputs = synthetic_image_inputs(
+        coords_generator, Tile(10, 300, 400))
+
+    def render_once():
+        image_reducer = ImageReducer(size, canvas_pool)
+        image_state = image_reducer.create_initial_state()
+        for image_input in image_inputs:
+            image_reducer.reduce(image_state, image_input)
+        image_reducer.finalize(image_state)
+    return render_once
+
+
+POOL_VARIANTS = (
+    ('unpooled', lambda: None),
+    ('pooled', lambda: CanvasPool(4)),
+)
+
+
+def render_benchmarks():
+    for size in (516, 1028):
+        for variant, make_pool in POOL_VARIANTS:
+            name = 'render/%d/%s' % (size, variant)
+            yield name, make_render(size, make_pool()), 2
+
+
+BENCHMARK_GROUPS = (
+    coords_benchmarks,
+    reduce_benchmarks,
+    finalize_benchmarks,
+    render_benchmarks,
+)
+
+
+def count_allocations(fn, number):
+    """
+    Pillow image and python allocations per call of fn
+
+    tracemalloc does not see the pixel memory, which Pillow allocates
+    itself, so that is taken from Pillow's allocator statistics.
+    """
+    fn()
+    before = Image.core.get_stats()
+    tracemalloc.start()
+    for i in range(number):
+        fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    after = Image.core.get_stats()
+    return dict(
+        images=(after['new_count'] - before['new_count']) / float(number),
+        blocks=(after['allocated_blocks'] - before['allocated_blocks']) /
+        float(number),
+        python_peak=peak,
+    )
+
+
+# the source modes of the tilesets, and the output modes to compare
+TILESET_MODES = (
+    ('terrarium', 'RGB', ('RGBA', 'RGB', None)),
+    ('normal', 'RGBA', ('RGBA', None)),
+)
+
+
+def run_mode_comparison(repeat=3):
+    """The smallest finalize time and the output size for each mode"""
+    results = {}
+    tile = Tile(10, 300, 400)
+    for tileset, source_mode, output_modes in TILESET_MODES:
+        for size in (516, 1028):
+            image_inputs = synthetic_image_inputs(
+                COORDS_GENERATORS[size], tile, source_mode)
+            for output_mode in output_modes:
+                image_reducer = ImageReducer(size, mode=output_mode)
+                image_state = image_reducer.create_initial_state()
+                for image_input in image_inputs:
+                    image_reducer.reduce(image_state, image_input)
+                timings = timeit.repeat(
+                    lambda: image_reducer.finalize(image_state),
+                    number=1, repeat=repeat)
+                name = 'finalize/%d/%s/%s' % (
+                    size, tileset, output_mode or 'auto')
+                results[name] = dict(
+                    finalize=min(timings),
+                    bytes=len(image_reducer.finalize(image_state)),
+                )
+    return results
+
+
+def run_allocations(number=5):
+    results = {}
+    for size in (516, 1028):
+        for variant, make_pool in POOL_VARIANTS:
+            name = 'render/%d/%s' % (size, variant)
+            results[name] = count_allocations(
+                make_render(size, make_pool()), number)
+    return results
+
+
+def cold_start_once():
+    env = dict(os.environ, TILES_FETCH_METHOD='http',
+               TILES_HTTP_PREFIX='http://localhost')
+    subprocess.check_call(
+        [sys.executable, '-c', 'import wsgi_server'], env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def startup_benchmarks():
+    yield 'startup/cold', cold_start_once, 1
+
+
+def run_benchmark(fn, number, repeat):
+    timings = timeit.repeat(fn, number=number, repeat=repeat)
+    per_op = sorted(t / number for t in timings)
+    return dict(
+        min=per_op[0],
+        median=per_op[len(per_op) // 2],
+        number=number,
+        repeat=repeat,
+    )
+
+
+def run_benchmarks(name_filter=None, repeat=5, scale=1.0, startup=False):
+    results = {}
+    groups = BENCHMARK_GROUPS
+    if startup:
+        groups += (startup_benchmarks,)
+    for group in groups:
+        for name, fn, number in group():
+            if name_filter and name_filter not in name:
+                continue
+            number = max(1, int(number * scale))
+            results[name] = run_benchmark(fn, number, repeat)
+    return dict(
+        environment=dict(
+            python=platform.python_version(),
+            implementation=platform.python_implementation(),
+            pillow=PIL.__version__,
+            machine=platform.machine(),
+        ),
+        benchmarks=results,
+    )
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare the fastest timings against the baseline
+
+    Returns the report lines and the names of the benchmarks that got
+    slower by more than the threshold, a fraction of the baseline.
+    """
+    lines = []
+    regressions = []
+    current = results['benchmarks']
+    previous = baseline['benchmarks']
+    for name in sorted(current):
+        if name not in previous:
+            lines.append('%-28s %12.3fus   (new)' % (
+                name, current[name]['min'] * 1e6))
+            continue
+        ratio = current[name]['min'] / previous[name]['min']
+        regressed = ratio > 1.0 + threshold
+        if regressed:
+            regressions.append(name)
+        lines.append('%-28s %12.3fus %12.3fus %+7.1f%%%s' % (
+            name, previous[name]['min'] * 1e6, current[name]['min'] * 1e6,
+            (ratio - 1.0) * 100.0, '  REGRESSION' if regressed else ''))
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark coordinate generation, reduce and finalize')
+    parser.add_argument('--output', help='write the json results here')
+    parser.add_argument('--baseline', help='json results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown relative to the baseline')
+    parser.add_argument('--filter', help='only run benchmarks matching this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale the number of iterations')
+    parser.add_argument('--startup', action='store_true',
+                        help='also time a cold import of wsgi_server')
+    parser.add_argument('--allocations', action='store_true',
+                        help='also count the allocations per render')
+    parser.add_argument('--modes', action='store_true',
+                        help='also compare the output modes')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.filter, args.repeat, args.scale,
+                             args.startup)
+    if args.allocations:
+        results['allocations'] = run_allocations()
+    if args.modes:
+        results['modes'] = run_mode_comparison(args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    elif not args.baseline:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        lines, regressions = compare(results, baseline, args.threshold)
+        print('\n'.join(lines))
+        if regressions:
+            print('%d benchmarks regressed by more than %d%%: %s' % (
+                len(regressions), args.threshold * 100,
+                ', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+"""
+Size the output and source caches from access logs
+
+Reads request logs (from files or stdin) and picks out the tile paths,
+eg /tilezen/terrain/v1/516/terrarium/10/163/395.png, whatever the log
+format around them. Each request is expanded into the source tiles it
+needs with the coordinate generators of the server, and the hit ratios
+of LRU and LFU caches over a range of sizes are simulated for the output
+tiles and for the source tiles:
+
+    python cache_sim.py access.log --sizes 1000,10000,100000
+
+The source cache only sees the requests that miss the output cache, so
+--output-cache-size simulates it behind an LRU output cache of that
+size, which the default of 0 leaves out, as with CACHE_TYPE=null.
+
+With --warm, the most requested tiles are rendered into the output cache
+(and output store) configured in config.py instead, eg to fill a shared
+redis cache before a deploy takes traffic:
+
+    CACHE_TYPE=redis CACHE_REDIS_URL=redis://... TILES_FETCH_METHOD=s3 \\
+        TILES_S3_BUCKET=elevation-tiles-prod \\
+        python cache_sim.py access.log --warm 1000
+"""
+
+from __future__ import print_function
+
+import argparse
+import fileinput
+import re
+from array import array
+from collections import Counter, defaultdict, OrderedDict
+
+
+DEFAULT_SIZES = '100,300,1000,3000,10000,30000,100000'
+TILE_PATH_IN_LOG_RE = re.compile(r'/tilezen/terrain/v1/[^\s?"]+')
+BAR_WIDTH = 40
+
+
+def read_tile_requests(paths):
+    """Generate the PathParseResult of each valid tile request in the logs"""
+    from zaloa import parse_tile_path
+    for line in fileinput.input(paths or ('-',)):
+        match = TILE_PATH_IN_LOG_RE.search(line)
+        if match is None:
+            continue
+        parse_result = parse_tile_path(match.group(0))
+        if parse_result.not_found_reason is None:
+            yield parse_result
+
+
+def output_path(parse_result):
+    return '/tilezen/terrain/v1/%d/%s/%s.%s' % (
+        parse_result.tilesize, parse_result.tileset, parse_result.tile,
+        parse_result.output_format)
+
+
+def source_keys(parse_result, derive_normals=False):
+    """The distinct (tileset, tile) sources that a request is rendered from"""
+    from zaloa import make_render_plan
+    plan = make_render_plan(
+        parse_result.tileset, parse_result.tilesize, parse_result.tile,
+        derive_normals=derive_normals)
+    return list(OrderedDict.fromkeys(
+        (plan.source_tileset, tile_coords.tile)
+        for tile_coords in plan.coords_generator(parse_result.tile)))
+
+
+class KeyIds(object):
+    """Intern the keys as small ints, so long traces stay compact"""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, key):
+        key_id = self.ids.get(key)
+        if key_id is None:
+            key_id = self.ids[key] = len(self.ids)
+        return key_id
+
+
+class FenwickTree(object):
+
+    def __init__(self, size):
+        self.tree = array('i', [0]) * (size + 1)
+
+    def add(self, index, delta):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix_sum(self, index):
+        """The sum of the values at positions below index"""
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+def lru_hit_ratios(trace, sizes):
+    """
+    The hit ratios of LRU caches of each of the sizes, in a single pass
+
+    An access hits an LRU cache of size C when fewer than C distinct keys
+    were accessed since the previous access to the same key, its stack
+    distance. The distances are counted with a Fenwick tree holding a 1
+    at the time of the latest access to each key.
+    """
+    if not trace:
+        return dict((size, 0.0) for size in sizes)
+    tree = FenwickTree(len(trace))
+    last_access = {}
+    distances = Counter()
+    for time, key in enumerate(trace):
+        previous = last_access.get(key)
+        if previous is not None:
+            distance = tree.prefix_sum(time) - tree.prefix_sum(previous + 1)
+            distances[distance] += 1
+            tree.add(previous, -1)
+        tree.add(time, 1)
+        last_access[key] = time
+    return dict(
+        (size, sum(count for distance, count in distances.items()
+                   if distance < size) / float(len(trace)))
+        for size in sizes)
+
+
+def lfu_hit_ratio(trace, size):
+    """
+    The hit ratio of an LFU cache of the size
+
+    Keys are counted while they are cached, and the least recently used
+    of the least frequently used key is evicted.
+    """
+    if not trace or size <= 0:
+        return 0.0
+    counts = {}
+    buckets = defaultdict(OrderedDict)
+    min_count = 0
+    hits = 0
+    for key in trace:
+        count = counts.get(key)
+        if count is not None:
+            hits += 1
+            del buckets[count][key]
+            if not buckets[count]:
+                del buckets[count]
+                if min_count == count:
+                    min_count = count + 1
+            counts[key] = count + 1
+            buckets[count + 1][key] = None
+            continue
+        if len(counts) >= size:
+            evicted, _ = buckets[min_count].popitem(last=False)
+            if not buckets[min_count]:
+                del buckets[min_count]
+            del counts[evicted]
+        counts[key] = 1
+        buckets[1][key] = None
+        min_count = 1
+    return hits / float(len(trace))
+
+
+def build_traces(tile_requests, derive_normals=False, output_cache_size=0):
+    """
+    The output and source key traces of the requests, as interned ids
+
+    With an output_cache_size, the source trace only has the sources of
+    the requests that miss an LRU output cache of that size.
+    """
+    output_ids = KeyIds()
+    source_ids = KeyIds()
+    output_trace = array('i')
+    source_trace = array('i')
+    output_cache = OrderedDict()
+    for parse_result in tile_requests:
+        key = output_path(parse_result)
+        output_trace.append(output_ids(key))
+        if output_cache_size:
+            if key in output_cache:
+                output_cache.move_to_end(key)
+                continue
+            output_cache[key] = None
+            if len(output_cache) > output_cache_size:
+                output_cache.popitem(last=False)
+        for source_key in source_keys(parse_result, derive_normals):
+            source_trace.append(source_ids(source_key))
+    return output_trace, source_trace
+
+
+def simulate(trace, sizes):
+    """The (size, lru hit ratio, lfu hit ratio) of each cache size"""
+    lru = lru_hit_ratios(trace, sizes)
+    return [(size, lru[size], lfu_hit_ratio(trace, size)) for size in sizes]
+
+
+def format_curve(name, trace, curve):
+    lines = ['%s: %d lookups, %d distinct' % (
+        name, len(trace), len(set(trace)))]
+    lines.append('%10s %7s %7s' % ('size', 'lru', 'lfu'))
+    for size, lru, lfu in curve:
+        lines.append(('%10d %6.1f%% %6.1f%% %s' % (
+            size, lru * 100.0, lfu * 100.0,
+            '#' * int(lru * BAR_WIDTH))).rstrip())
+    return '\n'.join(lines)
+
+
+def hot_tiles(tile_requests, top_n):
+    """The paths of the top_n most requested tiles, most requested first"""
+    counts = Counter(output_path(parse_result)
+                     for parse_result in tile_requests)
+    return [path for path, count in counts.most_common(top_n)]
+
+
+def warm(paths, workers=8, app=None):
+    """
+    Render the tiles into the configured output caches and store
+
+    The tiles are requested through the app, created from config.py by
+    default, so they are cached under the same keys, and with the same
+    settings, as the requests would be. Returns the paths that failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from server import create_app, has_output_cache
+    if app is None:
+        app = create_app()
+    extensions = app.extensions['zaloa']
+    if not has_output_cache(app.config) and \
+            extensions['disk_cache'] is None and \
+            extensions['output_store'] is None:
+        raise ValueError('There is no output cache or store to warm, '
+                         'see CACHE_TYPE, DISK_CACHE_DIR and OUTPUT_STORE')
+
+    def request_tile(path):
+        resp = app.test_client().get(path)
+        # reading a streamed response is what caches it
+        resp.get_data()
+        return resp.status_code
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = list(executor.map(request_tile, paths))
+    output_store_writer = extensions['output_store_writer']
+    if output_store_writer is not None:
+        output_store_writer.flush()
+    return [path for path, status in zip(paths, statuses) if status != 200]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Simulate cache hit ratios or warm the output cache '
+                    'from access logs')
+    parser.add_argument('paths', nargs='*', help='access logs, default stdin')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='comma separated cache sizes, in tiles')
+    parser.add_argument('--output-cache-size', type=int, default=0,
+                        help='simulate the source cache behind an LRU '
+                             'output cache of this many tiles')
+    parser.add_argument('--derive-normals', action='store_true',
+                        help='expand the normal tiles into terrarium '
+                             'sources, as with DERIVE_NORMALS')
+    parser.add_argument('--warm', type=int, metavar='N',
+                        help='render the N most requested tiles into the '
+                             'configured output cache instead')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='tiles rendered at once when warming')
+    args = parser.parse_args(argv)
+
+    tile_requests = read_tile_requests(args.paths)
+    if args.warm:
+        paths = hot_tiles(tile_requests, args.warm)
+        failed = warm(paths, args.workers)
+        print('Warmed %d tiles, %d failed' % (
+            len(paths) - len(failed), len(failed)))
+        for path in failed:
+            print('  %s' % path)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    output_trace, source_trace = build_traces(
+        tile_requests, args.derive_normals, args.output_cache_size)
+    print(format_curve('output tiles', output_trace,
+                       simulate(output_trace, sizes)))
+    print()
+    print(format_curve('source tiles', source_trace,
+                       simulate(source_trace, sizes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Compare derived normal tiles against the stored ones
+
+Renders each tile twice through the configured fetcher (see config.py):
+merged from the stored normal sources, and derived from the terrarium
+sources as with DERIVE_NORMALS, and reports how far apart they are:
+
+* the angle between the normal vectors, in degrees
+* the fraction of pixels whose elevation index (alpha) differs, and by
+  more than one step of NORMAL_HEIGHT_TABLE
+
+The stored normals were computed from the full precision elevation
+data, rather than from its terrarium encoding, so they are not expected
+to be identical. Each tile is reported as within the tolerance or not,
+and the exit status is 1 if any tile is not.
+
+    TILES_FETCH_METHOD=s3 TILES_S3_BUCKET=elevation-tiles-prod \\
+        python check_normals.py 516 4/3/5 10/163/395
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+from io import BytesIO
+
+
+PERCENTILES = (50, 90, 99)
+# the most a derived tile may differ from the stored one: the 99th
+# percentile of the angle between the normals, in degrees, and the
+# fraction of pixels in another step of NORMAL_HEIGHT_TABLE. Indexing the
+# table off by one puts nearly every pixel in another step
+MAX_ANGLE_P99 = 5.0
+MAX_ALPHA_DIFFERS = 0.25
+
+
+def compare_normal_images(stored, derived):
+    """The per pixel differences between two normal tiles"""
+    import numpy
+    stored = numpy.asarray(stored.convert('RGBA'), dtype=numpy.float64)
+    derived = numpy.asarray(derived.convert('RGBA'), dtype=numpy.float64)
+    assert stored.shape == derived.shape
+
+    def unit_vectors(pixels):
+        vectors = pixels[:, :, :3] / 128.0 - 1.0
+        norm = numpy.sqrt((vectors * vectors).sum(axis=2))
+        return vectors / norm[:, :, numpy.newaxis]
+
+    cosine = (unit_vectors(stored) * unit_vectors(derived)).sum(axis=2)
+    angles = numpy.degrees(numpy.arccos(numpy.clip(cosine, -1.0, 1.0)))
+    alpha_steps = numpy.abs(stored[:, :, 3] - derived[:, :, 3])
+    return dict(
+        angle_percentiles=dict(
+            (pct, float(numpy.percentile(angles, pct)))
+            for pct in PERCENTILES),
+        alpha_differs=float((alpha_steps > 0).mean()),
+        alpha_differs_by_more_than_one=float((alpha_steps > 1).mean()),
+    )
+
+
+def within_tolerance(comparison):
+    return comparison['angle_percentiles'][99] <= MAX_ANGLE_P99 and \
+        comparison['alpha_differs'] <= MAX_ALPHA_DIFFERS
+
+
+def render_both(tile_fetcher, tilesize, tile):
+    from PIL import Image
+    from zaloa import make_render_plan, process_tile
+
+    images = []
+    for derive_normals in (False, True):
+        plan = make_render_plan(
+            'normal', tilesize, tile, derive_normals=derive_normals)
+        image_bytes, timing_metadata, tile_coords = process_tile(
+            plan.coords_generator, tile_fetcher, plan.image_reducer,
+            plan.source_tileset, tile)
+        images.append(Image.open(BytesIO(image_bytes)))
+    return images
+
+
+def format_comparison(tilesize, tile, comparison):
+    angles = ' '.join(
+        'p%d=%.2f' % (pct, comparison['angle_percentiles'][pct])
+        for pct in PERCENTILES)
+    return '%s/%s angle(deg) %s alpha differs %.1f%% (>1 step %.1f%%) %s' % (
+        tilesize, tile, angles, comparison['alpha_differs'] * 100.0,
+        comparison['alpha_differs_by_more_than_one'] * 100.0,
+        'ok' if within_tolerance(comparison) else 'OVER TOLERANCE')
+
+
+def main(argv=None):
+    import config
+    from server import make_tile_fetcher
+    from startup import StartupTimer
+    from zaloa import Tile
+
+    parser = argparse.ArgumentParser(
+        description='Compare derived normal tiles against the stored ones')
+    parser.add_argument('tilesize', type=int)
+    parser.add_argument('tiles', nargs='+', help='z/x/y')
+    args = parser.parse_args(argv)
+
+    settings = dict(
+        (key, getattr(config, key)) for key in dir(config) if key.isupper())
+    tile_fetcher = make_tile_fetcher(settings, StartupTimer())
+    all_within_tolerance = True
+    for tile_path in args.tiles:
+        tile = Tile(*(int(part) for part in tile_path.split('/')))
+        stored, derived = render_both(tile_fetcher, args.tilesize, tile)
+        comparison = compare_normal_images(stored, derived)
+        print(format_comparison(args.tilesize, tile, comparison))
+        all_within_tolerance &= within_tolerance(comparison)
+    return 0 if all_within_tolerance else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,6 +14,10 @@ CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", '1200'))
 # http://werkzeug.pocoo.org/docs/0.14/datastructures/#werkzeug.datastructures.ResponseCacheControl.s_maxage
 SHARED_CACHE_MAX_AGE = int(os.environ.get("SHARED_CACHE_MAX_AGE", '600'))
 
+# Seconds a downstream cache may serve a tile after its max age while it revalidates it in
+# the background, emitted as Cache-Control: stale-while-revalidate when set
+CACHE_STALE_WHILE_REVALIDATE = int(os.environ.get('CACHE_STALE_WHILE_REVALIDATE', '0'))
+
 CACHE_TYPE = os.environ.get('CACHE_TYPE', 'null')
 CACHE_NO_NULL_WARNING = True
 # Expose some of the caching config via environment variables
@@ -22,9 +26,133 @@ CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
 CACHE_THRESHOLD = int(os.environ.get('CACHE_THRESHOLD')) if os.environ.get('CACHE_THRESHOLD') else None
 CACHE_KEY_PREFIX = os.environ.get('CACHE_KEY_PREFIX')
 CACHE_DIR = os.environ.get('CACHE_DIR')
+# Seconds after which a tile in the output cache is stale. Stale tiles are served while they
+# are revalidated in the background, once per tile. Unset, tiles are fresh until they expire
+OUTPUT_CACHE_SOFT_TTL = int(os.environ.get('OUTPUT_CACHE_SOFT_TTL')) if os.environ.get('OUTPUT_CACHE_SOFT_TTL') else None
+# Seconds after which tiles expire from the output cache, defaults to CACHE_DEFAULT_TIMEOUT
+# (300 unless set). Must be more than OUTPUT_CACHE_SOFT_TTL
+OUTPUT_CACHE_HARD_TTL = int(os.environ.get('OUTPUT_CACHE_HARD_TTL')) if os.environ.get('OUTPUT_CACHE_HARD_TTL') else None
+# Number of threads revalidating stale tiles
+REVALIDATE_WORKERS = int(os.environ.get('REVALIDATE_WORKERS', '2'))
 
-# This can be 's3' or 'http'
+# This can be 's3', 'http' or 'multi'
 TILES_FETCH_METHOD = os.environ.get('TILES_FETCH_METHOD')
 TILES_S3_BUCKET = os.environ.get("TILES_S3_BUCKET")
 TILES_HTTP_PREFIX = os.environ.get("TILES_HTTP_PREFIX")
+# With the multi fetch method, comma separated kind:location origins that mirror the
+# tiles, cheapest first, eg disk:/data/tiles,mbtiles:/data/{tileset}.mbtiles,http:https://cdn.example.com,s3:elevation-tiles-prod
+# Each fetch goes to the fastest healthy origin, and falls back to the others on errors
+TILES_ORIGINS = [origin for origin in os.environ.get('TILES_ORIGINS', '').split(',') if origin]
 REQUESTER_PAYS = os.environ.get("REQUESTER_PAYS", 'false') == 'true'
+# Output image mode for each tileset, as tileset:mode pairs. The terrarium tiles have
+# no alpha, so they are merged and encoded as RGB. Tilesets that are not listed, or
+# are set to auto, are RGB when none of their sources have any transparency
+TILESET_MODES = dict(pair.split(':') for pair in os.environ.get('TILESET_MODES', 'terrarium:RGB,normal:RGBA').split(',') if pair)
+# Compute the normal tiles from the terrarium sources, rather than fetching the
+# normal sources
+DERIVE_NORMALS = os.environ.get('DERIVE_NORMALS', 'false') == 'true'
+# Comma separated output formats (webp, f32) that the .png urls are served in when
+# the client's Accept header names them. Responses then vary on Accept
+NEGOTIATE_OUTPUT_FORMATS = [name for name in os.environ.get('NEGOTIATE_OUTPUT_FORMATS', '').split(',') if name]
+# Stream png outputs to the client as they are encoded, rather than after. Only
+# worthwhile where the response is not buffered in front of the app, which it is
+# on Lambda behind API Gateway
+STREAM_PNG_OUTPUT = os.environ.get('STREAM_PNG_OUTPUT', 'false') == 'true'
+# The most output tiles that a batch request can ask for. The tiles are all held in memory
+BATCH_MAX_TILES = int(os.environ.get('BATCH_MAX_TILES', '64'))
+# The most points that an elevation request can ask for
+ELEVATION_MAX_POINTS = int(os.environ.get('ELEVATION_MAX_POINTS', '10000'))
+# The most distinct source tiles that the points of an elevation request can fall in. The
+# tiles are all held in memory, decoded
+ELEVATION_MAX_SOURCE_TILES = int(os.environ.get('ELEVATION_MAX_SOURCE_TILES', '64'))
+# Number of decoded source tiles to keep for the elevation requests, at 256KB each. 0
+# disables the cache, and the source tiles are decoded again on every request
+ELEVATION_CACHE_SIZE = int(os.environ.get('ELEVATION_CACHE_SIZE', '0'))
+# Directory to keep the rendered tiles in as files, which the hits are sent from without
+# reading them into python, see DISK_CACHE_SENDFILE. Unset disables the disk cache
+DISK_CACHE_DIR = os.environ.get('DISK_CACHE_DIR')
+# The most bytes of tiles to keep in DISK_CACHE_DIR, the least recently used are evicted
+DISK_CACHE_MAX_BYTES = int(os.environ.get('DISK_CACHE_MAX_BYTES', str(1024 ** 3)))
+# How the disk cache hits are sent: 'wsgi' through the server's wsgi.file_wrapper, which
+# gunicorn sends with sendfile, or 'x-accel-redirect' (nginx) or 'x-sendfile' (apache,
+# lighttpd) for the proxy in front of the app to send the file
+DISK_CACHE_SENDFILE = os.environ.get('DISK_CACHE_SENDFILE', 'wsgi')
+# The internal nginx location that DISK_CACHE_DIR is served on, for x-accel-redirect
+DISK_CACHE_ACCEL_PREFIX = os.environ.get('DISK_CACHE_ACCEL_PREFIX', '/zaloa-disk-cache/')
+# Store shared by all the processes that the rendered tiles are written through to, as
+# s3:<bucket>[/<prefix>] or disk:<directory>. Requests that miss the output cache look for
+# the tile there before rendering it. Needs SOURCE_CACHE_SIZE, against which the stored tiles
+# are found stale
+OUTPUT_STORE = os.environ.get('OUTPUT_STORE')
+# Redirect the requests for stored tiles to this url, where the store's keys are served
+# eg a public bucket with the prefix, rather than serving them from the app
+OUTPUT_STORE_REDIRECT_URL = os.environ.get('OUTPUT_STORE_REDIRECT_URL')
+# The most rendered tiles waiting to be written to the output store, more are dropped
+OUTPUT_STORE_QUEUE_SIZE = int(os.environ.get('OUTPUT_STORE_QUEUE_SIZE', '256'))
+# Comma separated base urls of all the instances of the fleet, this one included, eg
+# http://10.0.0.1:5000,http://10.0.0.2:5000. Each source tile is owned by one of them, by
+# consistent hashing, and the others fetch it from the owner before going to the origin.
+# Needs the source tile cache, see SOURCE_CACHE_SIZE
+PEERS = [peer.rstrip('/') for peer in os.environ.get('PEERS', '').split(',') if peer]
+# The base url of this instance, as it is listed in PEERS
+PEER_SELF_URL = (os.environ.get('PEER_SELF_URL') or '').rstrip('/') or None
+# Seconds to wait for a peer before fetching the source tile from the origin instead
+PEER_TIMEOUT = float(os.environ.get('PEER_TIMEOUT', '1.0'))
+# The most source tiles fetched at once for a single output tile
+MAX_FETCH_CONCURRENCY = int(os.environ.get('MAX_FETCH_CONCURRENCY', '16'))
+
+# Settings for the asyncio/ASGI variant of the server (asgi_server.py)
+# Number of threads used to decode and encode images off the event loop
+ASGI_EXECUTOR_WORKERS = int(os.environ.get('ASGI_EXECUTOR_WORKERS')) if os.environ.get('ASGI_EXECUTOR_WORKERS') else None
+# Maximum number of simultaneous connections to the http tile origin
+ASGI_HTTP_CONNECTION_LIMIT = int(os.environ.get('ASGI_HTTP_CONNECTION_LIMIT', '100'))
+
+# Fraction of tile requests (0 to 1) that get traced. Sampled traces are written as
+# one JSON object per line, see analyze_traces.py
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+# File the traces are appended to, defaults to stderr
+TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH')
+
+# Requests sending this token in the X-Zaloa-Profile header are profiled, and get a
+# summary of the profile back in the same header. Profiling is disabled without a token.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+# Fraction of tile requests (0 to 1) that are profiled regardless of the header
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+# Directory the full profiles (pstats format) are stored in, if set
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+# Startup. Fetcher clients are always created when the app is created. These prepare
+# more work ahead of the first request, which helps with Lambda cold starts.
+# Log how long each phase of creating the app took
+STARTUP_MEASURE = os.environ.get('STARTUP_MEASURE', 'false') == 'true'
+# Load Pillow's codecs and run a png through them
+PREWARM_PIL = os.environ.get('PREWARM_PIL', 'false') == 'true'
+# Number of source tiles to keep in memory, 0 disables the source tile cache
+SOURCE_CACHE_SIZE = int(os.environ.get('SOURCE_CACHE_SIZE', '0'))
+# Fetch all source tiles up to this zoom into the source tile cache
+PREWARM_SOURCE_MAX_ZOOM = int(os.environ.get('PREWARM_SOURCE_MAX_ZOOM')) if os.environ.get('PREWARM_SOURCE_MAX_ZOOM') else None
+
+# Speculative prefetch into the source tile cache, which it needs. The most source
+# tiles queued after each render, 0 disables the prefetch
+PREFETCH_MAX_TILES = int(os.environ.get('PREFETCH_MAX_TILES', '0'))
+# Number of threads prefetching, which only fetch while no request is rendering
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', '4'))
+# The most source tiles waiting to be prefetched
+PREFETCH_QUEUE_SIZE = int(os.environ.get('PREFETCH_QUEUE_SIZE', '256'))
+
+# Number of outputs to memoize by the content of their source tiles, eg for the
+# tiles that are all ocean. 0 disables the memo
+OUTPUT_MEMO_SIZE = int(os.environ.get('OUTPUT_MEMO_SIZE', '0'))
+
+# Number of idle output canvases and encode buffers to keep for reuse, per
+# tilesize. 0 disables pooling
+CANVAS_POOL_SIZE = int(os.environ.get('CANVAS_POOL_SIZE', '0'))
+
+# Pinned low zoom tiles. All the tiles up to this zoom are rendered when the app
+# is created and served from memory, unset disables pinning
+PINNED_MAX_ZOOM = int(os.environ.get('PINNED_MAX_ZOOM')) if os.environ.get('PINNED_MAX_ZOOM') else None
+# Comma separated tilesizes to pin. The default leaves out 1024 and 1028, whose tiles are
+# each as large as sixteen 256 ones
+PINNED_TILESIZES = [int(size) for size in os.environ.get('PINNED_TILESIZES', '256,260,512,516').split(',') if size]
+# Seconds between re-rendering the pinned tiles, 0 renders them once only
+PINNED_REFRESH_INTERVAL = float(os.environ.get('PINNED_REFRESH_INTERVAL', '3600'))
@@ -0,0 +1,216 @@
+"""
+Output tile cache on local disk
+
+For self hosted deployments, eg behind gunicorn, the rendered tiles are
+kept as files, which the hits are served from without reading them into
+python: through the server's wsgi.file_wrapper, which gunicorn sends
+with sendfile, or by a proxy in front of the app, with nginx's
+X-Accel-Redirect or the X-Sendfile of apache and lighttpd.
+
+The files are spread over two levels of directories by the hash of their
+key, so no directory gets too large. Each file is written under a
+temporary name and renamed into place, so a partially written tile is
+never served, and the processes of a server can share the directory.
+
+The cache is kept within a size budget by evicting the least recently
+used files, by modification time, which the hits update. The time each
+tile was written and the etags of its sources are kept next to it, in a
+file with a .meta suffix, for the tile to expire and be revalidated like
+those in the output cache.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from output_store import format_source_etags, parse_source_etags
+
+
+logger = logging.getLogger('zaloa.disk_cache')
+
+
+# file is open for reading, from which the tile can be sent whatever
+# happens to path after it was looked up
+DiskTile = namedtuple(
+    'DiskTile', 'path relative_path size file written_at source_etags')
+
+# the modification time of a hit is only updated when it is older than
+# this, so the hits of a popular tile do not all write to the disk
+TOUCH_INTERVAL = 60.0
+# the eviction removes tiles until the cache is down to this fraction of
+# its budget, so it does not run again on the next write
+EVICT_TO = 0.9
+TEMP_PREFIX = '.tmp'
+META_SUFFIX = '.meta'
+# mkstemp makes the files readable by their owner only, but with the
+# proxy modes they are sent by a web server running as another user
+FILE_MODE = 0o644
+# temporary files older than this were left by a process that crashed
+# while writing them
+TEMP_MAX_AGE = 3600.0
+
+
+class DiskTileCache(object):
+    """
+    Keep rendered tiles as files under root, within max_bytes
+
+    The size is tracked approximately, from a scan of root when the
+    cache is created and the tiles written since, and when it goes over
+    max_bytes the files are scanned again and the oldest evicted in the
+    background. The other processes sharing root are only counted by the
+    scans, so the cache can go over its budget by what they wrote in
+    between. on_event, if set, is called with each of 'written',
+    'failed' and 'evicted'.
+    """
+
+    def __init__(self, root, max_bytes, on_event=None, clock=time.time):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.on_event = on_event
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.evicting = False
+        os.makedirs(root, exist_ok=True)
+        self.approx_bytes = sum(size for _, size, _ in self._scan())
+
+    def _record(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def relative_path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return '%s/%s/%s' % (digest[:2], digest[2:4], digest)
+
+    def _read_meta(self, path):
+        """The written time and source etags of a tile, or None"""
+        try:
+            with open(path + META_SUFFIX) as fp:
+                written_at, _, source_etags = fp.read().partition('\n')
+            return float(written_at), parse_source_etags(source_etags)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, path, source_etags):
+        self._write(path + META_SUFFIX, ('%r\n%s' % (
+            self.clock(), format_source_etags(source_etags or {}))).encode(
+                'ascii'))
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=TEMP_PREFIX)
+        try:
+            os.fchmod(fd, FILE_MODE)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, key):
+        """
+        The DiskTile of the key, or None
+
+        Tiles without their metadata, eg written before it was kept, are
+        missing, to be rendered and written again.
+        """
+        relative_path = self.relative_path(key)
+        path = os.path.join(self.root, relative_path)
+        try:
+            fp = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        meta = self._read_meta(path)
+        if meta is None:
+            fp.close()
+            return None
+        stat = os.fstat(fp.fileno())
+        now = self.clock()
+        if now - stat.st_mtime > TOUCH_INTERVAL:
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                # evicted since it was opened, which the open file survives
+                pass
+        return DiskTile(path, relative_path, stat.st_size, fp, *meta)
+
+    def put(self, key, image_bytes, source_etags=None):
+        """Write a tile, failing to write it only logs"""
+        path = os.path.join(self.root, self.relative_path(key))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write_meta(path, source_etags)
+            self._write(path, image_bytes)
+        except OSError:
+            logger.exception('Failed to write %s to the disk cache', key)
+            self._record('failed')
+            return
+        self._record('written')
+
+        with self.lock:
+            self.approx_bytes += len(image_bytes)
+            if self.evicting or self.approx_bytes <= self.max_bytes:
+                return
+            self.evicting = True
+        thread = threading.Thread(target=self.evict)
+        thread.daemon = True
+        thread.start()
+
+    def refresh(self, key, source_etags):
+        """Make a tile fresh again, when its sources are unchanged"""
+        path = os.path.join(self.root, self.relative_path(key))
+        if not os.path.exists(path):
+            return
+        try:
+            self._write_meta(path, source_etags)
+        except OSError:
+            logger.exception('Failed to refresh %s in the disk cache', key)
+            self._record('failed')
+
+    def _scan(self):
+        """The (mtime, size, path) of the tiles under root"""
+        files = []
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            for file_name in file_names:
+                if file_name.endswith(META_SUFFIX):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                    if file_name.startswith(TEMP_PREFIX):
+                        if self.clock() - stat.st_mtime > TEMP_MAX_AGE:
+                            os.unlink(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """Remove the least recently used tiles until within the budget"""
+        try:
+            files = sorted(self._scan())
+            total = sum(size for _, size, _ in files)
+            target = self.max_bytes * EVICT_TO
+            for mtime, size, path in files:
+                if total <= target:
+                    break
+                for evicted_path in (path, path + META_SUFFIX):
+                    try:
+                        os.unlink(evicted_path)
+                    except FileNotFoundError:
+                        # evicted by another process
+                        pass
+                total -= size
+                self._record('evicted')
+            with self.lock:
+                self.approx_bytes = total
+        except Exception:
+            logger.exception('Failed to evict from the disk cache')
+        finally:
+            with self.lock:
+                self.evicting = False
@@ -0,0 +1,189 @@
+"""
+Elevations at points
+
+Services that need the elevations of many points, eg along a route,
+would otherwise download and decode the terrarium tiles themselves. The
+points are grouped by the source tile they fall in, so each tile is
+fetched and decoded once however many of the points are in it, and the
+decoded tiles are kept for the next requests.
+"""
+
+import math
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+from tracing import NULL_TRACER
+from zaloa import (
+    fetch_tiles_multi_threaded,
+    FetchResult,
+    LRUCache,
+    MAX_FETCH_CONCURRENCY,
+    MAX_LATITUDE,
+    MissingTileException,
+    terrarium_elevations,
+    Tile,
+    TileCoordinates,
+    time_block,
+)
+
+
+SOURCE_TILESET = 'terrarium'
+SOURCE_TILESIZE = 256
+MAX_ZOOM = 15
+
+# where each of the points (or the corners around them, when they are
+# interpolated) is found: the distinct source tiles, the index into tiles
+# of each, and the row and column in that tile. corners is 1, or 4 with
+# the weights of each corner
+PointPlan = namedtuple(
+    'PointPlan', 'tiles tile_indexes rows cols corners weights')
+
+
+def world_pixels(lngs, lats, z):
+    """The fractional pixel coordinates of the points at zoom z"""
+    import numpy
+    world_size = SOURCE_TILESIZE * 2 ** z
+    lats = numpy.radians(numpy.clip(lats, -MAX_LATITUDE, MAX_LATITUDE))
+    px = numpy.mod((numpy.asarray(lngs, dtype=numpy.float64) + 180.0) /
+                   360.0 * world_size, world_size)
+    py = (1.0 - numpy.arcsinh(numpy.tan(lats)) / math.pi) / 2.0 * world_size
+    return px, py
+
+
+def plan_points(lngs, lats, z, interpolate=False):
+    """
+    Find the source pixels of the points at zoom z
+
+    The elevation of a pixel is the one at its center. Without
+    interpolate a point takes the elevation of the pixel it falls in,
+    and with it the bilinear interpolation of the four pixel centers
+    around it, which can be in the neighboring tiles. The columns wrap
+    around the antimeridian, and the rows stop at the poles.
+    """
+    import numpy
+    world_size = SOURCE_TILESIZE * 2 ** z
+    px, py = world_pixels(lngs, lats, z)
+    if interpolate:
+        px = px - 0.5
+        py = py - 0.5
+    x0 = numpy.floor(px).astype(numpy.int64)
+    y0 = numpy.floor(py).astype(numpy.int64)
+    if interpolate:
+        wx = px - x0
+        wy = py - y0
+        xs = numpy.concatenate((x0, x0 + 1, x0, x0 + 1))
+        ys = numpy.concatenate((y0, y0, y0 + 1, y0 + 1))
+        weights = numpy.stack((
+            (1.0 - wx) * (1.0 - wy), wx * (1.0 - wy),
+            (1.0 - wx) * wy, wx * wy))
+        corners = 4
+    else:
+        xs, ys, weights, corners = x0, y0, None, 1
+    xs = numpy.mod(xs, world_size)
+    ys = numpy.clip(ys, 0, world_size - 1)
+
+    n = 2 ** z
+    tile_keys = (ys // SOURCE_TILESIZE) * n + xs // SOURCE_TILESIZE
+    unique_keys, tile_indexes = numpy.unique(tile_keys, return_inverse=True)
+    tiles = [Tile(z, int(key % n), int(key // n)) for key in unique_keys]
+    return PointPlan(
+        tiles, tile_indexes.reshape(-1), ys % SOURCE_TILESIZE,
+        xs % SOURCE_TILESIZE, corners, weights)
+
+
+def decode_elevations(image_bytes):
+    """The float32 elevation grid of a terrarium tile, NaN when missing"""
+    import numpy
+    if image_bytes is None:
+        return numpy.full(
+            (SOURCE_TILESIZE, SOURCE_TILESIZE), numpy.nan, numpy.float32)
+    image = Image.open(BytesIO(image_bytes))
+    return terrarium_elevations(image)
+
+
+class PointSampler(object):
+    """
+    Sample the elevations of points from the terrarium tiles
+
+    The decoded elevation grids of up to cache_size tiles are kept, so
+    the tiles shared by consecutive requests, eg for the points of nearby
+    routes, are neither fetched nor decoded again. on_lookup, if set, is
+    called with whether each lookup in them was a hit.
+    """
+
+    def __init__(self, tile_fetcher, cache_size=0, on_lookup=None,
+                 max_fetch_concurrency=MAX_FETCH_CONCURRENCY):
+        self.tile_fetcher = tile_fetcher
+        self.decoded = LRUCache(cache_size) if cache_size else None
+        self.on_lookup = on_lookup
+        self.max_fetch_concurrency = max_fetch_concurrency
+
+    def _fetch_missing_as_none(self, tileset, tile):
+        # points in a missing tile have no elevation, rather than failing
+        # the whole batch
+        try:
+            return self.tile_fetcher(tileset, tile)
+        except MissingTileException:
+            return FetchResult(None, tile)
+
+    def _lookup(self, tiles, timing_fetch, tracer):
+        """The cached grids by tile, and the fetched ImageInputs of the rest"""
+        grids = {}
+        to_fetch = []
+        for tile in tiles:
+            grid = None
+            if self.decoded is not None:
+                grid = self.decoded.get(tile)
+                if self.on_lookup is not None:
+                    self.on_lookup(grid is not None)
+            if grid is None:
+                to_fetch.append(TileCoordinates(tile, None))
+            else:
+                grids[tile] = grid
+        image_inputs = []
+        if to_fetch:
+            image_inputs = fetch_tiles_multi_threaded(
+                self._fetch_missing_as_none, SOURCE_TILESET, to_fetch,
+                timing_fetch, tracer, self.max_fetch_concurrency)
+        return grids, image_inputs
+
+    def sample(self, plan, tracer=NULL_TRACER):
+        """
+        The float32 elevations of the planned points, in meters
+
+        Returns the elevations, NaN for the points in missing tiles, and
+        the timing metadata, with the fetch and process stages of
+        process_tile. The process stage decodes and samples the tiles.
+        """
+        import numpy
+        timing_metadata = dict(fetch={}, process={})
+        grids, image_inputs = self._lookup(
+            plan.tiles, timing_metadata['fetch'], tracer)
+
+        with time_block(timing_metadata['process'], 'total'), \
+                tracer.span('process'):
+            for image_input in image_inputs:
+                grid = decode_elevations(image_input.image_bytes)
+                grid.flags.writeable = False
+                grids[image_input.tile] = grid
+                if self.decoded is not None:
+                    self.decoded.put(image_input.tile, grid)
+
+            values = numpy.empty(len(plan.tile_indexes), numpy.float32)
+            # the points of each tile are gathered at once
+            order = numpy.argsort(plan.tile_indexes, kind='stable')
+            bounds = numpy.searchsorted(
+                plan.tile_indexes[order], numpy.arange(len(plan.tiles) + 1))
+            for i, tile in enumerate(plan.tiles):
+                indexes = order[bounds[i]:bounds[i + 1]]
+                values[indexes] = grids[tile][
+                    plan.rows[indexes], plan.cols[indexes]]
+            values = values.reshape(plan.corners, -1)
+            if plan.weights is None:
+                elevations = values[0]
+            else:
+                elevations = (values * plan.weights).sum(axis=0).astype(
+                    numpy.float32)
+        return elevations, timing_metadata
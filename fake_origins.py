@@ -0,0 +1,263 @@
+"""
+Local stand-ins for the tile origins
+
+FakeS3Client can be given to S3TileFetcher and S3OutputStore in place of
+a boto3 client, and FakeHttpOrigin serves tiles over http on localhost for
+HttpTileFetcher. Both serve synthetic terrarium tiles and can inject
+latency, errors and missing tiles, so that the whole stack can be
+exercised without AWS.
+"""
+
+import hashlib
+import math
+import random
+import re
+import threading
+import time
+from io import BytesIO
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from PIL import Image
+
+
+TILE_KEY_RE = re.compile(r'(?P<tileset>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/'
+                         r'(?P<y>\d+)\.png$')
+
+
+class LatencyModel(object):
+    """
+    Latency and failure injection for a fake origin
+
+    distribution is one of:
+      constant:<ms>
+      uniform:<min ms>:<max ms>
+      lognormal:<median ms>:<sigma>
+    error_rate and missing_rate are the fractions of requests that fail
+    with a server error or a missing tile respectively.
+    """
+
+    OK = 'ok'
+    ERROR = 'error'
+    MISSING = 'missing'
+
+    def __init__(self, distribution='constant:0', error_rate=0.0,
+                 missing_rate=0.0, seed=None):
+        parts = distribution.split(':')
+        self.kind = parts[0]
+        self.params = [float(p) for p in parts[1:]]
+        assert self.kind in ('constant', 'uniform', 'lognormal'), \
+            'Unknown latency distribution: %s' % self.kind
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        """Return the (delay in seconds, outcome) for a single request"""
+        with self.lock:
+            if self.kind == 'constant':
+                delay_ms = self.params[0]
+            elif self.kind == 'uniform':
+                delay_ms = self.random.uniform(*self.params)
+            else:
+                median_ms, sigma = self.params
+                delay_ms = self.random.lognormvariate(
+                    math.log(median_ms), sigma)
+            roll = self.random.random()
+        if roll < self.error_rate:
+            outcome = self.ERROR
+        elif roll < self.error_rate + self.missing_rate:
+            outcome = self.MISSING
+        else:
+            outcome = self.OK
+        return delay_ms / 1000.0, outcome
+
+
+class SyntheticTileSource(object):
+    """
+    Serve a handful of pre-encoded terrarium tiles
+
+    Tiles are assigned one of the variants by their coordinate, so that
+    decoding them costs as much as real tiles, without paying for
+    generating a new image for every coordinate.
+    """
+
+    def __init__(self, num_variants=8):
+        self.variants = []
+        for i in range(num_variants):
+            image = Image.new('RGB', (256, 256))
+            base = 128 + i
+            image.putdata([
+                (base, (x * 3 + y * i) % 256, (x * y) % 256)
+                for y in range(256) for x in range(256)
+            ])
+            fp = BytesIO()
+            image.save(fp, format='PNG')
+            self.variants.append(fp.getvalue())
+
+    def __call__(self, tileset, z, x, y):
+        index = (z * 31 + x * 17 + y) % len(self.variants)
+        return self.variants[index]
+
+
+def parse_tile_key(key):
+    match = TILE_KEY_RE.search(key)
+    if match is None:
+        return None
+    return (match.group('tileset'), int(match.group('z')),
+            int(match.group('x')), int(match.group('y')))
+
+
+class FakeS3Error(Exception):
+    """Mimics the botocore ClientError response attribute"""
+
+    def __init__(self, code, message=''):
+        super(FakeS3Error, self).__init__('%s: %s' % (code, message))
+        self.response = dict(Error=dict(Code=code, Message=message))
+
+
+class FakeS3Body(BytesIO):
+    pass
+
+
+def make_etag(data):
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+class FakeS3Client(object):
+    """
+    Enough of the boto3 s3 client interface for S3TileFetcher
+
+    Objects that are put are kept in memory, and served before the
+    synthetic tiles. The synthetic tiles are served from tile_buckets, or
+    from every bucket when it is None.
+    """
+
+    def __init__(self, tile_source=None, latency=None, tile_buckets=None):
+        self.tile_source = tile_source or SyntheticTileSource()
+        self.latency = latency or LatencyModel()
+        self.tile_buckets = tile_buckets
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.objects = {}
+
+    def _lookup(self, Bucket, Key):
+        with self.lock:
+            self.num_requests += 1
+            stored = self.objects.get((Bucket, Key))
+        delay, outcome = self.latency.sample()
+        time.sleep(delay)
+        if stored is not None:
+            return stored
+        parsed = parse_tile_key(Key)
+        if parsed is None or outcome == LatencyModel.MISSING or \
+                (self.tile_buckets is not None and
+                 Bucket not in self.tile_buckets):
+            raise FakeS3Error('NoSuchKey', Key)
+        if outcome == LatencyModel.ERROR:
+            raise FakeS3Error('InternalError', Key)
+        return self.tile_source(*parsed), {}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        image_bytes, metadata = self._lookup(Bucket, Key)
+        return dict(
+            Body=FakeS3Body(image_bytes),
+            ContentLength=len(image_bytes),
+            ETag=make_etag(image_bytes),
+            Metadata=metadata,
+        )
+
+    def head_object(self, Bucket, Key, **kwargs):
+        try:
+            image_bytes, metadata = self._lookup(Bucket, Key)
+        except FakeS3Error as e:
+            # head responses have no body, so botocore reports the status
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                raise FakeS3Error('404', Key)
+            raise
+        return dict(
+            ContentLength=len(image_bytes),
+            ETag=make_etag(image_bytes),
+            Metadata=metadata,
+        )
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        with self.lock:
+            self.num_requests += 1
+            self.objects[(Bucket, Key)] = (bytes(Body), dict(Metadata or {}))
+        return dict(ETag=make_etag(Body))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeHttpOrigin(object):
+    """A local http server serving tiles at <url_prefix>/<tileset>/z/x/y.png"""
+
+    def __init__(self, tile_source=None, latency=None, port=0):
+        self.tile_source = tile_source or SyntheticTileSource()
+        self.latency = latency or LatencyModel()
+        origin = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                delay, outcome = origin.latency.sample()
+                time.sleep(delay)
+                parsed = parse_tile_key(self.path)
+                if parsed is None or outcome == LatencyModel.MISSING:
+                    self.send_error(404)
+                    return
+                if outcome == LatencyModel.ERROR:
+                    self.send_error(503)
+                    return
+                image_bytes = origin.tile_source(*parsed)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(image_bytes)))
+                self.end_headers()
+                self.wfile.write(image_bytes)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url_prefix(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+
+if __name__ == '__main__':
+    # serve tiles for local instances of the app, eg a fleet of peers, with
+    # TILES_FETCH_METHOD=http TILES_HTTP_PREFIX=http://127.0.0.1:<port>
+    import argparse
+    parser = argparse.ArgumentParser(description='Serve synthetic tiles')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', default='constant:20',
+                        help='eg constant:20 or lognormal:20:0.5, in ms')
+    args = parser.parse_args()
+    origin = FakeHttpOrigin(latency=LatencyModel(args.latency), port=args.port)
+    print('Serving tiles at %s' % origin.url_prefix)
+    origin.server.serve_forever()
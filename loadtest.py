@@ -0,0 +1,323 @@
+"""
+End to end load test against stand-in tile origins
+
+Replays panning and zooming sessions against the flask app from
+create_app, with the source tiles served by the fake origins in
+fake_origins.py: a fake s3 client behind S3TileFetcher, or a local http
+server behind HttpTileFetcher. Each (fetch method, tilesize) combination
+runs in its own process, and reports the throughput, latency percentiles
+and peak memory:
+
+    python loadtest.py --backends s3 http --tilesizes 256 512 \\
+        --latency lognormal:20:0.5 --concurrency 8 --duration 10
+
+A file of request paths (eg taken from access logs) can be replayed
+instead of the generated sessions with --trace-file.
+
+--output-caches compares the throughput of the hits of the output
+caches instead: the tiles of a session are rendered into the in-memory
+cache or the disk cache first, and only they are requested:
+
+    python loadtest.py --backends s3 --tilesizes 516 \\
+        --output-caches memory disk --duration 10
+
+Through the flask test client, the disk cache hits are read in python,
+as they would be by a server without a wsgi.file_wrapper. Under gunicorn
+they are sent with sendfile instead, which this leaves out.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from queue import Empty
+
+
+VIEWPORT = (4, 3)
+
+
+def pan_zoom_session(rng, tilesize, num_steps, min_zoom=3, max_zoom=None):
+    """
+    Generate the tile paths requested by one map client
+
+    The client shows a VIEWPORT of tiles and then pans by a tile or zooms
+    in or out, requesting only the tiles that came into view, as a client
+    with its own tile cache would.
+    """
+    from zaloa import max_zoom_for_tilesize
+    max_zoom = max_zoom or max_zoom_for_tilesize(tilesize)
+    z = rng.randint(min_zoom, max_zoom - 2)
+    cx = rng.randrange(2 ** z)
+    cy = rng.randrange(2 ** z)
+    shown = set()
+    paths = []
+    for step in range(num_steps):
+        if step > 0:
+            roll = rng.random()
+            if roll < 0.7:
+                dx, dy = rng.choice(((1, 0), (-1, 0), (0, 1), (0, -1)))
+                cx = (cx + dx) % (2 ** z)
+                cy = min(max(cy + dy, 0), 2 ** z - 1)
+            elif roll < 0.85 and z < max_zoom:
+                z, cx, cy = z + 1, cx * 2, cy * 2
+            elif z > min_zoom:
+                z, cx, cy = z - 1, cx // 2, cy // 2
+        width, height = VIEWPORT
+        visible = set()
+        for dy in range(-(height // 2), height - height // 2):
+            y = cy + dy
+            if y < 0 or y >= 2 ** z:
+                continue
+            for dx in range(-(width // 2), width - width // 2):
+                visible.add((z, (cx + dx) % (2 ** z), y))
+        for z_, x, y in sorted(visible - shown):
+            paths.append('/tilezen/terrain/v1/%d/terrarium/%d/%d/%d.png' % (
+                tilesize, z_, x, y))
+        shown = visible
+    return paths
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def output_cache_config(output_cache):
+    if output_cache == 'memory':
+        return dict(CACHE_TYPE='simple', CACHE_THRESHOLD=100000)
+    elif output_cache == 'disk':
+        return dict(DISK_CACHE_DIR=tempfile.mkdtemp(prefix='zaloa-loadtest'))
+    return {}
+
+
+def make_app(backend, latency_args, output_cache=None):
+    from fake_origins import (
+        FakeHttpOrigin,
+        FakeS3Client,
+        LatencyModel,
+    )
+    from server import create_app
+    from zaloa import S3TileFetcher
+
+    latency = LatencyModel(*latency_args)
+    config = output_cache_config(output_cache)
+    if backend == 's3':
+        fetcher = S3TileFetcher(FakeS3Client(latency=latency), 'fake-bucket')
+        config.update(TILES_FETCH_METHOD='s3')
+        app = create_app(config, tile_fetcher=fetcher)
+        origin = None
+    else:
+        origin = FakeHttpOrigin(latency=latency).start()
+        config.update(
+            TILES_FETCH_METHOD='http',
+            TILES_HTTP_PREFIX=origin.url_prefix,
+        )
+        app = create_app(config)
+    return app, origin
+
+
+def run_load(backend, tilesize, latency_args, concurrency, duration, seed,
+             trace_paths=None, output_cache=None):
+    """Run one load test configuration in this process, return the stats"""
+    import logging
+    app, origin = make_app(backend, latency_args, output_cache)
+    # the fake origins raise errors on purpose, don't log the tracebacks
+    app.logger.disabled = True
+    logging.getLogger('werkzeug').disabled = True
+
+    if output_cache is not None:
+        # only the hits are timed
+        trace_paths = trace_paths or list(OrderedDict.fromkeys(
+            pan_zoom_session(random.Random(seed), tilesize, 20)))
+        client = app.test_client()
+        for path in trace_paths:
+            client.get(path).get_data()
+
+    lock = threading.Lock()
+    latencies = []
+    statuses = {}
+    deadline = time.time() + duration
+
+    def worker(worker_id):
+        client = app.test_client()
+        rng = random.Random(seed * 1000 + worker_id)
+        paths = []
+        i = 0
+        while time.time() < deadline:
+            if i >= len(paths):
+                if trace_paths:
+                    paths = trace_paths[worker_id::concurrency]
+                else:
+                    paths = pan_zoom_session(rng, tilesize, 20)
+                i = 0
+                if not paths:
+                    return
+            start = time.perf_counter()
+            resp = client.get(paths[i])
+            elapsed = time.perf_counter() - start
+            i += 1
+            with lock:
+                latencies.append(elapsed)
+                statuses[resp.status_code] = \
+                    statuses.get(resp.status_code, 0) + 1
+
+    started = time.time()
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+    if origin is not None:
+        origin.stop()
+    disk_cache_dir = app.config.get('DISK_CACHE_DIR')
+    if output_cache == 'disk' and disk_cache_dir:
+        shutil.rmtree(disk_cache_dir, ignore_errors=True)
+
+    latencies.sort()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on linux, bytes on macos
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return dict(
+        backend=backend,
+        output_cache=output_cache,
+        tilesize=tilesize,
+        requests=len(latencies),
+        statuses=dict((str(k), v) for k, v in statuses.items()),
+        rps=len(latencies) / elapsed,
+        p50=percentile(latencies, 50),
+        p90=percentile(latencies, 90),
+        p99=percentile(latencies, 99),
+        max=latencies[-1] if latencies else None,
+        peak_rss=peak_rss,
+    )
+
+
+def _run_in_child(queue, args):
+    queue.put(run_load(*args))
+
+
+def run_isolated(*args, **kwargs):
+    """
+    Run a configuration in a fresh process, so peak memory is its own
+
+    Raises RuntimeError when the process exits without a result, eg when
+    the app fails to start in it, rather than waiting for it forever.
+    """
+    poll_interval = kwargs.pop('poll_interval', 1.0)
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_run_in_child, args=(queue, args))
+    process.start()
+    result = None
+    while result is None:
+        # a result put before the process exited is still read
+        exited = process.exitcode is not None
+        try:
+            result = queue.get(timeout=poll_interval)
+        except Empty:
+            if exited:
+                break
+    process.join()
+    if result is None or process.exitcode != 0:
+        raise RuntimeError('The load test of %s/%s exited with %s' % (
+            args[0], args[1] or 'mixed', process.exitcode))
+    return result
+
+
+def format_results(results):
+    row_format = '%-10s %5s %8d %8.1f %9.1f %9.1f %9.1f %10.1f  %s'
+    lines = ['%-10s %5s %8s %8s %9s %9s %9s %10s  %s' % (
+        'fetch', 'size', 'requests', 'rps', 'p50 ms', 'p90 ms', 'p99 ms',
+        'peak MB', 'statuses')]
+    for result in results:
+        backend = result['backend']
+        if result.get('output_cache'):
+            backend += '+' + result['output_cache']
+        lines.append(row_format % (
+            backend, result['tilesize'] or 'mixed',
+            result['requests'],
+            result['rps'], (result['p50'] or 0) * 1000.0,
+            (result['p90'] or 0) * 1000.0, (result['p99'] or 0) * 1000.0,
+            result['peak_rss'] / 1024.0 / 1024.0,
+            ' '.join('%s:%d' % item for item in
+                     sorted(result['statuses'].items()))))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test the tile server against fake origins')
+    parser.add_argument('--backends', nargs='+', default=['s3', 'http'],
+                        choices=['s3', 'http'])
+    parser.add_argument('--tilesizes', nargs='+', type=int,
+                        default=[256, 260, 512, 516])
+    parser.add_argument('--latency', default='lognormal:20:0.5',
+                        help='origin latency distribution, eg constant:10, '
+                             'uniform:5:50 or lognormal:<median>:<sigma>')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--missing-rate', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds per configuration')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-file',
+                        help='replay these request paths, one per line')
+    parser.add_argument('--output-caches', nargs='+',
+                        choices=['memory', 'disk'],
+                        help='time the hits of these output caches instead')
+    parser.add_argument('--output', help='also write the results as json')
+    args = parser.parse_args(argv)
+
+    trace_paths = None
+    if args.trace_file:
+        with open(args.trace_file) as fp:
+            trace_paths = [line.strip() for line in fp if line.strip()]
+
+    latency_args = (args.latency, args.error_rate, args.missing_rate,
+                    args.seed)
+    results = []
+    failures = []
+    for backend in args.backends:
+        for tilesize in args.tilesizes:
+            paths = trace_paths
+            if paths is not None:
+                # the tilesize is part of the path in the replayed trace
+                if tilesize != args.tilesizes[0]:
+                    continue
+                tilesize = None
+            for output_cache in args.output_caches or [None]:
+                try:
+                    results.append(run_isolated(
+                        backend, tilesize, latency_args, args.concurrency,
+                        args.duration, args.seed, paths, output_cache))
+                except RuntimeError as e:
+                    # the traceback was printed by the process
+                    print(e, file=sys.stderr)
+                    failures.append(str(e))
+                    continue
+                print(format_results(results[-1:]).splitlines()[-1])
+
+    print()
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""
+Process local metrics, exposed in the prometheus text format
+
+This is intentionally tiny: counters, gauges and histograms with labels,
+all guarded by a lock so they can be updated from the fetch threads.
+"""
+
+import threading
+import time
+
+
+# buckets in seconds, covering a single fast cache hit up to a slow
+# multi tile render
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry(object):
+    """Collection of metrics that get rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register a callable invoked just before rendering"""
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        labels = tuple(labels)
+        assert len(labels) == len(self.labelnames)
+        return labels
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.metric_type),
+        ]
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            lines.extend(self.render_sample(labels, value))
+        return lines
+
+    def render_sample(self, labels, value):
+        return ['%s%s %s' % (
+            self.name, _format_labels(self.labelnames, labels),
+            _format_value(value))]
+
+
+class Counter(Metric):
+
+    metric_type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, labels=()):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+
+    metric_type = 'gauge'
+
+    def inc(self, labels=(), amount=1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def get(self, labels=()):
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super(Histogram, self).__init__(
+            name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, labels=()):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            bucket_counts = state[0]
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render_sample(self, labels, state):
+        bucket_counts, total, count = state
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket%s %d' % (
+                self.name,
+                _format_labels(self.labelnames, labels,
+                               [('le', _format_value(upper_bound))]),
+                cumulative))
+        label_str = _format_labels(self.labelnames, labels)
+        lines.append('%s_sum%s %s' % (
+            self.name, label_str, _format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, label_str, count))
+        return lines
+
+
+STAGE_DURATION = Histogram(
+    'zaloa_stage_duration_seconds',
+    'Time spent in each stage of rendering a tile',
+    ('stage', 'tileset', 'tilesize', 'backend'),
+)
+SOURCE_FETCH_DURATION = Histogram(
+    'zaloa_source_fetch_duration_seconds',
+    'Time spent fetching a single source tile',
+    ('tileset', 'backend'),
+)
+SOURCE_FETCHES_IN_FLIGHT = Gauge(
+    'zaloa_source_fetches_in_flight',
+    'Number of source tile fetches currently in progress',
+    ('backend',),
+)
+SOURCE_FETCH_ERRORS = Counter(
+    'zaloa_source_fetch_errors_total',
+    'Source tile fetches that failed, by exception type',
+    ('backend', 'type'),
+)
+REQUEST_ERRORS = Counter(
+    'zaloa_request_errors_total',
+    'Tile requests that failed, by exception type',
+    ('tileset', 'tilesize', 'type'),
+)
+CACHE_REQUESTS = Counter(
+    'zaloa_cache_requests_total',
+    'Cache lookups, by cache and result (hit or miss)',
+    ('cache', 'result'),
+)
+CANVAS_POOL_EVENTS = Counter(
+    'zaloa_canvas_pool_events_total',
+    'Output canvases created, reused, returned to or discarded by the pool',
+    ('event',),
+)
+
+PREFETCH_EVENTS = Counter(
+    'zaloa_prefetch_events_total',
+    'Source tiles queued, dropped, fetched, failed or used by the prefetch',
+    ('event',),
+)
+
+OUTPUT_STORE_EVENTS = Counter(
+    'zaloa_output_store_events_total',
+    'Stale tiles found in, and tiles written, dropped or failed to be read '
+    'or written by the output store',
+    ('event',),
+)
+
+REVALIDATION_EVENTS = Counter(
+    'zaloa_revalidation_events_total',
+    'Background revalidations of stale output tiles, by event or outcome',
+    ('event',),
+)
+
+DISK_CACHE_EVENTS = Counter(
+    'zaloa_disk_cache_events_total',
+    'Tiles written to, failed to be written to, evicted from, or found '
+    'expired or stale in the disk cache',
+    ('event',),
+)
+
+PEER_EVENTS = Counter(
+    'zaloa_peer_events_total',
+    'Source tiles fetched locally, from their owner peer, or from the origin '
+    'after the owner failed, served to peers, and coalesced fetches',
+    ('event',),
+)
+
+CACHE_HIT_RATIO = Gauge(
+    'zaloa_cache_hit_ratio',
+    'Fraction of cache lookups that were hits since the process started',
+    ('cache',),
+)
+
+
+def record_cache_lookup(cache_name, hit):
+    CACHE_REQUESTS.inc((cache_name, 'hit' if hit else 'miss'))
+
+
+def _update_cache_hit_ratios():
+    with CACHE_REQUESTS.lock:
+        counts = dict(CACHE_REQUESTS.values)
+    cache_names = set(cache_name for cache_name, result in counts)
+    for cache_name in cache_names:
+        hits = counts.get((cache_name, 'hit'), 0)
+        misses = counts.get((cache_name, 'miss'), 0)
+        CACHE_HIT_RATIO.set(float(hits) / (hits + misses), (cache_name,))
+
+
+REGISTRY.add_collector(_update_cache_hit_ratios)
+
+
+def record_canvas_pool_event(event):
+    CANVAS_POOL_EVENTS.inc((event,))
+
+
+def record_prefetch_event(event):
+    PREFETCH_EVENTS.inc((event,))
+
+
+def record_output_store_event(event):
+    OUTPUT_STORE_EVENTS.inc((event,))
+
+
+def record_revalidation_event(event):
+    REVALIDATION_EVENTS.inc((event,))
+
+
+def record_disk_cache_event(event):
+    DISK_CACHE_EVENTS.inc((event,))
+
+
+def record_peer_event(event):
+    PEER_EVENTS.inc((event,))
+
+
+def timing_stages(timing_metadata):
+    """Pull the top level stage durations out of the process_tile timing"""
+    stages = []
+    for stage in ('coords-gen', 'fetch', 'process', 'save'):
+        value = timing_metadata.get(stage)
+        if isinstance(value, dict):
+            value = value.get('total')
+        if value is not None:
+            stages.append((stage, value))
+    return stages
+
+
+def format_server_timing(timing_metadata, extra_stages=()):
+    """Format the process_tile timing as a Server-Timing header value"""
+    stages = timing_stages(timing_metadata) + list(extra_stages)
+    return ', '.join(
+        '%s;dur=%.3f' % (stage, duration * 1000.0)
+        for stage, duration in stages)
+
+
+def observe_timing(timing_metadata, tileset, tilesize, backend):
+    for stage, duration in timing_stages(timing_metadata):
+        STAGE_DURATION.observe(
+            duration, (stage, tileset, tilesize, backend))
+
+
+class InstrumentedTileFetcher(object):
+    """Wrap a tile fetcher to track fetch durations, concurrency and errors"""
+
+    def __init__(self, tile_fetcher, backend):
+        self.tile_fetcher = tile_fetcher
+        self.backend = backend
+
+    def __call__(self, tileset, tile):
+        SOURCE_FETCHES_IN_FLIGHT.inc((self.backend,))
+        start = time.perf_counter()
+        try:
+            return self.tile_fetcher(tileset, tile)
+        except Exception as e:
+            SOURCE_FETCH_ERRORS.inc((self.backend, type(e).__name__))
+            raise
+        finally:
+            SOURCE_FETCH_DURATION.observe(
+                time.perf_counter() - start, (tileset, self.backend))
+            SOURCE_FETCHES_IN_FLIGHT.dec((self.backend,))
+
+
+class AsyncInstrumentedTileFetcher(InstrumentedTileFetcher):
+    """InstrumentedTileFetcher for coroutine tile fetchers"""
+
+    async def __call__(self, tileset, tile):
+        SOURCE_FETCHES_IN_FLIGHT.inc((self.backend,))
+        start = time.perf_counter()
+        try:
+            return await self.tile_fetcher(tileset, tile)
+        except Exception as e:
+            SOURCE_FETCH_ERRORS.inc((self.backend, type(e).__name__))
+            raise
+        finally:
+            SOURCE_FETCH_DURATION.observe(
+                time.perf_counter() - start, (tileset, self.backend))
+            SOURCE_FETCHES_IN_FLIGHT.dec((self.backend,))
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
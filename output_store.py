@@ -0,0 +1,262 @@
+"""
+Write-through store of rendered tiles
+
+On Lambda every warm container renders the popular tiles again. With an
+output store, which all the containers share, a request that misses the
+in-process caches looks for the tile in the store, and only renders it
+when it is not there. The rendered tile is then written to the store in
+the background, so the request does not wait for the write.
+
+The etags of the source tiles that a tile was rendered from are stored
+with it. A stored tile is stale when one of its sources that the process
+has fetched since has another etag, and is rendered again.
+"""
+
+import logging
+import os
+import queue
+import tempfile
+import threading
+from collections import namedtuple
+
+
+logger = logging.getLogger('zaloa.output_store')
+
+
+# image_bytes is None when only the metadata was read
+StoredTile = namedtuple('StoredTile', 'image_bytes source_etags')
+# returned in place of the image bytes to send the client to the store
+StoreRedirect = namedtuple('StoreRedirect', 'url')
+
+SOURCE_ETAGS_METADATA = 'source-etags'
+# the s3 user metadata is limited to 2KB and a 1028 tile has 36 sources,
+# so only enough of each etag to tell the versions apart is kept
+ETAG_LENGTH = 16
+
+
+def output_key(tilesize, tileset, tile, output_format):
+    return '%s/%s/%s.%s' % (tilesize, tileset, tile, output_format)
+
+
+def short_etag(etag):
+    return etag.strip('"')[:ETAG_LENGTH]
+
+
+def format_source_etags(source_etags):
+    """Serialize a mapping of source tile paths to etags"""
+    return ' '.join(
+        '%s=%s' % (tile_path, short_etag(etag))
+        for tile_path, etag in sorted(source_etags.items()) if etag)
+
+
+def parse_source_etags(value):
+    source_etags = {}
+    for entry in (value or '').split():
+        tile_path, _, etag = entry.partition('=')
+        source_etags[tile_path] = etag
+    return source_etags
+
+
+def is_stale(stored_etags, current_etags):
+    """
+    Whether any source changed since the tile was stored
+
+    current_etags are those of the sources known now, which need not be
+    all of them. Sources without an etag on either side are not compared.
+    """
+    for tile_path, etag in current_etags.items():
+        stored_etag = stored_etags.get(tile_path)
+        if stored_etag and etag and stored_etag != short_etag(etag):
+            return True
+    return False
+
+
+def same_sources(stored_etags, current_etags):
+    """Whether all the sources are known to be unchanged"""
+    if not stored_etags or set(stored_etags) != set(current_etags):
+        return False
+    return all(
+        stored_etags[tile_path] and etag and
+        short_etag(stored_etags[tile_path]) == short_etag(etag)
+        for tile_path, etag in current_etags.items())
+
+
+class SourceEtagRecorder(object):
+    """Wrap a tile fetcher to record the etags of the sources it fetched"""
+
+    def __init__(self, tile_fetcher):
+        self.tile_fetcher = tile_fetcher
+        self.etags = {}
+
+    def __call__(self, tileset, tile):
+        fetch_result = self.tile_fetcher(tileset, tile)
+        self.etags[str(tile)] = fetch_result.etag
+        return fetch_result
+
+
+def is_missing_object_error(e):
+    try:
+        err_code = e.response.get('Error', {}).get('Code')
+    except Exception:
+        err_code = None
+    # head requests have no body to carry the NoSuchKey code
+    return err_code in ('NoSuchKey', '404', 'NotFound')
+
+
+class S3OutputStore(object):
+    """Store the rendered tiles in an s3 bucket, under prefix"""
+
+    def __init__(self, s3_client, bucket, prefix=''):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            resp = self.s3_client.get_object(
+                Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if is_missing_object_error(e):
+                return None
+            raise
+        body_file = resp['Body']
+        image_bytes = body_file.read()
+        body_file.close()
+        return StoredTile(image_bytes, parse_source_etags(
+            resp.get('Metadata', {}).get(SOURCE_ETAGS_METADATA)))
+
+    def head(self, key):
+        try:
+            resp = self.s3_client.head_object(
+                Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as e:
+            if is_missing_object_error(e):
+                return None
+            raise
+        return StoredTile(None, parse_source_etags(
+            resp.get('Metadata', {}).get(SOURCE_ETAGS_METADATA)))
+
+    def put(self, key, image_bytes, source_etags, content_type):
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Body=image_bytes,
+            ContentType=content_type,
+            Metadata={
+                SOURCE_ETAGS_METADATA: format_source_etags(source_etags),
+            },
+        )
+
+
+class LocalOutputStore(object):
+    """
+    Store the rendered tiles in a directory
+
+    The source etags of each tile are kept next to it, with an .etags
+    suffix. The files are written under temporary names and renamed into
+    place, so partially written tiles are never read.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    def _read_etags(self, path):
+        try:
+            with open(path + '.etags') as fp:
+                return parse_source_etags(fp.read())
+        except FileNotFoundError:
+            return {}
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fp:
+                image_bytes = fp.read()
+        except FileNotFoundError:
+            return None
+        return StoredTile(image_bytes, self._read_etags(path))
+
+    def head(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        return StoredTile(None, self._read_etags(path))
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def put(self, key, image_bytes, source_etags, content_type):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._write(path + '.etags',
+                    format_source_etags(source_etags).encode('ascii'))
+        self._write(path, image_bytes)
+
+
+class OutputStoreWriter(object):
+    """
+    Write the rendered tiles to an output store in the background
+
+    At most queue_size tiles wait to be written, and the tiles beyond
+    that are dropped, since they are rendered and written again on a
+    later miss. on_event, if set, is called with each of 'written',
+    'dropped' and 'failed'.
+    """
+
+    def __init__(self, output_store, queue_size=256, on_event=None):
+        self.output_store = output_store
+        self.queue = queue.Queue(queue_size)
+        self.on_event = on_event
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _record(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def put(self, key, image_bytes, source_etags, content_type):
+        try:
+            self.queue.put_nowait(
+                (key, image_bytes, source_etags, content_type))
+        except queue.Full:
+            self._record('dropped')
+
+    def flush(self):
+        """Wait until the queued tiles have been written"""
+        self.queue.join()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                key, image_bytes, source_etags, content_type = \
+                    self.queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                self.output_store.put(
+                    key, image_bytes, source_etags, content_type)
+                self._record('written')
+            except Exception:
+                logger.exception('Failed to write %s to the output store', key)
+                self._record('failed')
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,168 @@
+"""
+Source tile cache fill across a fleet of instances
+
+Behind a load balancer every instance fetches, and caches, the same hot
+source tiles. With peers, each (tileset, tile) source is owned by one of
+the instances, chosen by consistent hashing of its key. The other
+instances ask the owner for it over http before going to the origin, and
+the owner fetches it from the origin once, however many of its peers
+and requests ask at the same time, and caches it.
+
+An instance that cannot reach the owner fetches the tile from the origin
+itself, so a peer going away only costs the fleet its share of the cache,
+and adding one only moves the keys it takes over.
+"""
+
+import bisect
+import hashlib
+import logging
+import threading
+
+from zaloa import (
+    FetchResult,
+    make_http_url,
+    make_s3_key,
+    MissingTileException,
+    OriginErrorException,
+)
+
+
+logger = logging.getLogger('zaloa.peers')
+
+
+# the route that the owners serve their source tiles to their peers on
+PEER_URL_PREFIX = '/peer/v1'
+# sent with the 404 for a tile that is missing from the origin, to tell it
+# apart from a peer that does not serve the route, eg during a deploy
+MISSING_TILE_HEADER = 'X-Zaloa-Missing-Tile'
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto nodes
+
+    Each node is placed on the ring at replicas points, so the keys are
+    spread evenly, and a key belongs to the node at the first point after
+    its hash. Every instance builds the same ring from the same nodes,
+    whatever order they are listed in.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        points = sorted(
+            (_hash('%s#%d' % (node, i)), node)
+            for node in set(nodes) for i in range(replicas))
+        self.hashes = [point_hash for point_hash, node in points]
+        self.nodes = [node for point_hash, node in points]
+
+    def owner(self, key):
+        if not self.nodes:
+            return None
+        i = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.nodes[i]
+
+
+class CoalescingTileFetcher(object):
+    """
+    Fetch each source tile once however many ask for it at the same time
+
+    The first caller for a (tileset, tile) fetches it, and the callers
+    that ask while that fetch is in flight wait for its result, or its
+    exception.
+    """
+
+    class _Call(object):
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.fetch_result = None
+            self.error = None
+
+    def __init__(self, tile_fetcher, on_event=None):
+        self.tile_fetcher = tile_fetcher
+        self.on_event = on_event
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def __call__(self, tileset, tile):
+        key = (tileset, tile)
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self._Call()
+        if not leader:
+            if self.on_event is not None:
+                self.on_event('coalesced')
+            call.done.wait()
+        else:
+            try:
+                call.fetch_result = self.tile_fetcher(tileset, tile)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.fetch_result
+
+
+class PeerTileFetcher(object):
+    """
+    Fetch the source tiles from the peers that own them
+
+    ring maps the source keys to the base urls of the peers, self_url
+    among them. The tiles this instance owns, and those whose owner
+    fails, are fetched with origin_fetcher. A missing tile is missing
+    from the origin for the owner too, so it is not fetched again.
+
+    on_event, if set, is called with each of 'local', 'peer' and
+    'fallback'.
+    """
+
+    def __init__(self, ring, self_url, origin_fetcher, http_client,
+                 timeout=1.0, on_event=None):
+        self.ring = ring
+        self.self_url = self_url
+        self.origin_fetcher = origin_fetcher
+        self.http_client = http_client
+        self.timeout = timeout
+        self.on_event = on_event
+
+    def _record(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def owner(self, tileset, tile):
+        return self.ring.owner(make_s3_key(tileset, tile))
+
+    def __call__(self, tileset, tile):
+        owner = self.owner(tileset, tile)
+        if owner is None or owner == self.self_url:
+            self._record('local')
+            return self.origin_fetcher(tileset, tile)
+        try:
+            fetch_result = self._fetch_from_peer(owner, tileset, tile)
+        except MissingTileException:
+            raise
+        except Exception:
+            logger.warning('Failed to fetch %s/%s from peer %s',
+                           tileset, tile, owner, exc_info=True)
+            self._record('fallback')
+            return self.origin_fetcher(tileset, tile)
+        self._record('peer')
+        return fetch_result
+
+    def _fetch_from_peer(self, owner, tileset, tile):
+        url = make_http_url(owner + PEER_URL_PREFIX, tileset, tile)
+        resp = self.http_client.get(url, timeout=self.timeout)
+        if resp.status_code == 404 and MISSING_TILE_HEADER in resp.headers:
+            raise MissingTileException(tile)
+        if resp.status_code != 200:
+            raise OriginErrorException(tile, resp.status_code)
+        return FetchResult(resp.content, tile, resp.headers.get('ETag'))
@@ -0,0 +1,164 @@
+"""
+Low zoom tiles pinned in memory
+
+Every client requests the tiles at the lowest zooms, and there are few
+enough of them to keep all the rendered outputs resident: zooms 0 to 6
+are 5461 tiles per tilesize and tileset. They are rendered in the
+background once the app is created, so that it starts serving straight
+away, rendering the tiles on request until they are pinned. They are
+re-rendered periodically so that changes to the source tiles are picked
+up.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from zaloa import (
+    make_render_plan,
+    max_zoom_for_tilesize,
+    process_tile,
+    Tile,
+    tileset_output_mode,
+)
+
+
+logger = logging.getLogger('zaloa.pinned')
+
+
+class PinnedPyramid(object):
+    """
+    Read-only store of rendered tiles
+
+    The encoded tiles are concatenated into a single buffer, and indexed
+    by (tilesize, tileset, z, x, y) to their offset and length, which
+    keeps the per tile overhead to a tuple. The tiles are returned as
+    memoryviews of the buffer, rather than copied out of it.
+    """
+
+    def __init__(self, max_zoom, data, index):
+        self.max_zoom = max_zoom
+        self.data = data
+        self.view = memoryview(data)
+        self.index = index
+
+    def covers(self, tile):
+        return tile.z <= self.max_zoom
+
+    def get(self, tilesize, tileset, tile):
+        location = self.index.get((tilesize, tileset, tile.z, tile.x, tile.y))
+        if location is None:
+            return None
+        offset, length = location
+        return self.view[offset:offset + length]
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def nbytes(self):
+        return len(self.data)
+
+
+def _render_pinned_tile(tile_fetcher, tilesize, tileset, tile,
+                        tileset_modes, derive_normals):
+    plan = make_render_plan(
+        tileset, tilesize, tile,
+        mode=tileset_output_mode(tileset_modes, tileset),
+        derive_normals=derive_normals)
+    try:
+        image_bytes, timing_metadata, tile_coords = process_tile(
+            plan.coords_generator, tile_fetcher, plan.image_reducer,
+            plan.source_tileset, tile)
+    except Exception:
+        logger.exception('Failed to render pinned tile %s/%s/%s',
+                         tilesize, tileset, tile)
+        return None
+    return image_bytes
+
+
+def build_pinned_pyramid(tile_fetcher, max_zoom, tilesizes, tilesets,
+                         tileset_modes=None, derive_normals=False,
+                         max_workers=8):
+    """
+    Render every tile up to max_zoom for the tilesizes and tilesets
+
+    tileset_modes and derive_normals are as for the requests. Tiles that
+    fail to render are left out, and get rendered on request as usual, as
+    are the zooms that a tilesize does not go up to.
+    """
+    keys = [
+        (tilesize, tileset, z, x, y)
+        for tilesize in tilesizes
+        for tileset in tilesets
+        for z in range(min(max_zoom, max_zoom_for_tilesize(tilesize)) + 1)
+        for x in range(2 ** z)
+        for y in range(2 ** z)
+    ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        outputs = list(executor.map(
+            lambda key: _render_pinned_tile(
+                tile_fetcher, key[0], key[1], Tile(*key[2:]),
+                tileset_modes, derive_normals),
+            keys))
+
+    data = bytearray()
+    index = {}
+    for key, image_bytes in zip(keys, outputs):
+        if image_bytes is None:
+            continue
+        index[key] = (len(data), len(image_bytes))
+        data.extend(image_bytes)
+    return PinnedPyramid(max_zoom, bytes(data), index)
+
+
+# covers no tiles, until the first build has finished
+EMPTY_PYRAMID = PinnedPyramid(-1, b'', {})
+
+
+class PinnedPyramidRefresher(object):
+    """
+    Keep a pinned pyramid, built in the background when started, and
+    rebuilt every refresh_interval seconds
+
+    The pyramid is empty until the first build has finished, and is then
+    replaced whole once each rebuild has finished, so the requests never
+    see a partially built one. built is set once there is a pyramid. A
+    refresh_interval of 0 builds it once only.
+    """
+
+    def __init__(self, build_pyramid, refresh_interval):
+        self.build_pyramid = build_pyramid
+        self.refresh_interval = refresh_interval
+        self.pyramid = EMPTY_PYRAMID
+        self.built = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def refresh(self):
+        start = time.perf_counter()
+        pyramid = self.build_pyramid()
+        self.pyramid = pyramid
+        self.built.set()
+        logger.info('Pinned %d tiles, %d bytes, in %.1fs',
+                    len(pyramid), pyramid.nbytes, time.perf_counter() - start)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Failed to build the pinned tiles')
+            if not self.refresh_interval or \
+                    self.stopped.wait(self.refresh_interval):
+                return
@@ -0,0 +1,323 @@
+"""
+Speculative prefetch of source tiles
+
+Map clients request tiles in spatially coherent bursts: panning by a
+tile, or zooming in or out around the same spot. After an output tile is
+rendered, the source tiles of the output tiles most likely to be asked
+for next are fetched into the source tile cache in the background, so
+those requests find them there.
+
+The prefetch only starts fetching while no request is being rendered, so
+it does not compete with the foreground fetches, and it is bounded by
+the number of source tiles queued per request and in total.
+"""
+
+import logging
+import threading
+from collections import Counter, deque
+
+from zaloa import is_tile_valid, LRUCache, max_zoom_for_tilesize, Tile
+
+
+logger = logging.getLogger('zaloa.prefetch')
+
+
+# the sizes that are requested for the same tile by clients that want the
+# buffered or unbuffered variant, eg 512 and 516 for the same map
+SIBLING_TILESIZES = {
+    256: 260, 260: 256,
+    512: 516, 516: 512,
+    1024: 1028, 1028: 1024,
+}
+
+PAN_MOVES = tuple(
+    (dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy)
+ZOOM_IN = 'in'
+ZOOM_OUT = 'out'
+# with no history, panning in any direction is the most likely
+PRIOR_MOVES = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+def tile_move(previous, tile):
+    """
+    The move from the previous tile to tile, or None
+
+    Only a pan to one of the 8 neighbors at the same zoom, or a zoom to
+    the parent or a child, are moves. Consecutive requests from different
+    clients are not, in all likelihood.
+    """
+    if previous is None:
+        return None
+    if tile.z == previous.z:
+        n = 2 ** tile.z
+        # wrap around the antimeridian, as the coordinate generators do
+        dx = (tile.x - previous.x + 1) % n - 1
+        dy = tile.y - previous.y
+        if (dx, dy) in PAN_MOVES:
+            return (dx, dy)
+    elif tile.z == previous.z + 1:
+        if (tile.x // 2, tile.y // 2) == (previous.x, previous.y):
+            return ZOOM_IN
+    elif tile.z == previous.z - 1:
+        if (previous.x // 2, previous.y // 2) == (tile.x, tile.y):
+            return ZOOM_OUT
+    return None
+
+
+def apply_move(tile, move):
+    """The tiles that a move from tile can land on"""
+    if move == ZOOM_IN:
+        if not is_tile_valid(tile.z + 1, 0, 0):
+            return []
+        return [Tile(tile.z + 1, tile.x * 2 + dx, tile.y * 2 + dy)
+                for dy in (0, 1) for dx in (0, 1)]
+    elif move == ZOOM_OUT:
+        return [Tile(tile.z - 1, tile.x // 2, tile.y // 2)]
+    dx, dy = move
+    x = (tile.x + dx) % (2 ** tile.z)
+    y = tile.y + dy
+    if not is_tile_valid(tile.z, x, y):
+        return []
+    return [Tile(tile.z, x, y)]
+
+
+class PanZoomModel(object):
+    """
+    Predict the next tiles from the recent moves between requests
+
+    The moves between consecutive requests to the process are counted
+    over the last history of them, so the prediction follows the current
+    traffic, eg mostly zooming in after a page load.
+    """
+
+    def __init__(self, history=256):
+        self.lock = threading.Lock()
+        self.moves = deque(maxlen=history)
+        self.last_tile = None
+
+    def observe(self, tile):
+        with self.lock:
+            move = tile_move(self.last_tile, tile)
+            if move is not None:
+                self.moves.append(move)
+            self.last_tile = tile
+
+    def ranked_moves(self):
+        with self.lock:
+            counts = Counter(self.moves)
+        for move in PRIOR_MOVES:
+            counts[move] += 1
+        return [move for move, count in counts.most_common()]
+
+    def predict(self, tile, max_tiles):
+        predicted = []
+        for move in self.ranked_moves():
+            for next_tile in apply_move(tile, move):
+                if len(predicted) >= max_tiles:
+                    return predicted
+                # at the lowest zooms some moves land on the same tile
+                if next_tile not in predicted and \
+                        is_tile_valid(next_tile.z, next_tile.x, next_tile.y):
+                    predicted.append(next_tile)
+        return predicted
+
+
+class NeighborPrefetcher(object):
+    """
+    Fetch the sources of the likely next tiles into the source cache
+
+    caching_fetcher is the CachingTileFetcher to fill. The prefetcher is
+    also the fetcher for the requests, to count the prefetched tiles that
+    they used; renders run inside foreground(), which holds the prefetch
+    off until they are done.
+
+    After each render, observe queues up to max_tiles source tiles that
+    are not cached yet: the sources of the same tile at its sibling
+    tilesize, then of the predicted tiles. At most queue_size tiles wait
+    to be fetched. The most recently queued are fetched first, since the
+    clients have moved on from the older ones, which are dropped to make
+    room. on_event, if set, is called with each of 'queued', 'dropped',
+    'fetched', 'failed' and 'used'; the hit rate is used over fetched.
+    """
+
+    def __init__(self, caching_fetcher, coords_generators, max_tiles=16,
+                 queue_size=256, model=None, on_event=None):
+        self.caching_fetcher = caching_fetcher
+        self.coords_generators = coords_generators
+        self.max_tiles = max_tiles
+        self.model = model or PanZoomModel()
+        self.on_event = on_event
+        self.lock = threading.Lock()
+        self.has_work = threading.Condition(self.lock)
+        self.queued = deque(maxlen=queue_size)
+        self.pending = set()
+        # the prefetched tiles, and whether no request used them yet
+        self.unused = LRUCache(caching_fetcher.cache.maxsize)
+        self.active = 0
+        self.idle = threading.Event()
+        self.idle.set()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def _record(self, event, count=1):
+        if self.on_event is not None:
+            for i in range(count):
+                self.on_event(event)
+
+    def __call__(self, tileset, tile):
+        key = (tileset, tile)
+        if self.unused.get(key):
+            self.unused.put(key, False)
+            self._record('used')
+        return self.caching_fetcher(tileset, tile)
+
+    def foreground(self):
+        return _foreground(self)
+
+    def _source_tiles(self, coords_generators, tilesize, tile):
+        coords_generator = coords_generators.get(tilesize)
+        # the predicted tiles can be beyond the zooms of the tilesize,
+        # whose sources do not exist
+        if coords_generator is None or \
+                tile.z > max_zoom_for_tilesize(tilesize):
+            return []
+        return [tile_coords.tile for tile_coords in coords_generator(tile)]
+
+    def observe(self, tilesize, tileset, tile, coords_generators=None):
+        """
+        Queue the likely next source tiles after tile was rendered
+
+        tileset is the source tileset, and coords_generators replace the
+        prefetcher's for the tiles planned with others, eg the derived
+        normals. Failing to queue them is only logged, so that the
+        prefetch never fails the request that observed the tile.
+        """
+        try:
+            self._observe(tilesize, tileset, tile,
+                          coords_generators or self.coords_generators)
+        except Exception:
+            logger.exception('Failed to prefetch after %s/%s/%s',
+                             tilesize, tileset, tile)
+
+    def _observe(self, tilesize, tileset, tile, coords_generators):
+        self.model.observe(tile)
+        source_tiles = self._source_tiles(
+            coords_generators, SIBLING_TILESIZES.get(tilesize), tile)
+        for next_tile in self.model.predict(tile, self.max_tiles):
+            source_tiles.extend(
+                self._source_tiles(coords_generators, tilesize, next_tile))
+
+        keys = []
+        num_dropped = 0
+        with self.has_work:
+            for source_tile in source_tiles:
+                if len(keys) >= self.max_tiles:
+                    break
+                key = (tileset, source_tile)
+                if key in self.pending or key in keys or \
+                        key in self.caching_fetcher.cache:
+                    continue
+                keys.append(key)
+            # queued in reverse, so that the most likely are taken first
+            for key in reversed(keys):
+                if len(self.queued) == self.queued.maxlen:
+                    self.pending.discard(self.queued.popleft())
+                    num_dropped += 1
+                self.queued.append(key)
+                self.pending.add(key)
+            self.has_work.notify()
+        self._record('queued', len(keys))
+        self._record('dropped', num_dropped)
+
+    def take(self):
+        """Remove and return the most recently queued tile, or None"""
+        with self.lock:
+            if not self.queued:
+                return None
+            key = self.queued.pop()
+            self.pending.discard(key)
+            return key
+
+    def start(self, num_workers=1):
+        for i in range(num_workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def prefetch(self, key):
+        if key in self.caching_fetcher.cache:
+            return
+        tileset, tile = key
+        try:
+            fetch_result = self.caching_fetcher.tile_fetcher(tileset, tile)
+        except Exception:
+            # eg missing tiles, which the requests will find out about
+            self._record('failed')
+            return
+        # put directly, so that the prefetch is not counted as a lookup
+        self.caching_fetcher.cache.put(key, fetch_result)
+        self.unused.put(key, True)
+        self._record('fetched')
+
+    def _run(self):
+        while not self.stopped.is_set():
+            with self.has_work:
+                if not self.queued:
+                    self.has_work.wait(1.0)
+            self.idle.wait()
+            key = self.take()
+            if key is None:
+                continue
+            try:
+                self.prefetch(key)
+            except Exception:
+                logger.exception('Failed to prefetch %s/%s', *key)
+
+
+class _foreground(object):
+
+    def __init__(self, prefetcher):
+        self.prefetcher = prefetcher
+
+    def __enter__(self):
+        with self.prefetcher.lock:
+            self.prefetcher.active += 1
+            self.prefetcher.idle.clear()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.prefetcher.lock:
+            self.prefetcher.active -= 1
+            if not self.prefetcher.active:
+                self.prefetcher.idle.set()
+        suppress_exception = False
+        return suppress_exception
+
+
+class _NullForeground(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        suppress_exception = False
+        return suppress_exception
+
+
+class NullPrefetcher(object):
+    """Prefetcher that prefetches nothing, used when it is disabled"""
+
+    _null_foreground = _NullForeground()
+
+    def foreground(self):
+        return self._null_foreground
+
+    def observe(self, tilesize, tileset, tile, coords_generators=None):
+        pass
+
+
+NULL_PREFETCHER = NullPrefetcher()
@@ -0,0 +1,158 @@
+"""
+On demand profiling of a single request
+
+A request is profiled when it carries the profile header with the
+configured token, or when it is picked by the profile sample rate. The
+request thread runs under cProfile, and tracemalloc records the peak
+memory allocated while it ran. cProfile only sees the request thread, so
+the source fetches, which run on a thread pool, only show as the time
+the request waited for them. A profiled png is not streamed, so its
+encode is in the profile. Note that tracemalloc only sees memory
+allocated through python, eg the encoded tile bytes, and not the pixel
+buffers that Pillow allocates for itself.
+
+tracemalloc is process wide, so only one request is profiled at a time;
+other requests that ask for a profile while one is running go through
+unprofiled rather than waiting.
+"""
+
+import cProfile
+import hmac
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+
+logger = logging.getLogger('zaloa.profiling')
+
+
+PROFILE_HEADER = 'X-Zaloa-Profile'
+
+_profile_lock = threading.Lock()
+
+
+def _format_function(key):
+    filename, lineno, funcname = key
+    if filename == '~':
+        # builtins, eg <method 'decode' of 'ImagingDecoder' objects>
+        return funcname
+    return '%s:%d(%s)' % (os.path.basename(filename), lineno, funcname)
+
+
+class RequestProfiler(object):
+    """
+    Profile the enclosed block with cProfile and tracemalloc
+
+    The peak memory is that of the whole process while the block ran, so
+    it includes what the concurrent requests allocated meanwhile. When
+    the profilers fail to start, eg because another profiler is active,
+    the block runs unprofiled.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.enabled = False
+        self.started_tracemalloc = False
+        self.peak_memory = None
+        self.duration = None
+        self._start = None
+
+    def __enter__(self):
+        # skip profiling if another request is already being profiled
+        self.enabled = _profile_lock.acquire(False)
+        if not self.enabled:
+            return self
+        self.started_tracemalloc = not tracemalloc.is_tracing()
+        try:
+            if self.started_tracemalloc:
+                tracemalloc.start()
+            self._baseline_memory = tracemalloc.get_traced_memory()[0]
+            self._start = time.perf_counter()
+            self.profile.enable()
+        except Exception:
+            logger.exception('Failed to start profiling')
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+            self.enabled = False
+            _profile_lock.release()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.enabled:
+            return False
+        self.profile.disable()
+        self.duration = time.perf_counter() - self._start
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak_memory = peak - self._baseline_memory
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        _profile_lock.release()
+        suppress_exception = False
+        return suppress_exception
+
+    def top_functions(self, limit=5):
+        """The (function, self seconds, cumulative seconds) hot spots"""
+        stats = pstats.Stats(self.profile).stats
+        by_self_time = sorted(
+            stats.items(), key=lambda item: item[1][2], reverse=True)
+        return [
+            (_format_function(key), tottime, cumtime)
+            for key, (cc, nc, tottime, cumtime, callers)
+            in by_self_time[:limit]
+        ]
+
+    def compact_summary(self, limit=5):
+        """Single line summary, suitable for a response header"""
+        parts = [
+            'wall=%.1fms' % (self.duration * 1000.0),
+            'peak_alloc=%d' % self.peak_memory,
+        ]
+        for function, tottime, cumtime in self.top_functions(limit):
+            parts.append('%s=%.1fms' % (function, tottime * 1000.0))
+        return '; '.join(parts)
+
+    def dump(self, directory, name):
+        """Store the full profile, readable with pstats or snakeviz"""
+        path = os.path.join(directory, '%s-%d.prof' % (
+            name, int(time.time() * 1000)))
+        self.profile.dump_stats(path)
+        return path
+
+
+class NullProfiler(object):
+
+    enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        suppress_exception = False
+        return suppress_exception
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def make_profiler(config, headers):
+    """
+    Create a profiler if the request should be profiled
+
+    The request is profiled if it presents the PROFILE_TOKEN in the
+    profile header, or is sampled at PROFILE_SAMPLE_RATE.
+    """
+    token = config.get('PROFILE_TOKEN')
+    header_value = headers.get(PROFILE_HEADER)
+    requested = bool(
+        token and header_value and
+        hmac.compare_digest(token.encode('utf-8'),
+                            header_value.encode('utf-8')))
+    sample_rate = config.get('PROFILE_SAMPLE_RATE')
+    sampled = bool(sample_rate) and random.random() < sample_rate
+    if not (requested or sampled):
+        return NULL_PROFILER
+    return RequestProfiler()
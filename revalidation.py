@@ -0,0 +1,68 @@
+"""
+Background revalidation of stale output tiles
+
+Tiles in the output cache are fresh for a soft TTL, and kept for a
+longer hard TTL. A request for a tile between the two is served the
+stale tile straight away, and the tile is revalidated in the background,
+so only the tiles that expired altogether pay for a render on request.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger('zaloa.revalidation')
+
+
+class Revalidator(object):
+    """
+    Run revalidations in the background, one at a time per key
+
+    revalidate(key, fn) calls fn on one of max_workers threads, unless a
+    revalidation of the same key is already pending, when the requests
+    coalesce into it. At most max_pending keys are pending, and more are
+    dropped, since the next request for them schedules them again.
+
+    fn returns the outcome of the revalidation, eg 'unchanged' or
+    'rendered'. on_event, if set, is called with each of 'scheduled',
+    'coalesced', 'dropped', 'failed' and the outcomes.
+    """
+
+    def __init__(self, max_workers=2, max_pending=256, on_event=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self.on_event = on_event
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def _record(self, event):
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def revalidate(self, key, fn):
+        with self.lock:
+            if key in self.pending:
+                event = 'coalesced'
+            elif len(self.pending) >= self.max_pending:
+                event = 'dropped'
+            else:
+                event = 'scheduled'
+                self.pending.add(key)
+        self._record(event)
+        if event == 'scheduled':
+            return self.executor.submit(self._run, key, fn)
+        return None
+
+    def _run(self, key, fn):
+        try:
+            self._record(fn())
+        except Exception:
+            logger.exception('Failed to revalidate %s', key)
+            self._record('failed')
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -1,22 +1,84 @@
+import itertools
+import json
 import logging
 import math
+import os
 import sys
 import time
-from collections import namedtuple
+import zipfile
+from collections import namedtuple, OrderedDict
 from io import BytesIO
-from flask import Blueprint, Flask, current_app, make_response, render_template, request, abort
+from flask import Blueprint, Flask, current_app, make_response, redirect, render_template, request, abort, stream_with_context
 from flask_caching import Cache
+import flask_caching.backends
 from flask_cors import CORS
+from werkzeug.wsgi import wrap_file
+from disk_cache import DiskTile, DiskTileCache
+from elevation import MAX_ZOOM as ELEVATION_MAX_ZOOM, plan_points, PointSampler
+from metrics import (
+    Gauge,
+    record_canvas_pool_event,
+    record_disk_cache_event,
+    record_prefetch_event,
+    record_output_store_event,
+    record_peer_event,
+    record_revalidation_event,
+    format_server_timing,
+    observe_timing,
+    record_cache_lookup,
+    InstrumentedTileFetcher,
+    PROMETHEUS_CONTENT_TYPE,
+    REGISTRY,
+    REQUEST_ERRORS,
+    STAGE_DURATION,
+)
+from output_store import (
+    is_stale,
+    LocalOutputStore,
+    output_key,
+    OutputStoreWriter,
+    S3OutputStore,
+    same_sources,
+    SourceEtagRecorder,
+    StoreRedirect,
+)
+from peers import (
+    CoalescingTileFetcher,
+    HashRing,
+    MISSING_TILE_HEADER,
+    PEER_URL_PREFIX,
+    PeerTileFetcher,
+)
+from pinned import build_pinned_pyramid, PinnedPyramidRefresher
+from prefetch import NeighborPrefetcher, NULL_PREFETCHER
+from profiling import make_profiler, PROFILE_HEADER
+from revalidation import Revalidator
+from startup import prewarm_pil, prewarm_source_tiles, StartupTimer
+from tracing import configure_trace_logging, make_tracer
 from zaloa import (
-    generate_coordinates_512,
-    generate_coordinates_256,
-    generate_coordinates_260,
-    generate_coordinates_516,
-    is_tile_valid,
+    COORDS_GENERATORS,
+    NORMAL_COORDS_GENERATORS,
+    TILESETS,
+    parse_tile_request,
     process_tile,
-    ImageReducer,
+    process_tiles,
+    fetch_tiles_multi_threaded,
+    reduce_image_inputs,
+    is_tile_valid,
+    tiles_in_bbox,
+    CachingTileFetcher,
+    CanvasPool,
+    make_render_plan,
+    negotiate_output_format,
+    OutputMemo,
+    OUTPUT_FORMATS,
+    tileset_output_mode,
     S3TileFetcher,
     HttpTileFetcher,
+    DiskTileFetcher,
+    MBTilesTileFetcher,
+    MultiOriginTileFetcher,
+    MissingTileException,
     Tile,
 )
 
@@ -24,80 +86,1006 @@ from zaloa import (
 tile_bp = Blueprint('tiles', __name__)
 cache = Cache()
 
+# the rendered_at time decides whether the tile is stale, see
+# OUTPUT_CACHE_SOFT_TTL
+CachedTile = namedtuple('CachedTile', 'image_bytes rendered_at source_etags')
+
+STARTUP_PHASE_DURATION = Gauge(
+    'zaloa_startup_phase_seconds',
+    'Time spent in each phase of creating the app',
+    ('phase',),
+)
+
+
+# the lowercase CACHE_TYPEs of flask-caching before 1.10, which 2.0 only
+# knows by their class names
+CACHE_TYPE_CLASSES = {
+    'null': 'NullCache',
+    'simple': 'SimpleCache',
+    'filesystem': 'FileSystemCache',
+    'redis': 'RedisCache',
+    'redissentinel': 'RedisSentinelCache',
+    'rediscluster': 'RedisClusterCache',
+    'memcached': 'MemcachedCache',
+    'saslmemcached': 'SASLMemcachedCache',
+    'spreadsaslmemcached': 'SpreadSASLMemcachedCache',
+}
+NULL_CACHE_TYPES = ('null', 'NullCache', 'flask_caching.backends.NullCache')
+
+
+def make_origin_fetcher(kind, location, startup_timer):
+    if kind == 's3':
+        boto3 = startup_timer.import_module('boto3')
+        with startup_timer.phase('create s3 client'):
+            s3_client = boto3.client('s3')
+        return S3TileFetcher(s3_client, location)
+    elif kind == 'http':
+        requests = startup_timer.import_module('requests')
+        return HttpTileFetcher(requests, location)
+    elif kind == 'disk':
+        return DiskTileFetcher(location)
+    elif kind == 'mbtiles':
+        return MBTilesTileFetcher(location)
+    raise ValueError('Unknown tile origin: %s' % kind)
+
+
+def make_tile_fetcher(config, startup_timer):
+    fetch_type = config.get('TILES_FETCH_METHOD')
+    if fetch_type == 's3':
+        return make_origin_fetcher(
+            's3', config.get('TILES_S3_BUCKET'), startup_timer)
+    elif fetch_type == 'http':
+        return make_origin_fetcher(
+            'http', config.get('TILES_HTTP_PREFIX'), startup_timer)
+    elif fetch_type == 'multi':
+        assert config.get('TILES_ORIGINS'), \
+            "The multi fetch method needs TILES_ORIGINS"
+        origins = []
+        for origin in config.get('TILES_ORIGINS'):
+            kind, _, location = origin.partition(':')
+            tile_fetcher = make_origin_fetcher(kind, location, startup_timer)
+            # each origin's fetches are measured under its own backend
+            origins.append(
+                (kind, InstrumentedTileFetcher(tile_fetcher, kind)))
+        return MultiOriginTileFetcher(origins)
+
+
+def make_output_store(spec, startup_timer):
+    kind, _, location = spec.partition(':')
+    if kind == 's3':
+        bucket, _, prefix = location.partition('/')
+        boto3 = startup_timer.import_module('boto3')
+        with startup_timer.phase('create output store client'):
+            s3_client = boto3.client('s3')
+        return S3OutputStore(s3_client, bucket, prefix + '/' if prefix else '')
+    elif kind == 'disk':
+        return LocalOutputStore(location)
+    raise ValueError('Unknown output store: %s' % kind)
+
 
-def create_app():
+def _resolve_cache_type(config):
+    """Name CACHE_TYPE the way the installed flask-caching knows it"""
+    cache_type = config.get('CACHE_TYPE')
+    if cache_type in CACHE_TYPE_CLASSES and \
+            not hasattr(flask_caching.backends, cache_type):
+        config['CACHE_TYPE'] = CACHE_TYPE_CLASSES[cache_type]
+
+
+def has_output_cache(config):
+    """Whether CACHE_TYPE keeps the output tiles, by any of its names"""
+    return config.get('CACHE_TYPE') not in NULL_CACHE_TYPES
+
+
+def _record_source_cache_lookup(hit):
+    record_cache_lookup('source', hit)
+
+
+def _record_memo_lookup(hit):
+    record_cache_lookup('memo', hit)
+
+
+def _record_elevation_cache_lookup(hit):
+    record_cache_lookup('elevation', hit)
+
+
+def create_app(config_overrides=None, tile_fetcher=None, startup_timer=None,
+               output_store=None):
+    """
+    Create the flask app
+
+    config_overrides is applied on top of config.py, and tile_fetcher
+    replaces the fetcher built from the TILES_FETCH_METHOD configuration,
+    eg to use stand-in origins. Likewise output_store replaces the store
+    built from OUTPUT_STORE.
+
+    Everything the requests need is created here rather than on the first
+    request, see startup.py. startup_timer can carry timings from before
+    create_app was called, eg the imports.
+    """
+    startup_timer = startup_timer or StartupTimer()
     app = Flask(__name__)
     app.config.from_object('config')
+    if config_overrides:
+        app.config.update(config_overrides)
     CORS(app)
+    _resolve_cache_type(app.config)
     cache.init_app(app)
 
-    @app.before_first_request
-    def setup_logging():
-        if not app.debug:
-            # In production mode, add log handler to sys.stderr.
-            app.logger.addHandler(logging.StreamHandler())
-            app.logger.setLevel(logging.INFO)
+    if not app.debug:
+        # In production mode, add log handler to sys.stderr.
+        app.logger.addHandler(logging.StreamHandler())
+        app.logger.setLevel(logging.INFO)
 
     fetch_type = app.config.get('TILES_FETCH_METHOD')
-    assert fetch_type in ('s3', 'http'), "Fetch method must be s3 or http"
+    assert fetch_type in ('s3', 'http', 'multi'), \
+        "Fetch method must be s3, http or multi"
+    assert app.config.get('DISK_CACHE_SENDFILE') in \
+        ('wsgi', 'x-accel-redirect', 'x-sendfile'), \
+        "Disk cache sendfile must be wsgi, x-accel-redirect or x-sendfile"
+
+    if app.config.get('TRACE_SAMPLE_RATE'):
+        configure_trace_logging(app.config.get('TRACE_LOG_PATH'))
+
+    if tile_fetcher is None:
+        tile_fetcher = make_tile_fetcher(app.config, startup_timer)
+    if fetch_type != 'multi':
+        # the multi fetch method measures each origin under its own kind
+        tile_fetcher = InstrumentedTileFetcher(tile_fetcher, fetch_type)
+    origin_fetcher = tile_fetcher
+
+    source_cache_size = app.config.get('SOURCE_CACHE_SIZE')
+    peer_fetcher = None
+    peers = app.config.get('PEERS')
+    if peers and source_cache_size:
+        self_url = app.config.get('PEER_SELF_URL')
+        assert self_url in peers, "PEER_SELF_URL must be one of the PEERS"
+        requests = startup_timer.import_module('requests')
+        tile_fetcher = peer_fetcher = PeerTileFetcher(
+            HashRing(peers), self_url,
+            CoalescingTileFetcher(tile_fetcher, record_peer_event),
+            requests.Session(), app.config.get('PEER_TIMEOUT'),
+            record_peer_event)
+
+    source_cache = None
+    if source_cache_size:
+        tile_fetcher = source_cache = CachingTileFetcher(
+            tile_fetcher, source_cache_size, _record_source_cache_lookup)
+
+    if app.config.get('PREWARM_PIL'):
+        with startup_timer.phase('prewarm pil'):
+            prewarm_pil()
+
+    prewarm_max_zoom = app.config.get('PREWARM_SOURCE_MAX_ZOOM')
+    if prewarm_max_zoom is not None and source_cache_size:
+        with startup_timer.phase('prewarm source tiles'):
+            prewarm_source_tiles(tile_fetcher, TILESETS, prewarm_max_zoom)
+
+    prefetcher = NULL_PREFETCHER
+    prefetch_max_tiles = app.config.get('PREFETCH_MAX_TILES')
+    if prefetch_max_tiles and source_cache_size:
+        prefetcher = NeighborPrefetcher(
+            tile_fetcher, COORDS_GENERATORS, prefetch_max_tiles,
+            app.config.get('PREFETCH_QUEUE_SIZE'),
+            on_event=record_prefetch_event)
+        prefetcher.start(app.config.get('PREFETCH_WORKERS'))
+        tile_fetcher = prefetcher
+
+    point_sampler = PointSampler(
+        tile_fetcher, app.config.get('ELEVATION_CACHE_SIZE'),
+        _record_elevation_cache_lookup,
+        app.config.get('MAX_FETCH_CONCURRENCY'))
+
+    output_memo = None
+    output_memo_size = app.config.get('OUTPUT_MEMO_SIZE')
+    if output_memo_size:
+        output_memo = OutputMemo(output_memo_size, _record_memo_lookup)
+
+    canvas_pool = None
+    canvas_pool_size = app.config.get('CANVAS_POOL_SIZE')
+    if canvas_pool_size:
+        canvas_pool = CanvasPool(canvas_pool_size, record_canvas_pool_event)
+
+    output_store_writer = None
+    if output_store is None and app.config.get('OUTPUT_STORE'):
+        output_store = make_output_store(
+            app.config.get('OUTPUT_STORE'), startup_timer)
+    if output_store is not None:
+        # the stored tiles are only found stale against the sources that
+        # the source cache has fetched since, so never would be without it
+        assert source_cache_size, "OUTPUT_STORE needs a SOURCE_CACHE_SIZE"
+        output_store_writer = OutputStoreWriter(
+            output_store, app.config.get('OUTPUT_STORE_QUEUE_SIZE'),
+            record_output_store_event).start()
+
+    disk_cache = None
+    if app.config.get('DISK_CACHE_DIR'):
+        with startup_timer.phase('scan disk cache'):
+            disk_cache = DiskTileCache(
+                app.config.get('DISK_CACHE_DIR'),
+                app.config.get('DISK_CACHE_MAX_BYTES'),
+                record_disk_cache_event)
+
+    revalidator = None
+    soft_ttl = app.config.get('OUTPUT_CACHE_SOFT_TTL')
+    if soft_ttl:
+        # the tiles would expire before they were ever stale
+        hard_ttl = _output_cache_hard_ttl(app.config)
+        assert not hard_ttl or soft_ttl < hard_ttl, \
+            "OUTPUT_CACHE_SOFT_TTL (%d) must be less than the hard ttl, " \
+            "OUTPUT_CACHE_HARD_TTL or CACHE_DEFAULT_TIMEOUT (%d)" % (
+                soft_ttl, hard_ttl)
+        revalidator = Revalidator(
+            app.config.get('REVALIDATE_WORKERS'),
+            on_event=record_revalidation_event)
+
+    pinned = None
+    pinned_max_zoom = app.config.get('PINNED_MAX_ZOOM')
+    if pinned_max_zoom is not None:
+        pinned_tilesizes = app.config.get('PINNED_TILESIZES')
+
+        # straight from the origin, since the source cache and the peers
+        # would only give the refreshes the sources they already had
+        def build_pyramid():
+            return build_pinned_pyramid(
+                origin_fetcher, pinned_max_zoom, pinned_tilesizes, TILESETS,
+                app.config.get('TILESET_MODES'),
+                app.config.get('DERIVE_NORMALS'))
+
+        # built in the background, so it does not hold up the startup
+        pinned = PinnedPyramidRefresher(
+            build_pyramid, app.config.get('PINNED_REFRESH_INTERVAL'))
+        pinned.start()
+
+    for phase, duration in startup_timer.timings.items():
+        STARTUP_PHASE_DURATION.set(duration, (phase,))
+    if app.config.get('STARTUP_MEASURE'):
+        startup_logger = logging.getLogger('zaloa.startup')
+        startup_logger.addHandler(logging.StreamHandler())
+        startup_logger.setLevel(logging.INFO)
+        startup_logger.info('Startup took %.1fms: %s',
+                            startup_timer.total() * 1000.0,
+                            startup_timer.report())
+
+    app.extensions['zaloa'] = dict(
+        tile_fetcher=tile_fetcher,
+        startup_timer=startup_timer,
+        pinned=pinned,
+        output_memo=output_memo,
+        canvas_pool=canvas_pool,
+        prefetcher=prefetcher,
+        source_cache=source_cache,
+        output_store=output_store,
+        output_store_writer=output_store_writer,
+        disk_cache=disk_cache,
+        revalidator=revalidator,
+        peer_fetcher=peer_fetcher,
+        point_sampler=point_sampler,
+    )
 
     app.register_blueprint(tile_bp)
 
     return app
 
 
-@tile_bp.route('/tilezen/terrain/v1/<int:tilesize>/<tileset>/<int:z>/<int:x>/<int:y>.png')
-@tile_bp.route('/tilezen/terrain/v1/<tileset>/<int:z>/<int:x>/<int:y>.png')
-def handle_tile(z, x, y, tileset, tilesize=None):
-    tilesize = tilesize or 256
+@tile_bp.route('/tilezen/terrain/v1/<int:tilesize>/<tileset>/<int:z>/<int:x>/<int:y>.<output_format>')
+@tile_bp.route('/tilezen/terrain/v1/<tileset>/<int:z>/<int:x>/<int:y>.<output_format>')
+def handle_tile(z, x, y, tileset, tilesize=None, output_format='png'):
+    start = time.perf_counter()
 
-    if tilesize not in (256, 260, 512, 516):
-        return abort(404, 'Invalid tilesize')
+    parse_result = parse_tile_request(
+        tileset, tilesize, z, x, y, output_format)
+    if parse_result.not_found_reason:
+        return abort(404, parse_result.not_found_reason)
 
-    if tileset not in ('terrarium', 'normal'):
-        return abort(404, 'Invalid tileset')
+    tilesize = parse_result.tilesize
+    tile = parse_result.tile
+    fetch_type = current_app.config.get('TILES_FETCH_METHOD')
 
-    if not is_tile_valid(z, x, y):
-        return abort(404, 'Invalid tile coordinate')
+    # the png urls can be served in the other formats the client accepts
+    negotiable = current_app.config.get('NEGOTIATE_OUTPUT_FORMATS')
+    negotiated = output_format == 'png' and bool(negotiable)
+    if negotiated:
+        output_format = negotiate_output_format(
+            request.headers.get('Accept'), negotiable, tileset)
 
-    if tilesize != 260 and z == 15:
-        return abort(404, 'Invalid zoom')
+    tracer = make_tracer(
+        current_app.config.get('TRACE_SAMPLE_RATE'), 'handle_tile',
+        tileset=tileset, tilesize=tilesize, tile=str(tile),
+        backend=fetch_type)
+    profiler = make_profiler(current_app.config, request.headers)
+    try:
+        with profiler, tracer.span('handle_tile'):
+            # a profiled tile is not streamed, for its encode to run
+            # within the profile
+            image_bytes, timing_metadata = _render_tile(
+                tileset, tilesize, tile, fetch_type, tracer, output_format,
+                allow_stream=not profiler.enabled)
+    finally:
+        tracer.emit()
 
-    tile = Tile(z, x, y)
+    total = time.perf_counter() - start
+    STAGE_DURATION.observe(total, ('total', tileset, tilesize, fetch_type))
+
+    if isinstance(image_bytes, StoreRedirect):
+        resp = redirect(image_bytes.url)
+    else:
+        if isinstance(image_bytes, DiskTile):
+            resp = _send_disk_tile(image_bytes)
+        elif isinstance(image_bytes, bytes):
+            resp = make_response(image_bytes)
+        elif isinstance(image_bytes, memoryview):
+            # a pinned tile, which the wsgi server needs as bytes
+            resp = make_response(image_bytes.tobytes())
+        else:
+            # streamed, so the save and the rest of the total are not
+            # included in the Server-Timing
+            resp = current_app.response_class(
+                stream_with_context(image_bytes))
+        resp.content_type = OUTPUT_FORMATS[output_format].content_type
+    _set_cache_control(resp)
+    if negotiated:
+        resp.vary.add('Accept')
+    resp.headers['Server-Timing'] = format_server_timing(
+        timing_metadata, [('total', total)])
+    if profiler.enabled:
+        _report_profile(profiler, resp, tileset, tilesize, tile)
+    return resp
 
-    image_reducer = ImageReducer(tilesize)
 
-    # both terrarium and normal tiles follow the same
-    # coordinate generation strategy. They just point to a
-    # different location for the source data
-    if tilesize == 512:
-        coords_generator = generate_coordinates_512
-    elif tilesize == 256:
-        coords_generator = generate_coordinates_256
-    elif tilesize == 260:
-        coords_generator = generate_coordinates_260
-    elif tilesize == 516:
-        coords_generator = generate_coordinates_516
+def _send_disk_tile(disk_tile):
+    """Respond with a tile from the disk cache, without reading it"""
+    sendfile = current_app.config.get('DISK_CACHE_SENDFILE')
+    if sendfile == 'wsgi':
+        resp = current_app.response_class(
+            wrap_file(request.environ, disk_tile.file),
+            direct_passthrough=True)
+        resp.content_length = disk_tile.size
+        return resp
+
+    # the proxy in front sends the file
+    disk_tile.file.close()
+    resp = make_response(b'')
+    if sendfile == 'x-accel-redirect':
+        accel_prefix = current_app.config.get('DISK_CACHE_ACCEL_PREFIX')
+        resp.headers['X-Accel-Redirect'] = '%s/%s' % (
+            accel_prefix.rstrip('/'), disk_tile.relative_path)
     else:
-        abort(500, 'tileset/tilesize combination unimplemented')
+        resp.headers['X-Sendfile'] = os.path.abspath(disk_tile.path)
+    return resp
+
+
+def _set_cache_control(resp):
+    resp.cache_control.public = True
+    resp.cache_control.max_age = current_app.config.get('CACHE_MAX_AGE')
+    resp.cache_control.s_maxage = \
+        current_app.config.get('SHARED_CACHE_MAX_AGE')
+    stale_while_revalidate = \
+        current_app.config.get('CACHE_STALE_WHILE_REVALIDATE')
+    if stale_while_revalidate:
+        # werkzeug has no attribute for this extension
+        resp.cache_control['stale-while-revalidate'] = \
+            str(stale_while_revalidate)
+
+
+def _report_profile(profiler, resp, tileset, tilesize, tile):
+    summary = profiler.compact_summary()
+    resp.headers[PROFILE_HEADER] = summary
+    current_app.logger.info(
+        'Profiled %s/%s/%s: %s', tilesize, tileset, tile, summary)
+    profile_dir = current_app.config.get('PROFILE_DIR')
+    if profile_dir:
+        name = '%s-%s-%s' % (
+            tilesize, tileset, str(tile).replace('/', '-'))
+        profiler.dump(profile_dir, name)
+
+
+def _lookup_tile(tileset, tilesize, tile, output_format, tracer):
+    """The tile from the pinned pyramid or the output cache, and its key"""
+    pinned = current_app.extensions['zaloa']['pinned']
+    if pinned is not None and output_format == 'png' and \
+            pinned.pyramid.covers(tile):
+        with tracer.span('pinned-get'):
+            image_bytes = pinned.pyramid.get(tilesize, tileset, tile)
+        record_cache_lookup('pinned', image_bytes is not None)
+        if image_bytes is not None:
+            return image_bytes, None
+
+    cache_key = 'tile/%s/%s/%s' % (tilesize, tileset, tile)
+    if output_format != 'png':
+        cache_key += '.' + output_format
+    with tracer.span('cache-get'):
+        cached = cache.get(cache_key)
+    record_cache_lookup('output', cached is not None)
+    if cached is None or isinstance(cached, bytes):
+        # tiles cached before they had their rendered_at are always fresh
+        return cached, cache_key
+
+    revalidator = current_app.extensions['zaloa']['revalidator']
+    soft_ttl = current_app.config.get('OUTPUT_CACHE_SOFT_TTL')
+    if revalidator is not None and \
+            time.time() - cached.rendered_at > soft_ttl:
+        app = current_app._get_current_object()
+        revalidator.revalidate(cache_key, lambda: _revalidate_tile(
+            app, tileset, tilesize, tile, output_format, cache_key, cached))
+    return cached.image_bytes, cache_key
+
+
+def _output_cache_hard_ttl(config):
+    """The seconds after which output tiles expire, 0 for never"""
+    hard_ttl = config.get('OUTPUT_CACHE_HARD_TTL')
+    if hard_ttl is None:
+        # flask-caching's default, which it does not set in app.config
+        hard_ttl = config.get('CACHE_DEFAULT_TIMEOUT', 300)
+    return hard_ttl
+
+
+def _lookup_disk_tile(disk_cache, cache_key, plan, tileset, tilesize, tile,
+                      output_format, tracer):
+    """
+    The DiskTile of the tile, or None
+
+    The disk tiles expire after the hard ttl of the output cache, are
+    revalidated after its soft ttl, and are stale when one of their
+    sources has changed, like the stored tiles.
+    """
+    with tracer.span('disk-get'):
+        disk_tile = disk_cache.get(cache_key)
+    if disk_tile is not None:
+        age = time.time() - disk_tile.written_at
+        hard_ttl = _output_cache_hard_ttl(current_app.config)
+        if hard_ttl and age > hard_ttl:
+            event = 'expired'
+        elif is_stale(disk_tile.source_etags,
+                      _known_source_etags(plan, tile)):
+            event = 'stale'
+        else:
+            event = None
+        if event is not None:
+            record_disk_cache_event(event)
+            disk_tile.file.close()
+            disk_tile = None
+    record_cache_lookup('disk', disk_tile is not None)
+    if disk_tile is None:
+        return None
+
+    revalidator = current_app.extensions['zaloa']['revalidator']
+    soft_ttl = current_app.config.get('OUTPUT_CACHE_SOFT_TTL')
+    if revalidator is not None and age > soft_ttl:
+        app = current_app._get_current_object()
+        # the bytes are only needed again when the tile is rendered
+        cached = CachedTile(
+            None, disk_tile.written_at, disk_tile.source_etags)
+        revalidator.revalidate(cache_key, lambda: _revalidate_tile(
+            app, tileset, tilesize, tile, output_format, cache_key, cached))
+    return disk_tile
+
+
+def _cache_tile(cache_key, image_bytes, source_etags, write_disk=True):
+    # expires after the hard ttl, when it is rendered on request again
+    cache.set(cache_key, CachedTile(image_bytes, time.time(), source_etags),
+              timeout=current_app.config.get('OUTPUT_CACHE_HARD_TTL'))
+    disk_cache = current_app.extensions['zaloa']['disk_cache']
+    if disk_cache is not None and write_disk:
+        disk_cache.put(cache_key, image_bytes, source_etags)
+
+
+def _revalidate_tile(app, tileset, tilesize, tile, output_format, cache_key,
+                     cached):
+    """
+    Render a stale tile again, unless its sources are unchanged
+
+    The sources are fetched from behind the source cache, which can be as
+    old as the tile, and replace the ones in it.
+    """
+    with app.app_context():
+        extensions = app.extensions['zaloa']
+        source_cache = extensions['source_cache']
+        if source_cache is None:
+            origin_fetcher = extensions['tile_fetcher']
+        else:
+            origin_fetcher = source_cache.tile_fetcher
+
+        def fetch_source(source_tileset, source_tile):
+            fetch_result = origin_fetcher(source_tileset, source_tile)
+            if source_cache is not None:
+                source_cache.cache.put(
+                    (source_tileset, source_tile), fetch_result)
+            return fetch_result
+
+        plan = _make_render_plan(tileset, tilesize, tile, output_format)
+        tile_fetcher = SourceEtagRecorder(fetch_source)
+        timing_metadata = dict(fetch={}, process={})
+        image_inputs = fetch_tiles_multi_threaded(
+            tile_fetcher, plan.source_tileset, plan.coords_generator(tile),
+            timing_metadata['fetch'],
+            max_threads=app.config.get('MAX_FETCH_CONCURRENCY'))
+        if same_sources(cached.source_etags, tile_fetcher.etags):
+            # the tiles from the disk cache are only fresh again there,
+            # where they stay
+            if cached.image_bytes is not None:
+                _cache_tile(cache_key, cached.image_bytes,
+                            cached.source_etags, write_disk=False)
+            disk_cache = extensions['disk_cache']
+            if disk_cache is not None:
+                disk_cache.refresh(cache_key, cached.source_etags)
+            return 'unchanged'
+
+        image_bytes = reduce_image_inputs(
+            plan.image_reducer, image_inputs, timing_metadata)
+        _cache_tile(cache_key, image_bytes, tile_fetcher.etags)
+        output_store_writer = extensions['output_store_writer']
+        if output_store_writer is not None:
+            output_store_writer.put(
+                output_key(tilesize, tileset, tile, output_format),
+                image_bytes, tile_fetcher.etags,
+                OUTPUT_FORMATS[output_format].content_type)
+        return 'rendered'
+
+
+def _make_render_plan(tileset, tilesize, tile, output_format):
+    return make_render_plan(
+        tileset, tilesize, tile,
+        current_app.extensions['zaloa']['canvas_pool'],
+        tileset_output_mode(current_app.config.get('TILESET_MODES'), tileset),
+        output_format, current_app.config.get('DERIVE_NORMALS'))
+
+
+def _lookup_rendered_tile(tileset, tilesize, tile, output_format, tracer,
+                          allow_redirect=True):
+    """
+    Look for the rendered tile in the pinned pyramid, the output cache,
+    the disk cache and the output store, in that order
+
+    Returns the tile or None, its cache key and its render plan. The tile
+    is its bytes, the memoryview of a pinned tile, a DiskTile, or with
+    allow_redirect, a StoreRedirect when the store is redirected to.
+    """
+    image_bytes, cache_key = _lookup_tile(
+        tileset, tilesize, tile, output_format, tracer)
+    if image_bytes is not None:
+        return image_bytes, cache_key, None
+
+    plan = _make_render_plan(tileset, tilesize, tile, output_format)
+
+    disk_cache = current_app.extensions['zaloa']['disk_cache']
+    if disk_cache is not None:
+        disk_tile = _lookup_disk_tile(
+            disk_cache, cache_key, plan, tileset, tilesize, tile,
+            output_format, tracer)
+        if disk_tile is not None:
+            return disk_tile, cache_key, plan
+
+    output_store = current_app.extensions['zaloa']['output_store']
+    if output_store is not None:
+        stored = _lookup_output_store(
+            output_store, output_key(tilesize, tileset, tile, output_format),
+            plan, tile, tracer, allow_redirect)
+        if isinstance(stored, StoreRedirect):
+            return stored, cache_key, plan
+        if stored is not None:
+            _cache_tile(cache_key, stored.image_bytes, stored.source_etags)
+            return stored.image_bytes, cache_key, plan
+    return None, cache_key, plan
+
+
+def _render_tile(tileset, tilesize, tile, fetch_type, tracer, output_format,
+                 allow_stream=True):
+    image_bytes, cache_key, plan = _lookup_rendered_tile(
+        tileset, tilesize, tile, output_format, tracer)
+    if image_bytes is not None:
+        return image_bytes, {}
+
+    # the etags of the sources are kept with the tile in the output cache
+    # and store, to revalidate it against
+    tile_fetcher = SourceEtagRecorder(
+        current_app.extensions['zaloa']['tile_fetcher'])
+    output_memo = current_app.extensions['zaloa']['output_memo']
+    prefetcher = current_app.extensions['zaloa']['prefetcher']
+    stream = allow_stream and output_format == 'png' and \
+        current_app.config.get('STREAM_PNG_OUTPUT')
+
+    store_tile = None
+    if current_app.extensions['zaloa']['output_store'] is not None:
+        store_tile = _make_store_tile(
+            output_key(tilesize, tileset, tile, output_format), tile_fetcher,
+            OUTPUT_FORMATS[output_format].content_type)
+
+    try:
+        with prefetcher.foreground():
+            image_bytes, timing_metadata, tile_coords = process_tile(
+                plan.coords_generator, tile_fetcher, plan.image_reducer,
+                plan.source_tileset, tile, tracer,
+                current_app.config.get('MAX_FETCH_CONCURRENCY'),
+                output_memo, stream)
+    except Exception as e:
+        REQUEST_ERRORS.inc((tileset, tilesize, type(e).__name__))
+        raise
+    derived_normals = tileset == 'normal' and \
+        current_app.config.get('DERIVE_NORMALS')
+    prefetcher.observe(
+        tilesize, plan.source_tileset, tile,
+        NORMAL_COORDS_GENERATORS if derived_normals else None)
+
+    if stream:
+        chunks = _finish_streamed_tile(
+            image_bytes, cache_key, timing_metadata, tileset, tilesize,
+            fetch_type, tile_fetcher.etags, store_tile)
+        return chunks, timing_metadata
+
+    observe_timing(timing_metadata, tileset, tilesize, fetch_type)
+    with tracer.span('cache-set'):
+        _cache_tile(cache_key, image_bytes, tile_fetcher.etags)
+    if store_tile is not None:
+        store_tile(image_bytes)
+    return image_bytes, timing_metadata
+
+
+def _lookup_output_store(output_store, store_key, plan, tile, tracer,
+                         allow_redirect=True):
+    """
+    The StoredTile from the output store, a StoreRedirect to it, or None
+
+    A stored tile whose sources in the source cache have other etags is
+    stale, and None is returned to render it again. Failing to read the
+    store is a miss too, rather than failing the request. Without
+    allow_redirect, the stored tile is read even when the store is
+    redirected to.
+    """
+    redirect_url = allow_redirect and \
+        current_app.config.get('OUTPUT_STORE_REDIRECT_URL')
+    try:
+        with tracer.span('store-get'):
+            if redirect_url:
+                stored = output_store.head(store_key)
+            else:
+                stored = output_store.get(store_key)
+    except Exception:
+        current_app.logger.exception(
+            'Failed to read %s from the output store', store_key)
+        record_output_store_event('error')
+        stored = None
+
+    if stored is not None and is_stale(
+            stored.source_etags, _known_source_etags(plan, tile)):
+        record_output_store_event('stale')
+        stored = None
+    record_cache_lookup('store', stored is not None)
+    if stored is None:
+        return None
+    if redirect_url:
+        return StoreRedirect('%s/%s' % (redirect_url.rstrip('/'), store_key))
+    return stored
+
+
+def _known_source_etags(plan, tile):
+    """The etags of the tile's sources that are in the source cache"""
+    source_cache = current_app.extensions['zaloa']['source_cache']
+    if source_cache is None:
+        return {}
+    source_etags = {}
+    for tile_coords in plan.coords_generator(tile):
+        fetch_result = source_cache.cache.get(
+            (plan.source_tileset, tile_coords.tile))
+        if fetch_result is not None:
+            source_etags[str(tile_coords.tile)] = fetch_result.etag
+    return source_etags
+
+
+def _make_store_tile(store_key, etag_recorder, content_type):
+    output_store_writer = \
+        current_app.extensions['zaloa']['output_store_writer']
+
+    def store_tile(image_bytes):
+        output_store_writer.put(
+            store_key, image_bytes, etag_recorder.etags, content_type)
+
+    return store_tile
+
+
+def _finish_streamed_tile(chunks, cache_key, timing_metadata, tileset,
+                          tilesize, fetch_type, source_etags, store_tile=None):
+    # the whole output is only kept when there is an output cache to set
+    # or a store to write it to
+    keep = has_output_cache(current_app.config) or \
+        current_app.extensions['zaloa']['disk_cache'] is not None or \
+        store_tile is not None
+    kept = []
+    for chunk in chunks:
+        if keep:
+            kept.append(chunk)
+        yield chunk
+    observe_timing(timing_metadata, tileset, tilesize, fetch_type)
+    if keep:
+        image_bytes = b''.join(kept)
+        _cache_tile(cache_key, image_bytes, source_etags)
+        if store_tile is not None:
+            store_tile(image_bytes)
+
+
+def _batch_tiles(args, max_tiles):
+    """The distinct z, x, y of the tiles listed or covered by the args"""
+    if 'tiles' in args:
+        tiles = []
+        for tile_path in args['tiles'].split(','):
+            z, x, y = (int(part) for part in tile_path.split('/'))
+            tiles.append((z, x, y))
+    elif 'bbox' in args:
+        west, south, east, north = (
+            float(part) for part in args['bbox'].split(','))
+        z = int(args.get('z', ''))
+        if not is_tile_valid(z, 0, 0):
+            raise ValueError('Invalid zoom')
+        tiles = [
+            (tile.z, tile.x, tile.y) for tile in itertools.islice(
+                tiles_in_bbox(z, west, south, east, north), max_tiles + 1)]
+    else:
+        raise ValueError('Either tiles or bbox is required')
+    tiles = list(OrderedDict.fromkeys(tiles))
+    if len(tiles) > max_tiles:
+        raise ValueError('At most %d tiles can be requested' % max_tiles)
+    return tiles
+
+
+@tile_bp.route('/tilezen/terrain/v1/<int:tilesize>/<tileset>/batch.zip')
+def handle_batch(tilesize, tileset):
+    """
+    Render many output tiles into one zip archive
+
+    The tiles are listed as tiles=z/x/y,z/x/y or covered by
+    bbox=west,south,east,north at zoom z, and are encoded in format, png
+    by default. The archive has a z/x/y.format entry for each tile. The
+    tiles with missing sources are left out, and listed one z/x/y per
+    line in a missing.txt entry.
+    """
+    start = time.perf_counter()
+    output_format = request.args.get('format', 'png')
+    try:
+        tiles = _batch_tiles(
+            request.args, current_app.config.get('BATCH_MAX_TILES'))
+    except ValueError as e:
+        return abort(400, str(e))
+
+    parse_results = [
+        parse_tile_request(tileset, tilesize, z, x, y, output_format)
+        for z, x, y in tiles]
+    for parse_result in parse_results:
+        if parse_result.not_found_reason:
+            return abort(404, parse_result.not_found_reason)
 
     fetch_type = current_app.config.get('TILES_FETCH_METHOD')
-    if fetch_type == 's3':
-        import boto3
-        bucket = current_app.config.get('TILES_S3_BUCKET')
-        s3_client = boto3.client('s3')
-        tile_fetcher = S3TileFetcher(s3_client, bucket)
-    elif fetch_type == 'http':
-        import requests
-        url_prefix = current_app.config.get('TILES_HTTP_PREFIX')
-        tile_fetcher = HttpTileFetcher(requests, url_prefix)
+    tracer = make_tracer(
+        current_app.config.get('TRACE_SAMPLE_RATE'), 'handle_batch',
+        tileset=tileset, tilesize=tilesize, tiles=len(tiles),
+        backend=fetch_type)
+    try:
+        with tracer.span('handle_batch'):
+            outputs, timing_metadata = _render_batch(
+                tileset, tilesize,
+                [parse_result.tile for parse_result in parse_results],
+                tracer, output_format)
+    finally:
+        tracer.emit()
+
+    archive = BytesIO()
+    missing = []
+    # the tiles are compressed already
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED) as zip_file:
+        for tile, image_bytes in outputs:
+            if image_bytes is None:
+                missing.append(str(tile))
+            else:
+                zip_file.writestr(
+                    '%s.%s' % (tile, output_format), image_bytes)
+        if missing:
+            zip_file.writestr('missing.txt', ''.join(
+                '%s\n' % tile for tile in missing))
+
+    total = time.perf_counter() - start
+    STAGE_DURATION.observe(total, ('batch', tileset, tilesize, fetch_type))
+    resp = make_response(archive.getvalue())
+    resp.content_type = 'application/zip'
+    _set_cache_control(resp)
+    resp.headers['Server-Timing'] = format_server_timing(
+        timing_metadata, [('total', total)])
+    return resp
+
+
+def _render_batch(tileset, tilesize, tiles, tracer, output_format):
+    """
+    The (tile, image bytes) pairs of the tiles, and the timing metadata
+
+    The tiles are looked up as on the single tile route, and those
+    rendered are written through to the output cache, the disk cache and
+    the output store, with the etags of their sources to revalidate them
+    against. The image bytes of the tiles with missing sources are None.
+    """
+    images = OrderedDict()
+    cache_keys = {}
+    tile_plans = []
+    for tile in tiles:
+        image_bytes, cache_keys[tile], plan = _lookup_rendered_tile(
+            tileset, tilesize, tile, output_format, tracer,
+            allow_redirect=False)
+        if isinstance(image_bytes, DiskTile):
+            with image_bytes.file as fp:
+                image_bytes = fp.read()
+        images[tile] = image_bytes
+        if image_bytes is None:
+            tile_plans.append((tile, plan))
+
+    tile_fetcher = SourceEtagRecorder(
+        current_app.extensions['zaloa']['tile_fetcher'])
+    output_memo = current_app.extensions['zaloa']['output_memo']
+    prefetcher = current_app.extensions['zaloa']['prefetcher']
+    try:
+        with prefetcher.foreground():
+            outputs, timing_metadata, num_source_tiles = process_tiles(
+                tile_plans, tile_fetcher, tracer,
+                current_app.config.get('MAX_FETCH_CONCURRENCY'),
+                output_memo, skip_missing=True)
+    except Exception as e:
+        REQUEST_ERRORS.inc((tileset, tilesize, type(e).__name__))
+        raise
+
+    output_store_writer = \
+        current_app.extensions['zaloa']['output_store_writer']
+    plans = dict(tile_plans)
+    with tracer.span('cache-set'):
+        for tile, image_bytes in outputs:
+            images[tile] = image_bytes
+            if image_bytes is None:
+                continue
+            # the sources the tiles share were fetched once for them all
+            plan = plans[tile]
+            source_etags = dict(
+                (str(tile_coords.tile),
+                 tile_fetcher.etags[str(tile_coords.tile)])
+                for tile_coords in plan.coords_generator(tile)
+                if str(tile_coords.tile) in tile_fetcher.etags)
+            _cache_tile(cache_keys[tile], image_bytes, source_etags)
+            if output_store_writer is not None:
+                output_store_writer.put(
+                    output_key(tilesize, tileset, tile, output_format),
+                    image_bytes, source_etags,
+                    OUTPUT_FORMATS[output_format].content_type)
+    return list(images.items()), timing_metadata
+
+
+def _elevation_points(req, max_points):
+    """The lngs and lats of the points posted to the elevation endpoint"""
+    import numpy
+    if req.mimetype == 'application/octet-stream':
+        data = req.get_data()
+        if len(data) % 16:
+            raise ValueError('The points must be float64 lng, lat pairs')
+        points = numpy.frombuffer(data, '<f8').reshape(-1, 2)
+    else:
+        try:
+            points = numpy.asarray(
+                req.get_json(force=True), dtype=numpy.float64)
+        except (TypeError, ValueError):
+            points = None
+        if points is not None and points.size == 0:
+            points = points.reshape(0, 2)
+        if points is None or points.ndim != 2 or points.shape[1] != 2:
+            raise ValueError('The points must be a list of [lng, lat] pairs')
+    if len(points) > max_points:
+        raise ValueError('At most %d points can be requested' % max_points)
+    if not numpy.isfinite(points).all():
+        raise ValueError('The points must be finite')
+    return points[:, 0], points[:, 1]
+
 
-    image_bytes, timing_metadata, tile_coords = process_tile(
-        coords_generator, tile_fetcher, image_reducer, tileset,
-        tile)
+@tile_bp.route('/tilezen/terrain/v1/elevation.<output_format>',
+               methods=['POST'])
+def handle_elevation(output_format):
+    """
+    Sample the elevations of a batch of points at zoom z
 
-    resp = make_response(image_bytes)
+    The points are posted as a json list of [lng, lat] pairs, or as
+    little endian float64 lng, lat pairs with the application/octet-stream
+    content type. Their elevations in meters come back in the same order,
+    as little endian float32 with the f32 format, or a json list with
+    json. Points in missing tiles are NaN, or null. interpolate=true
+    interpolates bilinearly between the pixels around each point.
+    """
+    start = time.perf_counter()
+    if output_format not in ('f32', 'json'):
+        return abort(404, 'Invalid format')
+    try:
+        z = int(request.args.get('z', ''))
+        if not 0 <= z <= ELEVATION_MAX_ZOOM:
+            raise ValueError('Invalid zoom')
+        lngs, lats = _elevation_points(
+            request, current_app.config.get('ELEVATION_MAX_POINTS'))
+    except ValueError as e:
+        return abort(400, str(e))
+
+    plan = plan_points(
+        lngs, lats, z, request.args.get('interpolate') == 'true')
+    max_source_tiles = current_app.config.get('ELEVATION_MAX_SOURCE_TILES')
+    if len(plan.tiles) > max_source_tiles:
+        return abort(400, 'The points fall in %d source tiles, at most %d '
+                          'can be fetched, use a lower zoom or fewer points'
+                     % (len(plan.tiles), max_source_tiles))
+
+    fetch_type = current_app.config.get('TILES_FETCH_METHOD')
+    tracer = make_tracer(
+        current_app.config.get('TRACE_SAMPLE_RATE'), 'handle_elevation',
+        points=len(lngs), source_tiles=len(plan.tiles), backend=fetch_type)
+    point_sampler = current_app.extensions['zaloa']['point_sampler']
+    prefetcher = current_app.extensions['zaloa']['prefetcher']
+    try:
+        with prefetcher.foreground(), tracer.span('handle_elevation'):
+            elevations, timing_metadata = point_sampler.sample(plan, tracer)
+    except Exception as e:
+        # labelled apart from the terrarium tiles the points are in
+        REQUEST_ERRORS.inc(('elevation', 256, type(e).__name__))
+        raise
+    finally:
+        tracer.emit()
+
+    if output_format == 'json':
+        resp = make_response(json.dumps([
+            None if elevation != elevation else elevation
+            for elevation in elevations.tolist()]))
+        resp.content_type = 'application/json'
+    else:
+        resp = make_response(elevations.astype('<f4').tobytes())
+        resp.content_type = OUTPUT_FORMATS['f32'].content_type
+
+    total = time.perf_counter() - start
+    STAGE_DURATION.observe(total, ('elevation', 'elevation', 256, fetch_type))
+    resp.headers['Server-Timing'] = format_server_timing(
+        timing_metadata, [('total', total)])
+    return resp
+
+
+@tile_bp.route(PEER_URL_PREFIX + '/<tileset>/<int:z>/<int:x>/<int:y>.png')
+def handle_peer_tile(tileset, z, x, y):
+    peer_fetcher = current_app.extensions['zaloa']['peer_fetcher']
+    if peer_fetcher is None or tileset not in TILESETS or \
+            not is_tile_valid(z, x, y):
+        return abort(404)
+
+    try:
+        fetch_result = _fetch_owned_source(
+            peer_fetcher, tileset, Tile(z, x, y))
+    except MissingTileException:
+        resp = make_response('', 404)
+        resp.headers[MISSING_TILE_HEADER] = '1'
+        return resp
+    record_peer_event('served')
+
+    resp = make_response(fetch_result.image_bytes)
     resp.content_type = 'image/png'
+    if fetch_result.etag:
+        resp.headers['ETag'] = fetch_result.etag
+    return resp
+
+
+def _fetch_owned_source(peer_fetcher, tileset, tile):
+    """
+    Fetch a source tile that a peer asked for, from the source cache or
+    the origin
+
+    Never from another peer, which could send the request back here when
+    the instances disagree on the peers, eg during a deploy.
+    """
+    source_cache = current_app.extensions['zaloa']['source_cache']
+    key = (tileset, tile)
+    fetch_result = source_cache.cache.get(key)
+    _record_source_cache_lookup(fetch_result is not None)
+    if fetch_result is None:
+        fetch_result = peer_fetcher.origin_fetcher(tileset, tile)
+        source_cache.cache.put(key, fetch_result)
+    return fetch_result
+
+
+@tile_bp.route('/metrics')
+def metrics():
+    resp = make_response(REGISTRY.render())
+    resp.content_type = PROMETHEUS_CONTENT_TYPE
     return resp
 
 
@@ -0,0 +1,104 @@
+"""
+Cold start support
+
+On Lambda the init phase (importing the handler module) runs with more
+CPU than the invocations that follow, and does not count against the
+first request. So everything that would otherwise happen lazily on the
+first request is moved into create_app: importing and creating the
+fetcher clients, and optionally loading Pillow's png codec and some
+source tiles. StartupTimer records how long each of these phases took.
+"""
+
+import importlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import perf_counter
+
+from zaloa import Tile
+
+
+logger = logging.getLogger('zaloa.startup')
+
+
+class _phase(object):
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.timings[self.name] = perf_counter() - self.start
+        suppress_exception = False
+        return suppress_exception
+
+
+class StartupTimer(object):
+    """Record the duration of the startup phases, in order"""
+
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    def phase(self, name):
+        return _phase(self.timings, name)
+
+    def import_module(self, name):
+        """Import a module, timing it as its own phase"""
+        with self.phase('import %s' % name):
+            return importlib.import_module(name)
+
+    def total(self):
+        return sum(self.timings.values())
+
+    def report(self):
+        return ', '.join(
+            '%s=%.1fms' % (name, duration * 1000.0)
+            for name, duration in self.timings.items())
+
+
+def prewarm_pil():
+    """
+    Load Pillow's codecs and run a png through them
+
+    Image.open imports the plugins on first use, and the first encode
+    and decode initialize zlib, none of which should happen on a request.
+    """
+    from PIL import Image
+    Image.init()
+    fp = BytesIO()
+    Image.new('RGBA', (4, 4)).save(fp, format='PNG')
+    fp.seek(0)
+    Image.open(fp).load()
+
+
+def _prewarm_source_tile(tile_fetcher, tileset, tile):
+    try:
+        tile_fetcher(tileset, tile)
+    except Exception:
+        logger.exception('Failed to prewarm %s/%s', tileset, tile)
+        return False
+    return True
+
+
+def prewarm_source_tiles(tile_fetcher, tilesets, max_zoom, max_workers=8):
+    """
+    Fetch every source tile up to max_zoom through the fetcher
+
+    Meant to fill a CachingTileFetcher with the low zoom tiles that every
+    client needs. Returns the number of tiles fetched.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _prewarm_source_tile, tile_fetcher, tileset, Tile(z, x, y))
+            for tileset in tilesets
+            for z in range(max_zoom + 1)
+            for x in range(2 ** z)
+            for y in range(2 ** z)
+        ]
+    return sum(1 for future in futures if future.result())
@@ -1,13 +1,281 @@
+import math
 import unittest
 
+from zaloa import ImageSpec, Tile, TileCoordinates
+
+
+# the hand written coordinate generators that CoordinatePlanner replaced,
+# which it is checked against
+
+def img_pos(x, y):
+    pos = x, y
+    crop = None
+    return ImageSpec(pos, crop)
+
+
+def generate_coordinates_256(tile):
+    tile_coordinates = (
+        TileCoordinates(tile, img_pos(0, 0)),
+    )
+    return tile_coordinates
+
+
+def generate_coordinates_512(tile):
+    zp1 = tile.z + 1
+    dbl_x = tile.x * 2
+    dbl_y = tile.y * 2
+    # see ImageSpec description above for coordinate meaning
+
+    tile_coordinates = (
+        TileCoordinates(Tile(zp1, dbl_x, dbl_y), img_pos(0, 0)),
+        TileCoordinates(Tile(zp1, dbl_x+1, dbl_y), img_pos(256, 0)),
+        TileCoordinates(Tile(zp1, dbl_x, dbl_y+1), img_pos(0, 256)),
+        TileCoordinates(Tile(zp1, dbl_x+1, dbl_y+1), img_pos(256, 256)),
+    )
+    return tile_coordinates
+
+
+def generate_coordinates_260(tile):
+    """
+    generate a 3x3 grid with the source tile in the center
+
+    x x x
+    x o x
+    x x x
+
+    """
+
+    # see ImageSpec description above for coordinate meaning
+
+    tile_coordinates = []
+
+    x_y_max = int(math.pow(2, tile.z)) - 1
+
+    # NOTE: using a north, east, south, west naming scheme
+    # top row placement positions
+    loc_nw, loc_n, loc_ne = (0, 0), (2, 0), (258, 0)
+    # mid row placement positions
+    loc_w, loc_c, loc_e = (0, 2), (2, 2), (258, 2)
+    # bot row placement positions
+    loc_sw, loc_s, loc_se = (0, 258), (2, 258), (258, 258)
+
+    # set the top row tiles to account for edge cases
+    top_y = 0 if tile.y == 0 else tile.y-1
+    if tile.x == 0:
+        nw_tile = Tile(tile.z, x_y_max, top_y)
+    else:
+        nw_tile = Tile(tile.z, tile.x-1, top_y)
+    n_tile = Tile(tile.z, tile.x, top_y)
+    if tile.x == x_y_max:
+        ne_tile = Tile(tile.z, 0, top_y)
+    else:
+        ne_tile = Tile(tile.z, tile.x+1, top_y)
+
+    # set the mid row of tiles
+    if tile.x == 0:
+        w_tile = Tile(tile.z, x_y_max, tile.y)
+    else:
+        w_tile = Tile(tile.z, tile.x-1, tile.y)
+    c_tile = Tile(tile.z, tile.x, tile.y)
+    if tile.x == x_y_max:
+        e_tile = Tile(tile.z, 0, tile.y)
+    else:
+        e_tile = Tile(tile.z, tile.x+1, tile.y)
+
+    # set the bot row of tiles
+    bot_y = x_y_max if tile.y == x_y_max else tile.y+1
+    if tile.x == 0:
+        sw_tile = Tile(tile.z, x_y_max, bot_y)
+    else:
+        sw_tile = Tile(tile.z, tile.x-1, bot_y)
+    s_tile = Tile(tile.z, tile.x, bot_y)
+    if tile.x == x_y_max:
+        se_tile = Tile(tile.z, 0, bot_y)
+    else:
+        se_tile = Tile(tile.z, tile.x+1, bot_y)
+
+    # relevant tiles are set appropriately
+    # now we need to figure out the parts that are cropped from each
+    # if we are the top or bot, we need to invert the piece that gets cropped
+    if tile.y == 0:
+        # the tiles will be set to be the top row
+        # we'll be extracting the top bounds from these
+        top_crop_bounds = (
+            (254, 0, 256, 2),
+            (0, 0, 256, 2),
+            (0, 0, 2, 2),
+        )
+    else:
+        # we are not the top row
+        # we'll be extracting the bot bounds from the row above us
+        top_crop_bounds = (
+            (254, 254, 256, 256),
+            (0, 254, 256, 256),
+            (0, 254, 2, 256),
+        )
+    mid_crop_bounds = (
+        (254, 0, 256, 256),
+        None,
+        (0, 0, 2, 256),
+    )
+    if tile.y == x_y_max:
+        # the tiles will be set to the bot row
+        # we'll be extrating the bot bounds from these
+        bot_crop_bounds = (
+            (254, 254, 256, 256),
+            (0, 254, 256, 256),
+            (0, 254, 2, 256),
+        )
+    else:
+        # we are not the bot row
+        # we'll be extracting the top bounds from the row below us
+        bot_crop_bounds = (
+            (254, 0, 256, 2),
+            (0, 0, 256, 2),
+            (0, 0, 2, 2),
+        )
+
+    # the tiles, locations, and bounds are now all assembled
+    # weave them together to generate the list of all tile coordinates
+    all_tiles = (
+        nw_tile, n_tile, ne_tile,
+        w_tile, c_tile, e_tile,
+        sw_tile, s_tile, se_tile,
+    )
+    all_locs = (
+        loc_nw, loc_n, loc_ne,
+        loc_w, loc_c, loc_e,
+        loc_sw, loc_s, loc_se,
+    )
+    all_bounds = (list(top_crop_bounds) +
+                  list(mid_crop_bounds) +
+                  list(bot_crop_bounds))
+
+    for tile, loc, crop_bounds in zip(all_tiles, all_locs, all_bounds):
+        tc = TileCoordinates(tile, ImageSpec(loc, crop_bounds))
+        tile_coordinates.append(tc)
+
+    return tile_coordinates
+
+
+def generate_coordinates_516(tile):
+    """
+    generate a 4x4 grid with the source tiles being the 4 in the middle
+
+    The source tile is zoomed in one, which generates 4 tiles. Then
+    the border around these 4 is used.
+
+    x x x x
+    x O o x
+    x o o x
+    x x x x
+
+    """
+
+    tile_coordinates = []
+
+    # pre-bump the coordinates to the next highest zoom
+    z = tile.z + 1
+    x = tile.x * 2
+    y = tile.y * 2
+
+    x_y_max = int(math.pow(2, z)) - 1
+
+    # see ImageSpec description above for coordinate meaning
+
+    # NOTE: using a row/col scheme to organize the values
+
+    # these are the origin locations where the images will be placed
+    locations = (
+        # first row
+        (0, 0), (2, 0), (258, 0), (514, 0),
+        # second row
+        (0, 2), (2, 2), (258, 2), (514, 2),
+        # third row
+        (0, 258), (2, 258), (258, 258), (514, 258),
+        # fourth row
+        (0, 514), (2, 514), (258, 514), (514, 514),
+    )
+
+    # set the row tiles to account for edge cases
+    tiles = []
+    for y_iter in range(y-1, y+3):
+
+        if y_iter < 0:
+            y_val = 0
+        elif y_iter > x_y_max:
+            y_val = x_y_max
+        else:
+            y_val = y_iter
+
+        for x_iter in range(x-1, x+3):
+
+            x_val = x_iter
+            if x_iter < 0:
+                x_val = x_y_max
+            elif x_iter > x_y_max:
+                x_val = 0
+
+            tiles.append(Tile(z, x_val, y_val))
+
+    assert len(tiles) == 16
+
+    # set the crop bounds for each
+    if y == 0:
+        top_row_crop_bounds = (
+            (254, 0, 256, 2),
+            (0, 0, 256, 2),
+            (0, 0, 256, 2),
+            (0, 0, 2, 2),
+        )
+    else:
+        top_row_crop_bounds = (
+            (254, 254, 256, 256),
+            (0, 254, 256, 256),
+            (0, 254, 256, 256),
+            (0, 254, 2, 256),
+        )
+    mid_rows_crop_bounds = (
+        (254, 0, 256, 256),
+        None,
+        None,
+        (0, 0, 2, 256),
+    )
+    if y+1 == x_y_max:
+        bot_row_crop_bounds = (
+            (254, 254, 256, 256),
+            (0, 254, 256, 256),
+            (0, 254, 256, 256),
+            (0, 254, 2, 256),
+        )
+    else:
+        bot_row_crop_bounds = (
+            (254, 0, 256, 2),
+            (0, 0, 256, 2),
+            (0, 0, 256, 2),
+            (0, 0, 2, 2),
+        )
+
+    all_crop_bounds = (
+        list(top_row_crop_bounds) +
+        list(mid_rows_crop_bounds) +
+        list(mid_rows_crop_bounds) +
+        list(bot_row_crop_bounds))
+
+    for tile, loc, crop_bounds in zip(tiles, locations, all_crop_bounds):
+        tc = TileCoordinates(tile, ImageSpec(loc, crop_bounds))
+        tile_coordinates.append(tc)
+
+    return tile_coordinates
+
 
 class CoordsGeneratorTest(unittest.TestCase):
 
     def test_512(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_512
         tile = Tile(0, 0, 0)
-        all_coords = generate_coordinates_512(tile)
+        all_coords = COORDS_GENERATORS[512](tile)
         just_tile_coords = [x.tile for x in all_coords]
         exp_coords = [
             Tile(1, 0, 0),
@@ -18,10 +286,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(exp_coords, just_tile_coords)
 
     def test_260(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 1, 1)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         just_tile_coords = [x.tile for x in all_coords]
         exp_coords = [
             Tile(2, 0, 0), Tile(2, 1, 0), Tile(2, 2, 0),
@@ -31,10 +299,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(exp_coords, just_tile_coords)
 
     def test_516(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 1, 1)
-        all_coords = generate_coordinates_516(tile)
+        all_coords = COORDS_GENERATORS[516](tile)
         just_tile_coords = [x.tile for x in all_coords]
         exp_coords = [
             Tile(3, 1, 1), Tile(3, 2, 1), Tile(3, 3, 1), Tile(3, 4, 1),
@@ -45,10 +313,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(exp_coords, just_tile_coords)
 
     def test_edge_260_topleft(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 0, 0)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(nw.tile, Tile(2, 3, 0))
         self.assertEqual(n.tile, Tile(2, 0, 0))
@@ -61,10 +329,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(ne.image_spec.crop_bounds, (0, 0, 2, 2))
 
     def test_edge_260_topmid(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 1, 0)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(nw.tile, Tile(2, 0, 0))
         self.assertEqual(n.tile, Tile(2, 1, 0))
@@ -77,10 +345,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(ne.image_spec.crop_bounds, (0, 0, 2, 2))
 
     def test_edge_260_topright(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 3, 0)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(nw.tile, Tile(2, 2, 0))
         self.assertEqual(n.tile, Tile(2, 3, 0))
@@ -93,10 +361,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(ne.image_spec.crop_bounds, (0, 0, 2, 2))
 
     def test_edge_260_botleft(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 0, 3)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(sw.tile, Tile(2, 3, 3))
         self.assertEqual(s.tile, Tile(2, 0, 3))
@@ -109,10 +377,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(se.image_spec.crop_bounds, (0, 254, 2, 256))
 
     def test_edge_260_botmid(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 2, 3)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(sw.tile, Tile(2, 1, 3))
         self.assertEqual(s.tile, Tile(2, 2, 3))
@@ -125,10 +393,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(se.image_spec.crop_bounds, (0, 254, 2, 256))
 
     def test_edge_260_botright(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 3, 3)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(sw.tile, Tile(2, 2, 3))
         self.assertEqual(s.tile, Tile(2, 3, 3))
@@ -141,10 +409,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(se.image_spec.crop_bounds, (0, 254, 2, 256))
 
     def test_edge_260_midleft(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 0, 2)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(w.tile, Tile(2, 3, 2))
         self.assertEqual(c.tile, Tile(2, 0, 2))
@@ -154,10 +422,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(e.image_spec.crop_bounds, (0, 0, 2, 256))
 
     def test_edge_260_midright(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_260
         tile = Tile(2, 3, 1)
-        all_coords = generate_coordinates_260(tile)
+        all_coords = COORDS_GENERATORS[260](tile)
         nw, n, ne, w, c, e, sw, s, se = all_coords
         self.assertEqual(w.tile, Tile(2, 2, 1))
         self.assertEqual(c.tile, Tile(2, 3, 1))
@@ -167,10 +435,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(e.image_spec.crop_bounds, (0, 0, 2, 256))
 
     def test_edge_516_topleft(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 0, 0)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[0].tile, Tile(3, 7, 0))
         self.assertEqual(coords[1].tile, Tile(3, 0, 0))
         self.assertEqual(coords[2].tile, Tile(3, 1, 0))
@@ -185,10 +453,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(coords[3].image_spec.crop_bounds, (0, 0, 2, 2))
 
     def test_edge_516_topmid(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 2, 0)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[0].tile, Tile(3, 3, 0))
         self.assertEqual(coords[1].tile, Tile(3, 4, 0))
         self.assertEqual(coords[2].tile, Tile(3, 5, 0))
@@ -203,10 +471,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(coords[3].image_spec.crop_bounds, (0, 0, 2, 2))
 
     def test_edge_516_topright(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 3, 0)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[0].tile, Tile(3, 5, 0))
         self.assertEqual(coords[1].tile, Tile(3, 6, 0))
         self.assertEqual(coords[2].tile, Tile(3, 7, 0))
@@ -225,10 +493,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(coords[3].image_spec.crop_bounds, (0, 0, 2, 2))
 
     def test_edge_516_midleft(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 0, 3)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[4].tile, Tile(3, 7, 6))
         self.assertEqual(coords[5].tile, Tile(3, 0, 6))
         self.assertEqual(coords[6].tile, Tile(3, 1, 6))
@@ -247,10 +515,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(coords[11].image_spec.crop_bounds, (0, 0, 2, 256))
 
     def test_edge_516_midright(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 3, 2)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[4].tile, Tile(3, 5, 4))
         self.assertEqual(coords[5].tile, Tile(3, 6, 4))
         self.assertEqual(coords[6].tile, Tile(3, 7, 4))
@@ -269,10 +537,10 @@ class CoordsGeneratorTest(unittest.TestCase):
         self.assertEqual(coords[11].image_spec.crop_bounds, (0, 0, 2, 256))
 
     def test_edge_516_botleft(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 0, 3)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[8].tile, Tile(3, 7, 7))
         self.assertEqual(coords[9].tile, Tile(3, 0, 7))
         self.assertEqual(coords[10].tile, Tile(3, 1, 7))
@@ -291,10 +559,10 @@ class CoordsGeneratorTest(unittest.TestCase):
                          (0, 254, 2, 256))
 
     def test_edge_516_botmid(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 1, 3)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[8].tile, Tile(3, 1, 7))
         self.assertEqual(coords[9].tile, Tile(3, 2, 7))
         self.assertEqual(coords[10].tile, Tile(3, 3, 7))
@@ -313,10 +581,10 @@ class CoordsGeneratorTest(unittest.TestCase):
                          (0, 254, 2, 256))
 
     def test_edge_516_botright(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import Tile
-        from zaloa import generate_coordinates_516
         tile = Tile(2, 3, 3)
-        coords = generate_coordinates_516(tile)
+        coords = COORDS_GENERATORS[516](tile)
         self.assertEqual(coords[8].tile, Tile(3, 5, 7))
         self.assertEqual(coords[9].tile, Tile(3, 6, 7))
         self.assertEqual(coords[10].tile, Tile(3, 7, 7))
@@ -335,6 +603,67 @@ class CoordsGeneratorTest(unittest.TestCase):
                          (0, 254, 2, 256))
 
 
+class CoordinatePlannerTest(unittest.TestCase):
+
+    def _generators(self):
+        return {
+            256: generate_coordinates_256,
+            260: generate_coordinates_260,
+            512: generate_coordinates_512,
+            516: generate_coordinates_516,
+        }
+
+    def test_matches_generators(self):
+        from zaloa import COORDS_GENERATORS
+        from zaloa import Tile
+        # every tile in CoordsGeneratorTest, and all tiles at low zooms
+        tiles = [
+            Tile(0, 0, 0), Tile(2, 1, 1), Tile(1, 0, 0), Tile(1, 1, 0),
+            Tile(2, 0, 0), Tile(2, 3, 0), Tile(2, 0, 3), Tile(2, 3, 3),
+            Tile(2, 0, 1), Tile(2, 3, 1), Tile(2, 1, 0), Tile(2, 1, 3),
+            Tile(14, 0, 16383), Tile(14, 16383, 0),
+        ]
+        for z in range(4):
+            for x in range(2 ** z):
+                for y in range(2 ** z):
+                    tiles.append(Tile(z, x, y))
+        for tilesize, generator in self._generators().items():
+            planner = COORDS_GENERATORS[tilesize]
+            self.assertEqual(tilesize, planner.tilesize)
+            for tile in tiles:
+                self.assertEqual(list(generator(tile)), planner(tile),
+                                 '%d %s' % (tilesize, tile))
+
+    def test_templates_memoized(self):
+        from zaloa import CoordinatePlanner
+        from zaloa import Tile
+        planner = CoordinatePlanner(1, 2)
+        first = planner(Tile(3, 2, 3))
+        second = planner(Tile(3, 5, 4))
+        self.assertEqual(1, len(planner._templates))
+        for a, b in zip(first, second):
+            self.assertIs(a.image_spec, b.image_spec)
+
+    def test_other_sizes_cover_the_tile(self):
+        from zaloa import CoordinatePlanner
+        from zaloa import Tile
+        for scale_zoom, buffer in ((0, 1), (0, 4), (2, 0), (2, 4)):
+            planner = CoordinatePlanner(scale_zoom, buffer)
+            for tile in (Tile(0, 0, 0), Tile(3, 0, 0), Tile(3, 4, 5)):
+                area = 0
+                for tile_coords in planner(tile):
+                    x, y = tile_coords.image_spec.location
+                    crop_bounds = tile_coords.image_spec.crop_bounds or \
+                        (0, 0, 256, 256)
+                    width = crop_bounds[2] - crop_bounds[0]
+                    height = crop_bounds[3] - crop_bounds[1]
+                    self.assertLessEqual(x + width, planner.tilesize)
+                    self.assertLessEqual(y + height, planner.tilesize)
+                    self.assertEqual(tile.z + scale_zoom, tile_coords.tile.z)
+                    area += width * height
+                self.assertEqual(planner.tilesize ** 2, area)
+
+
 class S3FetchTest(unittest.TestCase):
 
     def test_success(self):
@@ -412,6 +741,27 @@ class S3FetchTest(unittest.TestCase):
         self.assertFalse(isinstance(cm.exception, MissingTileException))
         self.assertEqual('unknown exception', cm.exception.message)
 
+    def test_server_error(self):
+
+        class StubHttpResponse(object):
+
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+        class StubHttpClient(object):
+
+            def get(self, url):
+                return StubHttpResponse(503)
+
+        from zaloa import HttpTileFetcher
+        from zaloa import OriginErrorException
+        from zaloa import Tile
+        http_tile_fetcher = HttpTileFetcher(StubHttpClient(), 'http://foo')
+        with self.assertRaises(OriginErrorException) as cm:
+            http_tile_fetcher('terrarium', Tile(3, 2, 1))
+        self.assertEqual(503, cm.exception.status)
+        self.assertEqual(Tile(3, 2, 1), cm.exception.tile)
+
 
 class HttpFetchTest(unittest.TestCase):
 
@@ -422,6 +772,7 @@ class HttpFetchTest(unittest.TestCase):
             def __init__(self, status_code, content):
                 self.status_code = status_code
                 self.content = content
+                self.headers = {'ETag': '"abc"'}
 
         class StubHttpClient(object):
 
@@ -437,6 +788,7 @@ class HttpFetchTest(unittest.TestCase):
         from zaloa import Tile
         fetch_result = http_tile_fetcher(tileset, Tile(3, 2, 1))
         self.assertEqual('image data', fetch_result.image_bytes)
+        self.assertEqual('"abc"', fetch_result.etag)
         self.assertEqual(
             'http://foo/terrarium/3/2/1.png', stub_http_client.url)
 
@@ -492,8 +844,8 @@ class HttpFetchTest(unittest.TestCase):
 class ProcessTileTest(unittest.TestCase):
 
     def test_basic_invocation(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import process_tile
-        from zaloa import generate_coordinates_512
         from zaloa import Tile
 
         def stub_fetch(tileset, tile):
@@ -514,7 +866,7 @@ class ProcessTileTest(unittest.TestCase):
         stub_reducer = StubImageReducer()
 
         response, metadata, tiles = process_tile(
-            generate_coordinates_512,
+            COORDS_GENERATORS[512],
             stub_fetch,
             stub_reducer,
             'terrarium',
@@ -535,8 +887,8 @@ class ProcessTileTest(unittest.TestCase):
         return fp.getvalue()
 
     def test_validity_512(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import process_tile
-        from zaloa import generate_coordinates_512
         from zaloa import Tile
 
         def stub_fetch(tileset, tile):
@@ -566,7 +918,7 @@ class ProcessTileTest(unittest.TestCase):
         image_reducer = ImageReducer(512)
 
         image_bytes, metadata, tiles = process_tile(
-            generate_coordinates_512,
+            COORDS_GENERATORS[512],
             stub_fetch,
             image_reducer,
             'terrarium',
@@ -594,9 +946,54 @@ class ProcessTileTest(unittest.TestCase):
                     pixel = im.getpixel((x, y))
                     self.assertEqual(color, pixel)
 
+    def test_validity_1028(self):
+        import threading
+        import time
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import COORDS_GENERATORS
+        from zaloa import FetchResult
+        from zaloa import ImageReducer
+        from zaloa import process_tile
+        from zaloa import Tile
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+
+        def color_for(tile):
+            return tile.x * 20 % 256, tile.y * 20 % 256, 100
+
+        def stub_fetch(tileset, tile):
+            with lock:
+                in_flight.append(tile)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.005)
+            with lock:
+                in_flight.remove(tile)
+            return FetchResult(self._gen_stub_image(color_for(tile)), tile)
+
+        image_bytes, metadata, tile_coords = process_tile(
+            COORDS_GENERATORS[1028], stub_fetch, ImageReducer(1028),
+            'terrarium', Tile(2, 1, 1), max_fetch_concurrency=4)
+
+        self.assertEqual(36, len(tile_coords))
+        self.assertEqual(36, len(max_in_flight))
+        self.assertLessEqual(max(max_in_flight), 4)
+
+        im = Image.open(BytesIO(image_bytes))
+        self.assertEqual((1028, 1028), im.size)
+        for i in range(4):
+            for j in range(4):
+                r, g, b = color_for(Tile(4, 4 + i, 4 + j))
+                pixel = im.getpixel((2 + i * 256 + 128, 2 + j * 256 + 128))
+                self.assertEqual((r, g, b, 255), pixel)
+        # the buffer comes from the neighbours at z4
+        r, g, b = color_for(Tile(4, 3, 3))
+        self.assertEqual((r, g, b, 255), im.getpixel((0, 0)))
+
     def test_validity_260(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import process_tile
-        from zaloa import generate_coordinates_260
         from zaloa import Tile
 
         def stub_fetch(tileset, tile):
@@ -627,7 +1024,7 @@ class ProcessTileTest(unittest.TestCase):
         image_reducer = ImageReducer(260)
 
         image_bytes, metadata, tiles = process_tile(
-            generate_coordinates_260,
+            COORDS_GENERATORS[260],
             stub_fetch,
             image_reducer,
             'terrarium',
@@ -665,8 +1062,8 @@ class ProcessTileTest(unittest.TestCase):
                     self.assertEqual(color, pixel)
 
     def test_validity_516(self):
+        from zaloa import COORDS_GENERATORS
         from zaloa import process_tile
-        from zaloa import generate_coordinates_516
         from zaloa import Tile
 
         def stub_fetch(tileset, tile):
@@ -711,7 +1108,7 @@ class ProcessTileTest(unittest.TestCase):
         image_reducer = ImageReducer(516)
 
         image_bytes, metadata, tiles = process_tile(
-            generate_coordinates_516,
+            COORDS_GENERATORS[516],
             stub_fetch,
             image_reducer,
             'terrarium',
@@ -749,5 +1146,2631 @@ class ProcessTileTest(unittest.TestCase):
                     self.assertEqual(color, pixel)
 
 
+def _run_async(coroutine):
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncFetchTest(unittest.TestCase):
+
+    def test_s3_success(self):
+
+        class StubBody(object):
+
+            async def read(self):
+                return b'image data'
+
+            def close(self):
+                pass
+
+        class StubS3Client(object):
+
+            async def get_object(self, **kwargs):
+                self.kwargs = kwargs
+                return dict(Body=StubBody())
+
+        from zaloa import AsyncS3TileFetcher
+        from zaloa import Tile
+        stub_s3_client = StubS3Client()
+        fetcher = AsyncS3TileFetcher(stub_s3_client, 'fake-bucket')
+        fetch_result = _run_async(fetcher('terrarium', Tile(3, 2, 1)))
+        self.assertEqual(b'image data', fetch_result.image_bytes)
+        self.assertEqual('fake-bucket', stub_s3_client.kwargs['Bucket'])
+        self.assertEqual('terrarium/3/2/1.png', stub_s3_client.kwargs['Key'])
+
+    def test_s3_missing(self):
+
+        class StubS3Exception(Exception):
+
+            def __init__(self, *args, **kwargs):
+                super(StubS3Exception, self).__init__(*args, **kwargs)
+                self.response = dict(Error=dict(Code='NoSuchKey'))
+
+        class StubS3Client(object):
+
+            async def get_object(self, **kwargs):
+                raise StubS3Exception('test missing tile')
+
+        from zaloa import AsyncS3TileFetcher
+        from zaloa import MissingTileException
+        from zaloa import Tile
+        fetcher = AsyncS3TileFetcher(StubS3Client(), 'fake-bucket')
+        with self.assertRaises(MissingTileException) as cm:
+            _run_async(fetcher('terrarium', Tile(3, 2, 1)))
+        self.assertEqual(Tile(3, 2, 1), cm.exception.tile)
+
+    def _stub_http_session(self, status, content):
+
+        class StubHttpResponse(object):
+
+            def __init__(self):
+                self.status = status
+                self.headers = {}
+
+            async def read(self):
+                return content
+
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, exc_type, exc_val, exc_tb):
+                return False
+
+        class StubHttpSession(object):
+
+            def get(self, url):
+                self.url = url
+                return StubHttpResponse()
+
+        return StubHttpSession()
+
+    def test_http_success(self):
+        from zaloa import AsyncHttpTileFetcher
+        from zaloa import Tile
+        stub_session = self._stub_http_session(200, b'image data')
+        fetcher = AsyncHttpTileFetcher(stub_session, 'http://foo')
+        fetch_result = _run_async(fetcher('terrarium', Tile(3, 2, 1)))
+        self.assertEqual(b'image data', fetch_result.image_bytes)
+        self.assertEqual('http://foo/terrarium/3/2/1.png', stub_session.url)
+
+    def test_http_missing(self):
+        from zaloa import AsyncHttpTileFetcher
+        from zaloa import MissingTileException
+        from zaloa import Tile
+        stub_session = self._stub_http_session(404, b'')
+        fetcher = AsyncHttpTileFetcher(stub_session, 'http://foo')
+        with self.assertRaises(MissingTileException):
+            _run_async(fetcher('terrarium', Tile(3, 2, 1)))
+
+    def test_http_server_error(self):
+        from zaloa import AsyncHttpTileFetcher
+        from zaloa import OriginErrorException
+        from zaloa import Tile
+        stub_session = self._stub_http_session(502, b'bad gateway')
+        fetcher = AsyncHttpTileFetcher(stub_session, 'http://foo')
+        with self.assertRaises(OriginErrorException):
+            _run_async(fetcher('terrarium', Tile(3, 2, 1)))
+
+
+class ProcessTileAsyncTest(unittest.TestCase):
+
+    def test_validity_512(self):
+        from zaloa import COORDS_GENERATORS
+        from zaloa import process_tile_async
+        from zaloa import ImageReducer
+        from zaloa import Tile
+        from zaloa import FetchResult
+
+        colors = {
+            Tile(3, 2, 2): (255, 0, 0),
+            Tile(3, 3, 2): (0, 255, 0),
+            Tile(3, 2, 3): (0, 0, 255),
+            Tile(3, 3, 3): (255, 255, 255),
+        }
+
+        async def stub_fetch(tileset, tile):
+            from PIL import Image
+            from io import BytesIO
+            fp = BytesIO()
+            Image.new('RGB', (256, 256), colors[tile]).save(fp, format='PNG')
+            return FetchResult(fp.getvalue(), tile)
+
+        image_bytes, metadata, tiles = _run_async(process_tile_async(
+            COORDS_GENERATORS[512],
+            stub_fetch,
+            ImageReducer(512),
+            'terrarium',
+            Tile(2, 1, 1),
+        ))
+
+        from io import BytesIO
+        from PIL import Image
+        im = Image.open(BytesIO(image_bytes))
+        self.assertEqual((255, 0, 0, 255), im.getpixel((0, 0)))
+        self.assertEqual((0, 255, 0, 255), im.getpixel((511, 0)))
+        self.assertEqual((0, 0, 255, 255), im.getpixel((0, 511)))
+        self.assertEqual((255, 255, 255, 255), im.getpixel((511, 511)))
+        self.assertIn('total', metadata['fetch'])
+        self.assertIn('save', metadata)
+
+    def test_fetch_error(self):
+        from zaloa import COORDS_GENERATORS
+        from zaloa import process_tile_async
+        from zaloa import MissingTileException
+        from zaloa import Tile
+        from zaloa import FetchResult
+
+        async def stub_fetch(tileset, tile):
+            if tile == Tile(2, 0, 0):
+                raise MissingTileException(tile)
+            return FetchResult(b'', tile)
+
+        with self.assertRaises(MissingTileException):
+            _run_async(process_tile_async(
+                COORDS_GENERATORS[260],
+                stub_fetch,
+                None,
+                'terrarium',
+                Tile(2, 1, 1),
+            ))
+
+
+class ParseTilePathTest(unittest.TestCase):
+
+    def test_valid(self):
+        from zaloa import parse_tile_path
+        from zaloa import Tile
+        result = parse_tile_path('/tilezen/terrain/v1/516/normal/3/2/1.png')
+        self.assertIsNone(result.not_found_reason)
+        self.assertEqual('normal', result.tileset)
+        self.assertEqual(516, result.tilesize)
+        self.assertEqual(Tile(3, 2, 1), result.tile)
+
+    def test_default_tilesize(self):
+        from zaloa import parse_tile_path
+        result = parse_tile_path('/tilezen/terrain/v1/terrarium/0/0/0.png')
+        self.assertEqual(256, result.tilesize)
+
+    def test_invalid(self):
+        from zaloa import parse_tile_path
+        for path, reason in (
+                ('/foo', 'Not found'),
+                ('/tilezen/terrain/v1/300/terrarium/0/0/0.png',
+                 'Invalid tilesize'),
+                ('/tilezen/terrain/v1/512/foo/0/0/0.png', 'Invalid tileset'),
+                ('/tilezen/terrain/v1/512/normal/1/2/0.png',
+                 'Invalid tile coordinate'),
+                ('/tilezen/terrain/v1/512/normal/15/0/0.png',
+                 'Invalid zoom'),
+                ('/tilezen/terrain/v1/1024/normal/14/0/0.png',
+                 'Invalid zoom')):
+            self.assertEqual(reason, parse_tile_path(path).not_found_reason)
+
+
+class AsgiAppTest(unittest.TestCase):
+
+    def _request(self, app, path, method='GET', headers=()):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        scope = dict(type='http', method=method, path=path,
+                     headers=list(headers))
+        _run_async(app(scope, None, send))
+        start, body = messages
+        return start['status'], dict(start['headers']), body['body']
+
+    def _make_app(self, **settings):
+        from async_server import create_asgi_app
+        from zaloa import FetchResult
+
+        async def stub_fetch(tileset, tile):
+            from PIL import Image
+            from io import BytesIO
+            fp = BytesIO()
+            Image.new('RGB', (256, 256)).save(fp, format='PNG')
+            return FetchResult(fp.getvalue(), tile)
+
+        app = create_asgi_app(dict(
+            TILES_FETCH_METHOD='http',
+            CORS_SEND_WILDCARD=True,
+            **settings
+        ))
+        app.tile_fetcher = stub_fetch
+        return app
+
+    def test_tile(self):
+        app = self._make_app()
+        status, headers, body = self._request(
+            app, '/tilezen/terrain/v1/260/terrarium/2/1/1.png')
+        self.assertEqual(200, status)
+        self.assertEqual(b'image/png', headers[b'content-type'])
+        self.assertEqual(b'*', headers[b'access-control-allow-origin'])
+        from io import BytesIO
+        from PIL import Image
+        self.assertEqual((260, 260), Image.open(BytesIO(body)).size)
+
+    def test_flask_only_features(self):
+        status, headers, body = self._request(
+            self._make_app(), '/tilezen/terrain/v1/260/terrarium/batch.zip')
+        self.assertEqual(404, status)
+        status, headers, body = self._request(
+            self._make_app(), '/tilezen/terrain/v1/elevation.json',
+            method='POST')
+        self.assertEqual(405, status)
+
+        for settings in (dict(DISK_CACHE_DIR='/tmp/tiles'),
+                         dict(PEERS=['http://a']),
+                         dict(CACHE_TYPE='redis')):
+            with self.assertRaises(AssertionError):
+                self._make_app(**settings)
+        self._make_app(CACHE_TYPE='null', SOURCE_CACHE_SIZE=0)
+
+    def test_output_formats(self):
+        app = self._make_app(NEGOTIATE_OUTPUT_FORMATS=['webp'])
+        status, headers, body = self._request(
+            app, '/tilezen/terrain/v1/260/terrarium/2/1/1.f32')
+        self.assertEqual(200, status)
+        self.assertEqual(b'application/x-elevation-float32',
+                         headers[b'content-type'])
+        self.assertEqual(260 * 260 * 4, len(body))
+        self.assertNotIn(b'vary', headers)
+
+        status, headers, body = self._request(
+            app, '/tilezen/terrain/v1/260/terrarium/2/1/1.png',
+            headers=[(b'accept', b'image/webp,*/*')])
+        self.assertEqual(b'image/webp', headers[b'content-type'])
+        self.assertEqual(b'Accept', headers[b'vary'])
+        status, headers, body = self._request(
+            app, '/tilezen/terrain/v1/260/terrarium/2/1/1.png')
+        self.assertEqual(b'image/png', headers[b'content-type'])
+        self.assertEqual(b'Accept', headers[b'vary'])
+
+    def test_not_found(self):
+        app = self._make_app()
+        status, headers, body = self._request(
+            app, '/tilezen/terrain/v1/260/foo/2/1/1.png')
+        self.assertEqual(404, status)
+        self.assertEqual(b'Invalid tileset', body)
+
+    def test_concurrent_startup(self):
+        import asyncio
+        app = self._make_app()
+        stub_fetch = app.tile_fetcher
+        app.tile_fetcher = None
+        created = []
+
+        async def create_tile_fetcher():
+            created.append(1)
+            # the other requests arrive while the clients are created
+            await asyncio.sleep(0.01)
+            return stub_fetch
+
+        app._create_tile_fetcher = create_tile_fetcher
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = dict(type='http', method='GET', headers=[],
+                     path='/tilezen/terrain/v1/256/terrarium/1/1/1.png')
+
+        async def requests():
+            await asyncio.gather(*[app(scope, None, send) for i in range(4)])
+
+        _run_async(requests())
+        self.assertEqual(1, len(created))
+        self.assertEqual([200] * 4, [
+            message['status'] for message in sent
+            if message['type'] == 'http.response.start'])
+
+    def test_health_check(self):
+        app = self._make_app()
+        status, headers, body = self._request(app, '/health_check', 'HEAD')
+        self.assertEqual(200, status)
+        self.assertEqual(b'', body)
+
+    def test_server_timing(self):
+        app = self._make_app()
+        status, headers, body = self._request(
+            app, '/tilezen/terrain/v1/512/terrarium/2/1/1.png')
+        server_timing = headers[b'server-timing'].decode('ascii')
+        for stage in ('coords-gen', 'fetch', 'process', 'save', 'total'):
+            self.assertIn('%s;dur=' % stage, server_timing)
+        status, headers, body = self._request(app, '/metrics')
+        self.assertEqual(200, status)
+        self.assertIn(b'zaloa_stage_duration_seconds_count{stage="fetch"',
+                      body)
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram_render(self):
+        from metrics import Histogram
+        from metrics import Registry
+        registry = Registry()
+        histogram = Histogram(
+            'test_seconds', 'test', ('stage',), buckets=(0.1, 1.0),
+            registry=registry)
+        histogram.observe(0.05, ('fetch',))
+        histogram.observe(0.5, ('fetch',))
+        histogram.observe(5, ('fetch',))
+        lines = registry.render().splitlines()
+        self.assertIn('test_seconds_bucket{stage="fetch",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{stage="fetch",le="1.0"} 2', lines)
+        self.assertIn('test_seconds_bucket{stage="fetch",le="+Inf"} 3', lines)
+        self.assertIn('test_seconds_count{stage="fetch"} 3', lines)
+
+    def test_format_server_timing(self):
+        from metrics import format_server_timing
+        timing_metadata = {
+            'coords-gen': 0.001,
+            'fetch': {'total': 0.02, '1/0/0': 0.02},
+            'process': {'total': 0.003},
+            'save': 0.0045,
+        }
+        self.assertEqual(
+            'coords-gen;dur=1.000, fetch;dur=20.000, process;dur=3.000, '
+            'save;dur=4.500, total;dur=30.000',
+            format_server_timing(timing_metadata, [('total', 0.03)]))
+
+    def test_instrumented_fetcher_errors(self):
+        from metrics import InstrumentedTileFetcher
+        from metrics import SOURCE_FETCH_ERRORS
+        from metrics import SOURCE_FETCHES_IN_FLIGHT
+        from zaloa import MissingTileException
+        from zaloa import Tile
+
+        def stub_fetch(tileset, tile):
+            raise MissingTileException(tile)
+
+        labels = ('test-backend', 'MissingTileException')
+        before = SOURCE_FETCH_ERRORS.get(labels)
+        fetcher = InstrumentedTileFetcher(stub_fetch, 'test-backend')
+        with self.assertRaises(MissingTileException):
+            fetcher('terrarium', Tile(0, 0, 0))
+        self.assertEqual(before + 1, SOURCE_FETCH_ERRORS.get(labels))
+        self.assertEqual(0, SOURCE_FETCHES_IN_FLIGHT.get(('test-backend',)))
+
+
+class TracingTest(unittest.TestCase):
+
+    def _stub_fetch(self, tileset, tile):
+        from zaloa import FetchResult
+        return FetchResult(b'', tile)
+
+    def _stub_reducer(self):
+
+        class StubImageReducer(object):
+
+            def create_initial_state(self):
+                return None
+
+            def reduce(self, image_state, image_input):
+                pass
+
+            def finalize(self, image_state):
+                return b'combined image data'
+
+        return StubImageReducer()
+
+    def test_duplicate_tiles_timed_separately(self):
+        from zaloa import COORDS_GENERATORS
+        from zaloa import process_tile
+        from zaloa import Tile
+        # the top row is repeated for tiles on the top edge
+        response, metadata, tiles = process_tile(
+            COORDS_GENERATORS[260], self._stub_fetch, self._stub_reducer(),
+            'terrarium', Tile(2, 1, 0))
+        self.assertEqual(10, len(metadata['fetch']))
+        self.assertEqual(10, len(metadata['process']))
+
+    def test_spans(self):
+        from zaloa import COORDS_GENERATORS
+        from tracing import Tracer
+        from zaloa import process_tile
+        from zaloa import Tile
+        tracer = Tracer('test')
+        with tracer.span('handle_tile'):
+            process_tile(
+                COORDS_GENERATORS[516], self._stub_fetch,
+                self._stub_reducer(), 'terrarium', Tile(2, 1, 1), tracer)
+        trace = tracer.as_dict()
+        spans_by_id = dict((span['id'], span) for span in trace['spans'])
+        fetch_tile_spans = [span for span in trace['spans']
+                            if span['name'] == 'fetch-tile']
+        self.assertEqual(16, len(fetch_tile_spans))
+        self.assertEqual(
+            list(range(16)),
+            sorted(span['attrs']['index'] for span in fetch_tile_spans))
+        for span in fetch_tile_spans:
+            parent = spans_by_id[span['parent']]
+            self.assertEqual('fetch', parent['name'])
+            self.assertNotEqual(parent['thread'], span['thread'])
+        root, = [span for span in trace['spans'] if span['parent'] is None]
+        self.assertEqual('handle_tile', root['name'])
+        for name in ('coords-gen', 'fetch', 'process', 'save'):
+            span, = [span for span in trace['spans'] if span['name'] == name]
+            self.assertEqual(root['id'], span['parent'])
+
+    def test_critical_path(self):
+        from analyze_traces import critical_path
+
+        def span(span_id, parent, name, duration):
+            return dict(id=span_id, parent=parent, name=name,
+                        duration=duration, attrs={})
+
+        trace = dict(spans=[
+            span(1, None, 'handle_tile', 1.0),
+            span(2, 1, 'fetch', 0.5),
+            span(3, 2, 'fetch-tile', 0.2),
+            span(4, 2, 'fetch-tile', 0.4),
+            span(5, 1, 'save', 0.25),
+        ])
+        path = dict(critical_path(trace))
+        self.assertAlmostEqual(0.4, path['fetch:slowest-source'])
+        self.assertAlmostEqual(0.1, path['fetch:fan-out'])
+        self.assertAlmostEqual(0.25, path['save'])
+        self.assertAlmostEqual(0.25, path['other'])
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def test_make_profiler(self):
+        from profiling import make_profiler
+        from profiling import NULL_PROFILER
+        config = dict(PROFILE_TOKEN='secret', PROFILE_SAMPLE_RATE=0)
+        self.assertIs(NULL_PROFILER, make_profiler(config, {}))
+        self.assertIs(NULL_PROFILER, make_profiler(
+            config, {'X-Zaloa-Profile': 'wrong'}))
+        self.assertIsNot(NULL_PROFILER, make_profiler(
+            config, {'X-Zaloa-Profile': 'secret'}))
+        self.assertIs(NULL_PROFILER, make_profiler(
+            dict(PROFILE_TOKEN=None), {'X-Zaloa-Profile': ''}))
+        self.assertIsNot(NULL_PROFILER, make_profiler(
+            dict(PROFILE_SAMPLE_RATE=1.0), {}))
+
+    def test_profile_reducer(self):
+        from profiling import RequestProfiler
+        from zaloa import ImageReducer
+        from zaloa import ImageInput
+        from zaloa import Tile
+        from PIL import Image
+        from io import BytesIO
+        fp = BytesIO()
+        Image.new('RGB', (256, 256), (1, 2, 3)).save(fp, format='PNG')
+        image_reducer = ImageReducer(256)
+        with RequestProfiler() as profiler:
+            image_state = image_reducer.create_initial_state()
+            image_reducer.reduce(image_state, ImageInput(
+                fp.getvalue(), img_pos(0, 0), Tile(0, 0, 0)))
+            image_reducer.finalize(image_state)
+        self.assertTrue(profiler.enabled)
+        self.assertGreater(profiler.peak_memory, 0)
+        summary = profiler.compact_summary()
+        self.assertTrue(summary.startswith('wall='))
+        self.assertIn('peak_alloc=', summary)
+
+    def test_one_profile_at_a_time(self):
+        from profiling import RequestProfiler
+        with RequestProfiler() as outer:
+            with RequestProfiler() as inner:
+                pass
+        self.assertTrue(outer.enabled)
+        self.assertFalse(inner.enabled)
+        with RequestProfiler() as again:
+            pass
+        self.assertTrue(again.enabled)
+
+    def test_failed_start_releases_lock(self):
+        import logging
+        import tracemalloc
+        from profiling import RequestProfiler
+
+        class FailingProfile(object):
+
+            def enable(self):
+                raise ValueError('Another profiling tool is already active')
+
+        failing = RequestProfiler()
+        failing.profile = FailingProfile()
+        logging.getLogger('zaloa.profiling').disabled = True
+        try:
+            with failing:
+                pass
+        finally:
+            logging.getLogger('zaloa.profiling').disabled = False
+        self.assertFalse(failing.enabled)
+        self.assertFalse(tracemalloc.is_tracing())
+        with RequestProfiler() as after:
+            pass
+        self.assertTrue(after.enabled)
+
+
+class BenchCompareTest(unittest.TestCase):
+
+    def test_compare(self):
+        from bench import compare
+
+        def results(**timings):
+            return dict(benchmarks=dict(
+                (name.replace('_', '/'), dict(min=timing))
+                for name, timing in timings.items()))
+
+        baseline = results(coords_260=1.0, finalize_512=1.0)
+        current = results(coords_260=1.1, finalize_512=1.5, reduce_full=1.0)
+        lines, regressions = compare(current, baseline, 0.2)
+        self.assertEqual(['finalize/512'], regressions)
+        self.assertEqual(3, len(lines))
+
+    def test_synthetic_tile(self):
+        from bench import synthetic_terrarium_tile
+        from zaloa import Tile
+        from PIL import Image
+        from io import BytesIO
+        image = Image.open(BytesIO(synthetic_terrarium_tile(Tile(1, 0, 0))))
+        self.assertEqual('RGB', image.mode)
+        self.assertEqual((256, 256), image.size)
+
+
+class CacheSimTest(unittest.TestCase):
+
+    def test_lru_matches_simulation(self):
+        import random
+        from cache_sim import lru_hit_ratios
+        from zaloa import LRUCache
+        rng = random.Random(0)
+        trace = [int(rng.paretovariate(1.0) * 3) % 500 for i in range(5000)]
+        sizes = (1, 10, 100)
+        hit_ratios = lru_hit_ratios(trace, sizes)
+        for size in sizes:
+            cache = LRUCache(size)
+            hits = 0
+            for key in trace:
+                if cache.get(key) is not None:
+                    hits += 1
+                cache.put(key, True)
+            self.assertAlmostEqual(hits / float(len(trace)), hit_ratios[size])
+
+    def test_lfu_keeps_frequent_keys(self):
+        from cache_sim import lfu_hit_ratio
+        from cache_sim import lru_hit_ratios
+        # a scan of one-off keys between the accesses to a hot key, which
+        # is counted while it is cached
+        trace = [0, 0]
+        for i in range(100):
+            trace.extend([0, 1000 + i * 2, 1001 + i * 2])
+        self.assertAlmostEqual(101 / 302.0, lfu_hit_ratio(trace, 2))
+        self.assertAlmostEqual(2 / 302.0, lru_hit_ratios(trace, (2,))[2])
+
+    def test_build_traces(self):
+        from cache_sim import build_traces
+        from cache_sim import read_tile_requests
+        import os
+        import tempfile
+        lines = [
+            '1.2.3.4 "GET /tilezen/terrain/v1/260/terrarium/10/163/395.png'
+            '?api_key=x HTTP/1.1" 200',
+            '1.2.3.4 "GET /tilezen/terrain/v1/260/terrarium/10/163/395.png '
+            'HTTP/1.1" 200',
+            '1.2.3.4 "GET /tilezen/terrain/v1/999/terrarium/1/0/0.png" 404',
+            '1.2.3.4 "GET /health_check HTTP/1.1" 200',
+            '1.2.3.4 "GET /tilezen/terrain/v1/normal/3/2/1.png" 200',
+        ]
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write('\n'.join(lines) + '\n')
+            output_trace, source_trace = build_traces(
+                read_tile_requests([path]))
+            cached_output_trace, cached_source_trace = build_traces(
+                read_tile_requests([path]), output_cache_size=1)
+        finally:
+            os.unlink(path)
+        self.assertEqual([0, 0, 1], list(output_trace))
+        # the 260 needs 9 sources, twice, and the 256 just one
+        self.assertEqual(19, len(source_trace))
+        self.assertEqual(list(output_trace), list(cached_output_trace))
+        self.assertEqual(10, len(cached_source_trace))
+
+    def test_warm(self):
+        from cache_sim import warm
+
+        class StubResponse(object):
+
+            def __init__(self, status_code):
+                self.status_code = status_code
+
+            def get_data(self):
+                return b''
+
+        class StubApp(object):
+
+            def __init__(self, **extensions):
+                self.config = dict(CACHE_TYPE='null')
+                self.extensions = dict(zaloa=dict(
+                    dict(disk_cache=None, output_store=None,
+                         output_store_writer=None), **extensions))
+                self.requested = []
+
+            def test_client(self):
+                return self
+
+            def get(self, path):
+                self.requested.append(path)
+                return StubResponse(404 if 'missing' in path else 200)
+
+        with self.assertRaises(ValueError):
+            warm(['/a.png'], app=StubApp())
+        # the disk cache alone is worth warming
+        app = StubApp(disk_cache=object())
+        self.assertEqual(['/missing.png'], warm(
+            ['/a.png', '/missing.png'], workers=1, app=app))
+        self.assertEqual(['/a.png', '/missing.png'], app.requested)
+
+
+class FakeOriginsTest(unittest.TestCase):
+
+    def test_fake_s3(self):
+        from fake_origins import FakeS3Client
+        from fake_origins import LatencyModel
+        from zaloa import MissingTileException
+        from zaloa import S3TileFetcher
+        from zaloa import Tile
+        fetcher = S3TileFetcher(FakeS3Client(), 'fake-bucket')
+        fetch_result = fetcher('terrarium', Tile(3, 2, 1))
+        self.assertTrue(fetch_result.image_bytes.startswith(b'\x89PNG'))
+
+        missing = S3TileFetcher(
+            FakeS3Client(latency=LatencyModel(missing_rate=1.0)),
+            'fake-bucket')
+        with self.assertRaises(MissingTileException):
+            missing('terrarium', Tile(3, 2, 1))
+
+        failing = S3TileFetcher(
+            FakeS3Client(latency=LatencyModel(error_rate=1.0)),
+            'fake-bucket')
+        with self.assertRaises(Exception) as cm:
+            failing('terrarium', Tile(3, 2, 1))
+        self.assertFalse(isinstance(cm.exception, MissingTileException))
+
+    def test_fake_http(self):
+        import requests
+        from fake_origins import FakeHttpOrigin
+        from fake_origins import LatencyModel
+        from zaloa import HttpTileFetcher
+        from zaloa import MissingTileException
+        from zaloa import Tile
+        with FakeHttpOrigin(latency=LatencyModel('uniform:1:2')) as origin:
+            fetcher = HttpTileFetcher(requests, origin.url_prefix)
+            fetch_result = fetcher('normal', Tile(3, 2, 1))
+            self.assertTrue(fetch_result.image_bytes.startswith(b'\x89PNG'))
+        with FakeHttpOrigin(latency=LatencyModel(missing_rate=1.0)) as origin:
+            fetcher = HttpTileFetcher(requests, origin.url_prefix)
+            with self.assertRaises(MissingTileException):
+                fetcher('normal', Tile(3, 2, 1))
+
+    def test_pan_zoom_session(self):
+        import random
+        from loadtest import pan_zoom_session
+        from zaloa import parse_tile_path
+        for tilesize in (256, 260, 512, 516):
+            paths = pan_zoom_session(random.Random(tilesize), tilesize, 50)
+            self.assertTrue(paths)
+            for path in paths:
+                parse_result = parse_tile_path(path)
+                self.assertIsNone(parse_result.not_found_reason, path)
+                self.assertEqual(tilesize, parse_result.tilesize)
+
+    def test_run_isolated_reports_failures(self):
+        from loadtest import run_isolated
+        # the latency model fails to parse in the process, which exits
+        # without a result
+        with self.assertRaises(RuntimeError):
+            run_isolated('s3', 256, ('bogus', 0.0, 0.0, 0), 1, 0.1, 0,
+                         poll_interval=0.1)
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_caching_tile_fetcher(self):
+        from zaloa import CachingTileFetcher
+        from zaloa import FetchResult
+        from zaloa import MissingTileException
+        from zaloa import Tile
+        fetched = []
+        lookups = []
+
+        def tile_fetcher(tileset, tile):
+            fetched.append((tileset, tile))
+            if tile.z == 5:
+                raise MissingTileException(tile)
+            return FetchResult(b'tile', tile)
+
+        fetcher = CachingTileFetcher(tile_fetcher, 2, lookups.append)
+        fetcher('terrarium', Tile(0, 0, 0))
+        fetcher('terrarium', Tile(0, 0, 0))
+        fetcher('normal', Tile(0, 0, 0))
+        self.assertEqual(2, len(fetched))
+        self.assertEqual([False, True, False], lookups)
+
+        # evicts the least recently used
+        fetcher('terrarium', Tile(1, 0, 0))
+        fetcher('terrarium', Tile(0, 0, 0))
+        self.assertEqual(4, len(fetched))
+
+        for i in range(2):
+            with self.assertRaises(MissingTileException):
+                fetcher('terrarium', Tile(5, 0, 0))
+        self.assertEqual(6, len(fetched))
+
+    def test_prewarm_source_tiles(self):
+        from startup import prewarm_source_tiles
+        from zaloa import FetchResult
+        from zaloa import MissingTileException
+        fetched = set()
+
+        def tile_fetcher(tileset, tile):
+            if tile.x == 3:
+                raise MissingTileException(tile)
+            fetched.add((tileset, tile))
+            return FetchResult(b'tile', tile)
+
+        num_fetched = prewarm_source_tiles(
+            tile_fetcher, ('terrarium', 'normal'), 2)
+        # 1 + 4 + 16 tiles per tileset, less the 4 with x == 3
+        self.assertEqual(2 * 17, num_fetched)
+        self.assertEqual(2 * 17, len(fetched))
+
+
+class OutputMemoTest(unittest.TestCase):
+
+    def _png(self, color, noisy=False):
+        from io import BytesIO
+        from PIL import Image
+        image = Image.new('RGB', (256, 256), color)
+        if noisy:
+            image.putdata([(x % 256, y % 256, (x * y) % 256)
+                           for y in range(256) for x in range(256)])
+        fp = BytesIO()
+        image.save(fp, format='PNG')
+        return fp.getvalue()
+
+    def _process(self, image_bytes, tile, output_memo):
+        from zaloa import COORDS_GENERATORS
+        from zaloa import FetchResult
+        from zaloa import ImageReducer
+        from zaloa import process_tile
+        reduced = []
+
+        class CountingReducer(ImageReducer):
+            def reduce(self, image_state, image_input):
+                reduced.append(image_input.tile)
+                super(CountingReducer, self).reduce(image_state, image_input)
+
+        def stub_fetch(tileset, tile):
+            return FetchResult(image_bytes, tile)
+
+        output, timing_metadata, tile_coords = process_tile(
+            COORDS_GENERATORS[516], stub_fetch, CountingReducer(516),
+            'terrarium', tile, output_memo=output_memo)
+        return output, len(reduced)
+
+    def test_identical_sources(self):
+        from zaloa import OutputMemo
+        from zaloa import Tile
+        lookups = []
+        output_memo = OutputMemo(10, lookups.append)
+        image_bytes = self._png(None, noisy=True)
+        expected, num_reduced = self._process(
+            image_bytes, Tile(3, 2, 2), None)
+        self.assertEqual(16, num_reduced)
+
+        output, num_reduced = self._process(
+            image_bytes, Tile(3, 2, 2), output_memo)
+        self.assertEqual(expected, output)
+        self.assertEqual(16, num_reduced)
+        output, num_reduced = self._process(
+            image_bytes, Tile(3, 5, 1), output_memo)
+        self.assertEqual(expected, output)
+        self.assertEqual(0, num_reduced)
+        self.assertEqual([False, True], lookups)
+
+    def test_uniform_sources(self):
+        from zaloa import OutputMemo
+        from zaloa import Tile
+        ocean = self._png((128, 10, 20))
+        expected, num_reduced = self._process(ocean, Tile(3, 2, 2), None)
+        output, num_reduced = self._process(
+            ocean, Tile(3, 2, 2), OutputMemo(10))
+        self.assertEqual(0, num_reduced)
+        self.assertEqual(expected, output)
+
+    def test_key_independent_of_order(self):
+        from zaloa import ImageInput
+        from zaloa import ImageReducer
+        from zaloa import OutputMemo
+        from zaloa import Tile
+        image_inputs = [
+            ImageInput(b'a', img_pos(0, 0), Tile(1, 0, 0)),
+            ImageInput(b'b', img_pos(256, 0), Tile(1, 1, 0)),
+        ]
+        output_memo = OutputMemo(10)
+        self.assertEqual(
+            output_memo.key(ImageReducer(512), image_inputs),
+            output_memo.key(ImageReducer(512), image_inputs[::-1]))
+        self.assertNotEqual(
+            output_memo.key(ImageReducer(512), image_inputs),
+            output_memo.key(ImageReducer(1024), image_inputs))
+
+    def test_key_of_derived_normals(self):
+        from zaloa import ImageInput
+        from zaloa import ImageReducer
+        from zaloa import NormalReducer
+        from zaloa import OutputMemo
+        from zaloa import Tile
+        image_inputs = [ImageInput(b'a', img_pos(0, 0), Tile(1, 0, 0))]
+        output_memo = OutputMemo(10)
+
+        def key(image_reducer):
+            return output_memo.key(image_reducer, image_inputs)
+
+        # the normals depend on the latitude, ie the zoom and row
+        self.assertEqual(key(NormalReducer(256, Tile(3, 1, 2))),
+                         key(NormalReducer(256, Tile(3, 5, 2))))
+        self.assertNotEqual(key(NormalReducer(256, Tile(3, 1, 2))),
+                            key(NormalReducer(256, Tile(3, 1, 3))))
+        self.assertNotEqual(key(NormalReducer(256, Tile(3, 1, 2))),
+                            key(NormalReducer(256, Tile(4, 1, 2))))
+        self.assertNotEqual(key(NormalReducer(256, Tile(3, 1, 2))),
+                            key(ImageReducer(256, mode='RGB')))
+
+
+class ImageReducerModeTest(unittest.TestCase):
+
+    def _png(self, mode, color):
+        from io import BytesIO
+        from PIL import Image
+        fp = BytesIO()
+        image = Image.new(mode, (256, 256), color)
+        image.putpixel((0, 0), (0,) * len(color))
+        image.save(fp, format='PNG')
+        return fp.getvalue()
+
+    def _reduce(self, image_reducer, sources):
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import ImageInput
+        from zaloa import Tile
+        image_state = image_reducer.create_initial_state()
+        for i, image_bytes in enumerate(sources):
+            image_reducer.reduce(image_state, ImageInput(
+                image_bytes, img_pos(i * 256, 0), Tile(1, i, 0)))
+        return Image.open(BytesIO(image_reducer.finalize(image_state)))
+
+    def test_fixed_mode(self):
+        from zaloa import ImageReducer
+        rgb = self._png('RGB', (1, 2, 3))
+        output = self._reduce(ImageReducer(512, mode='RGB'), [rgb, rgb])
+        self.assertEqual('RGB', output.mode)
+        self.assertEqual((1, 2, 3), output.getpixel((300, 10)))
+        output = self._reduce(ImageReducer(512), [rgb, rgb])
+        self.assertEqual('RGBA', output.mode)
+
+    def test_auto_mode(self):
+        from zaloa import ImageReducer
+        rgb = self._png('RGB', (1, 2, 3))
+        rgba = self._png('RGBA', (1, 2, 3, 4))
+        output = self._reduce(ImageReducer(512, mode=None), [rgb, rgb])
+        self.assertEqual('RGB', output.mode)
+        output = self._reduce(ImageReducer(512, mode=None), [rgb, rgba])
+        self.assertEqual('RGBA', output.mode)
+        self.assertEqual((1, 2, 3, 4), output.getpixel((300, 10)))
+
+    def test_uniform_color_in_mode(self):
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import ImageReducer
+        uniform = Image.new('RGB', (256, 256), (9, 8, 7))
+        fp = BytesIO()
+        uniform.save(fp, format='PNG')
+        self.assertEqual((9, 8, 7), ImageReducer(
+            256, mode=None).uniform_color(fp.getvalue()))
+        self.assertEqual((9, 8, 7, 255), ImageReducer(
+            256).uniform_color(fp.getvalue()))
+        self.assertIsNone(ImageReducer(256).uniform_color(
+            self._png('RGB', (1, 2, 3))))
+
+    def test_tileset_output_mode(self):
+        from zaloa import tileset_output_mode
+        modes = dict(terrarium='RGB', normal='auto')
+        self.assertEqual('RGB', tileset_output_mode(modes, 'terrarium'))
+        self.assertIsNone(tileset_output_mode(modes, 'normal'))
+        self.assertIsNone(tileset_output_mode(None, 'terrarium'))
+
+
+class OutputFormatTest(unittest.TestCase):
+
+    def _reduce(self, output_format, color=(128, 10, 64)):
+        from PIL import Image
+        from io import BytesIO
+        from zaloa import ImageInput
+        from zaloa import ImageReducer
+        from zaloa import Tile
+        fp = BytesIO()
+        Image.new('RGB', (256, 256), color).save(fp, format='PNG')
+        image_reducer = ImageReducer(
+            256, mode='RGB', output_format=output_format)
+        image_state = image_reducer.create_initial_state()
+        image_reducer.reduce(image_state, ImageInput(
+            fp.getvalue(), img_pos(0, 0), Tile(0, 0, 0)))
+        return image_reducer.finalize(image_state)
+
+    def test_webp(self):
+        from io import BytesIO
+        from PIL import Image
+        image = Image.open(BytesIO(self._reduce('webp')))
+        self.assertEqual('WEBP', image.format)
+        self.assertEqual((128, 10, 64), image.convert('RGB').getpixel((5, 5)))
+
+    def test_float32(self):
+        import struct
+        image_bytes = self._reduce('f32')
+        self.assertEqual(256 * 256 * 4, len(image_bytes))
+        elevation, = struct.unpack('<f', image_bytes[:4])
+        self.assertEqual(128 * 256 + 10 + 64 / 256.0 - 32768, elevation)
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            self._reduce('gif')
+
+    def test_parse(self):
+        from zaloa import parse_tile_path
+        for path, output_format, reason in (
+                ('/tilezen/terrain/v1/512/normal/3/2/1.webp', 'webp', None),
+                ('/tilezen/terrain/v1/terrarium/3/2/1.f32', 'f32', None),
+                ('/tilezen/terrain/v1/normal/3/2/1.f32', None,
+                 'Invalid format'),
+                ('/tilezen/terrain/v1/normal/3/2/1.jpg', None,
+                 'Invalid format')):
+            result = parse_tile_path(path)
+            self.assertEqual(reason, result.not_found_reason)
+            self.assertEqual(output_format, result.output_format)
+
+    def test_negotiate(self):
+        from zaloa import negotiate_output_format
+        formats = ['webp', 'f32']
+        for accept, tileset, expected in (
+                (None, 'terrarium', 'png'),
+                ('*/*', 'terrarium', 'png'),
+                ('image/webp,*/*', 'terrarium', 'webp'),
+                ('image/png,image/webp;q=0.8', 'terrarium', 'png'),
+                ('image/webp;q=0.5,image/*;q=0.9', 'terrarium', 'png'),
+                ('application/x-elevation-float32', 'terrarium', 'f32'),
+                ('application/x-elevation-float32', 'normal', 'png'),
+                ('image/webp;q=0', 'terrarium', 'png')):
+            self.assertEqual(
+                expected, negotiate_output_format(accept, formats, tileset),
+                accept)
+        self.assertEqual(
+            'png', negotiate_output_format('image/webp', ['f32'], 'normal'))
+
+
+class CanvasPoolTest(unittest.TestCase):
+
+    def test_reuse(self):
+        from zaloa import CanvasPool
+        events = []
+        canvas_pool = CanvasPool(1, events.append)
+        first = canvas_pool.acquire_canvas('RGBA', (260, 260))
+        second = canvas_pool.acquire_canvas('RGBA', (260, 260))
+        first.paste((255, 0, 0, 255), (0, 0, 10, 10))
+        canvas_pool.release_canvas(first)
+        canvas_pool.release_canvas(second)
+        self.assertEqual(['created', 'created', 'returned', 'discarded'],
+                         events)
+
+        self.assertIsNot(
+            first, canvas_pool.acquire_canvas('RGBA', (516, 516)))
+        reused = canvas_pool.acquire_canvas('RGBA', (260, 260))
+        self.assertIs(first, reused)
+        self.assertEqual((0, 0, 0, 0), reused.getpixel((5, 5)))
+        self.assertEqual(
+            dict(created=3, reused=1, returned=1, discarded=1, idle=0),
+            canvas_pool.stats())
+
+    def test_pooled_outputs_match(self):
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import CanvasPool
+        from zaloa import COORDS_GENERATORS
+        from zaloa import FetchResult
+        from zaloa import ImageReducer
+        from zaloa import process_tile
+        from zaloa import Tile
+
+        def stub_fetch(tileset, tile):
+            image = Image.new('RGB', (256, 256), (tile.x * 30, tile.y * 30, 7))
+            fp = BytesIO()
+            image.save(fp, format='PNG')
+            return FetchResult(fp.getvalue(), tile)
+
+        canvas_pool = CanvasPool(2)
+        for tile in (Tile(2, 1, 1), Tile(2, 3, 0), Tile(2, 1, 1)):
+            expected = process_tile(
+                COORDS_GENERATORS[516], stub_fetch, ImageReducer(516),
+                'normal', tile)[0]
+            pooled = process_tile(
+                COORDS_GENERATORS[516], stub_fetch,
+                ImageReducer(516, canvas_pool), 'normal', tile)[0]
+            self.assertEqual(expected, pooled)
+        self.assertEqual(2, canvas_pool.stats()['reused'])
+
+    def test_buffers_per_tilesize(self):
+        from zaloa import CanvasPool
+        canvas_pool = CanvasPool(1)
+        large = canvas_pool.acquire_buffer(1028)
+        large.write(b'x' * 4096)
+        canvas_pool.release_buffer(large, 1028)
+        self.assertIsNot(large, canvas_pool.acquire_buffer(256))
+        self.assertIs(large, canvas_pool.acquire_buffer(1028))
+        self.assertEqual(0, large.tell())
+
+    def test_released_when_encode_fails(self):
+        from zaloa import CanvasPool
+        from zaloa import ImageReducer
+
+        class FailingReducer(ImageReducer):
+            def encode(self, image, fp):
+                raise IOError('encode failed')
+
+        canvas_pool = CanvasPool(1)
+        image_reducer = FailingReducer(256, canvas_pool)
+        image_state = image_reducer.create_initial_state()
+        with self.assertRaises(IOError):
+            image_reducer.finalize(image_state)
+        self.assertEqual(1, canvas_pool.stats()['returned'])
+        self.assertEqual(1, len(canvas_pool.buffers[256]))
+
+
+class StreamingPngTest(unittest.TestCase):
+
+    def test_same_bytes_as_save(self):
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import iter_png_chunks
+        for mode in ('RGB', 'RGBA'):
+            image = Image.new(mode, (1028, 1028))
+            image.putdata([(x % 256, y % 256, (x * y) % 256, 255)[:len(mode)]
+                           for y in range(1028) for x in range(1028)])
+            fp = BytesIO()
+            image.save(fp, format='PNG')
+            chunks = list(iter_png_chunks(image))
+            self.assertEqual(fp.getvalue(), b''.join(chunks))
+            # the header goes out before any row is compressed
+            self.assertEqual(33, len(chunks[0]))
+
+            chunks = list(iter_png_chunks(image, idat_size=4096))
+            self.assertGreater(len(chunks), 20)
+            decoded = Image.open(BytesIO(b''.join(chunks)))
+            self.assertEqual(image.tobytes(), decoded.tobytes())
+
+    def test_process_tile_stream(self):
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import CanvasPool
+        from zaloa import COORDS_GENERATORS
+        from zaloa import FetchResult
+        from zaloa import ImageReducer
+        from zaloa import OutputMemo
+        from zaloa import process_tile
+        from zaloa import Tile
+
+        def stub_fetch(tileset, tile):
+            image = Image.new('RGB', (256, 256), (tile.x * 30, tile.y * 30, 7))
+            fp = BytesIO()
+            image.save(fp, format='PNG')
+            return FetchResult(fp.getvalue(), tile)
+
+        expected = process_tile(
+            COORDS_GENERATORS[516], stub_fetch, ImageReducer(516),
+            'normal', Tile(2, 1, 1))[0]
+        canvas_pool = CanvasPool(1)
+        lookups = []
+        output_memo = OutputMemo(1, lookups.append)
+        saves = []
+        for i in range(2):
+            chunks, timing_metadata, tile_coords = process_tile(
+                COORDS_GENERATORS[516], stub_fetch,
+                ImageReducer(516, canvas_pool), 'normal', Tile(2, 1, 1),
+                output_memo=output_memo, stream=True)
+            # nothing is encoded until the chunks are taken
+            self.assertNotIn('save', timing_metadata)
+            self.assertEqual(expected, b''.join(chunks))
+            saves.append('save' in timing_metadata)
+        self.assertEqual([True, False], saves)
+        self.assertEqual([False, True], lookups)
+        self.assertEqual(1, canvas_pool.stats()['idle'])
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def test_tile_move(self):
+        from prefetch import tile_move
+        from zaloa import Tile
+        self.assertEqual((1, 0), tile_move(Tile(3, 2, 2), Tile(3, 3, 2)))
+        self.assertEqual((-1, 1), tile_move(Tile(3, 0, 2), Tile(3, 7, 3)))
+        self.assertEqual('in', tile_move(Tile(3, 2, 2), Tile(4, 5, 4)))
+        self.assertEqual('out', tile_move(Tile(4, 5, 4), Tile(3, 2, 2)))
+        self.assertIsNone(tile_move(Tile(3, 2, 2), Tile(3, 5, 2)))
+        self.assertIsNone(tile_move(Tile(3, 2, 2), Tile(4, 0, 0)))
+        self.assertIsNone(tile_move(None, Tile(3, 2, 2)))
+
+    def test_model_predict(self):
+        from prefetch import PanZoomModel
+        from zaloa import Tile
+        model = PanZoomModel()
+        self.assertEqual(
+            [Tile(3, 3, 2), Tile(3, 1, 2), Tile(3, 2, 3), Tile(3, 2, 1)],
+            model.predict(Tile(3, 2, 2), 10))
+        self.assertEqual(
+            [Tile(1, 0, 0), Tile(1, 1, 1)],
+            model.predict(Tile(1, 1, 0), 10))
+
+        for tile in (Tile(2, 1, 1), Tile(3, 2, 2), Tile(4, 5, 4)):
+            model.observe(tile)
+        self.assertEqual(
+            [Tile(5, 10, 8), Tile(5, 11, 8), Tile(5, 10, 9)],
+            model.predict(Tile(4, 5, 4), 3))
+
+    def _make_prefetcher(self, **kwargs):
+        from prefetch import NeighborPrefetcher
+        from zaloa import CachingTileFetcher
+        from zaloa import COORDS_GENERATORS
+        from zaloa import FetchResult
+        fetched = []
+        events = []
+
+        def stub_fetch(tileset, tile):
+            fetched.append(tile)
+            return FetchResult(b'', tile)
+
+        prefetcher = NeighborPrefetcher(
+            CachingTileFetcher(stub_fetch, 100), COORDS_GENERATORS,
+            on_event=events.append, **kwargs)
+        return prefetcher, fetched, events
+
+    def test_prefetch_used(self):
+        from zaloa import Tile
+        prefetcher, fetched, events = self._make_prefetcher(max_tiles=4)
+        prefetcher('terrarium', Tile(3, 2, 2))
+        prefetcher.observe(512, 'terrarium', Tile(2, 1, 1))
+        self.assertEqual(4, len(prefetcher.queued))
+        key = prefetcher.take()
+        while key is not None:
+            prefetcher.prefetch(key)
+            key = prefetcher.take()
+        self.assertEqual(5, len(fetched))
+
+        # the 516 sibling shares the 512 sources, and adds the ring around
+        prefetcher('terrarium', Tile(3, 1, 1))
+        prefetcher('terrarium', Tile(3, 2, 2))
+        self.assertEqual(5, len(fetched))
+        self.assertEqual(['queued'] * 4 + ['fetched'] * 4 + ['used'], events)
+
+    def test_observe_at_max_zoom(self):
+        from zaloa import Tile
+        prefetcher, fetched, events = self._make_prefetcher(max_tiles=64)
+        # zooming in, then at the highest zoom of the 512s, whose children
+        # have no sources
+        prefetcher.observe(512, 'terrarium', Tile(13, 10, 10))
+        prefetcher.observe(512, 'terrarium', Tile(14, 20, 20))
+        prefetcher.observe(1024, 'terrarium', Tile(13, 20, 20))
+        prefetcher.observe(260, 'terrarium', Tile(15, 40, 40))
+        for tileset, tile in prefetcher.queued:
+            self.assertLessEqual(tile.z, 15)
+        self.assertNotIn('failed', events)
+
+    def test_observe_derived_normals(self):
+        from zaloa import NORMAL_COORDS_GENERATORS
+        from zaloa import Tile
+        plain, _, _ = self._make_prefetcher(max_tiles=64)
+        plain.observe(512, 'terrarium', Tile(3, 2, 2))
+        derived, _, _ = self._make_prefetcher(max_tiles=64)
+        derived.observe(512, 'terrarium', Tile(3, 2, 2),
+                        NORMAL_COORDS_GENERATORS)
+        # the derived normals also need the ring of neighbors of the
+        # predicted tiles' sources
+        self.assertLess(set(plain.queued), set(derived.queued))
+
+    def test_foreground_holds_off(self):
+        import time
+        from zaloa import Tile
+        prefetcher, fetched, events = self._make_prefetcher(
+            max_tiles=2, queue_size=3)
+        with prefetcher.foreground():
+            prefetcher.start()
+            prefetcher.observe(256, 'normal', Tile(3, 2, 2))
+            prefetcher.observe(256, 'normal', Tile(3, 3, 2))
+            time.sleep(0.05)
+            self.assertEqual([], fetched)
+        self.assertEqual(['queued'] * 4 + ['dropped'], events)
+        for i in range(100):
+            if len(fetched) == 3:
+                break
+            time.sleep(0.01)
+        prefetcher.stop()
+        self.assertEqual(3, len(fetched))
+
+
+class DeriveNormalsTest(unittest.TestCase):
+
+    # a normal tile of an analytic surface, whose normals and elevation
+    # indexes were computed from the exact gradients and elevations, see
+    # _analytic_normal_tile
+    NORMAL_FIXTURE = 'test_fixtures/normal-256-10-163-395.png'
+    FIXTURE_TILE = (10, 163, 395)
+
+    def _analytic_surface(self, px, py):
+        """The elevation at the world pixel, and its gradient per pixel"""
+        z, x, y = self.FIXTURE_TILE
+        u = px - x * 256.0
+        v = py - y * 256.0
+        a = 2.0 * math.pi / 170.0
+        b = 2.0 * math.pi / 230.0
+        elevation = 1200.0 + 700.0 * math.sin(a * u) * math.cos(b * v) + \
+            1.5 * u - 1.0 * v
+        d_du = 700.0 * a * math.cos(a * u) * math.cos(b * v) + 1.5
+        d_dv = -700.0 * b * math.sin(a * u) * math.sin(b * v) - 1.0
+        return elevation, d_du, d_dv
+
+    def _analytic_normal_tile(self):
+        import bisect
+        from PIL import Image
+        from zaloa import EARTH_CIRCUMFERENCE
+        from zaloa import NORMAL_HEIGHT_TABLE
+        z, x, y = self.FIXTURE_TILE
+        world_pixels = 256.0 * 2 ** z
+        pixels = []
+        for row in range(256):
+            py = y * 256.0 + row + 0.5
+            latitude = math.atan(math.sinh(
+                math.pi * (1.0 - 2.0 * py / world_pixels)))
+            resolution = EARTH_CIRCUMFERENCE / world_pixels * \
+                math.cos(latitude)
+            for col in range(256):
+                elevation, d_du, d_dv = self._analytic_surface(
+                    x * 256.0 + col + 0.5, py)
+                # the rows run southwards
+                east, north = -d_du / resolution, d_dv / resolution
+                norm = math.sqrt(east * east + north * north + 1.0)
+                # the highest elevation in the table at or below it
+                index = bisect.bisect_right(NORMAL_HEIGHT_TABLE, elevation)
+                pixels.append(tuple(
+                    int(round(min(255.0, 128.0 * (c / norm + 1.0))))
+                    for c in (east, north, 1.0)) + (max(0, index - 1),))
+        image = Image.new('RGBA', (256, 256))
+        image.putdata(pixels)
+        return image
+
+    def _analytic_terrarium_png(self, tile):
+        from io import BytesIO
+        from PIL import Image
+        image = Image.new('RGB', (256, 256))
+        pixels = []
+        for row in range(256):
+            for col in range(256):
+                elevation = self._analytic_surface(
+                    tile.x * 256.0 + col + 0.5, tile.y * 256.0 + row + 0.5)[0]
+                value = int(round((elevation + 32768.0) * 256.0))
+                pixels.append((value >> 16, (value >> 8) & 255, value & 255))
+        image.putdata(pixels)
+        fp = BytesIO()
+        image.save(fp, format='PNG')
+        return fp.getvalue()
+
+    def _terrarium_png(self, tile, east=0.0, south=0.0):
+        # elevations rising by east and south meters per source pixel
+        from io import BytesIO
+        from PIL import Image
+        image = Image.new('RGB', (256, 256))
+        pixels = []
+        for y in range(256):
+            for x in range(256):
+                elevation = 1000.0 + east * (tile.x % 8 * 256 + x) + \
+                    south * (tile.y % 8 * 256 + y)
+                value = int((elevation + 32768.0) * 256.0)
+                pixels.append((value >> 16, (value >> 8) & 255, value & 255))
+        image.putdata(pixels)
+        fp = BytesIO()
+        image.save(fp, format='PNG')
+        return fp.getvalue()
+
+    def _render(self, tilesize, tile, **slope):
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import FetchResult
+        from zaloa import make_render_plan
+        from zaloa import process_tile
+
+        def stub_fetch(tileset, tile):
+            self.assertEqual('terrarium', tileset)
+            return FetchResult(self._terrarium_png(tile, **slope), tile)
+
+        plan = make_render_plan(
+            'normal', tilesize, tile, derive_normals=True)
+        image_bytes = process_tile(
+            plan.coords_generator, stub_fetch, plan.image_reducer,
+            plan.source_tileset, tile)[0]
+        image = Image.open(BytesIO(image_bytes))
+        self.assertEqual(('RGBA', (tilesize, tilesize)),
+                         (image.mode, image.size))
+        return image
+
+    def test_flat(self):
+        from PIL import Image
+        from zaloa import NORMAL_HEIGHT_TABLE
+        from zaloa import terrarium_to_normal
+        from zaloa import Tile
+        # 0m in terrarium
+        flat = Image.new('RGB', (262, 262), (128, 0, 0))
+        normal = terrarium_to_normal(flat, Tile(3, 2, 2), 0, 2)
+        self.assertEqual((260, 260), normal.size)
+        self.assertEqual([(260 * 260, (128, 128, 255, 16))],
+                         normal.getcolors())
+        self.assertEqual(0, NORMAL_HEIGHT_TABLE[16])
+
+    def test_slopes(self):
+        from zaloa import Tile
+        # rising to the east faces west, rising to the south faces north.
+        # The source pixels are about 28m here
+        red, green, blue, alpha = self._render(
+            256, Tile(12, 1000, 1500), east=5.0).getpixel((100, 100))
+        self.assertLess(red, 120)
+        self.assertEqual(128, green)
+        red, green, blue, alpha = self._render(
+            256, Tile(12, 1000, 1500), south=5.0).getpixel((100, 100))
+        self.assertEqual(128, red)
+        self.assertGreater(green, 136)
+
+    def test_edges_match(self):
+        from zaloa import Tile
+        slope = dict(east=3.0, south=-2.0)
+        tile_512 = self._render(512, Tile(3, 2, 3), **slope)
+        tile_516 = self._render(516, Tile(3, 2, 3), **slope)
+        self.assertEqual(
+            tile_512.tobytes(), tile_516.crop((2, 2, 514, 514)).tobytes())
+
+        # the buffer is the edge of the neighboring tile
+        tile_256 = self._render(256, Tile(4, 4, 6), **slope)
+        tile_260 = self._render(260, Tile(4, 5, 6), **slope)
+        self.assertEqual(tile_256.crop((254, 0, 256, 256)).tobytes(),
+                         tile_260.crop((0, 2, 2, 258)).tobytes())
+
+    def test_stored_normal_fixture(self):
+        import os
+        from io import BytesIO
+        from PIL import Image
+        from check_normals import compare_normal_images
+        from check_normals import MAX_ALPHA_DIFFERS
+        from check_normals import MAX_ANGLE_P99
+        from check_normals import within_tolerance
+        from zaloa import FetchResult
+        from zaloa import make_render_plan
+        from zaloa import process_tile
+        from zaloa import Tile
+
+        def stub_fetch(tileset, tile):
+            return FetchResult(self._analytic_terrarium_png(tile), tile)
+
+        tile = Tile(*self.FIXTURE_TILE)
+        plan = make_render_plan('normal', 256, tile, derive_normals=True)
+        derived = Image.open(BytesIO(process_tile(
+            plan.coords_generator, stub_fetch, plan.image_reducer,
+            plan.source_tileset, tile)[0]))
+        stored = Image.open(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), self.NORMAL_FIXTURE))
+        comparison = compare_normal_images(stored, derived)
+        self.assertTrue(within_tolerance(comparison), comparison)
+        # well within, since the surface is smooth and the sources exact
+        self.assertLess(comparison['angle_percentiles'][99],
+                        MAX_ANGLE_P99 / 2)
+        self.assertLess(comparison['alpha_differs'], MAX_ALPHA_DIFFERS / 10)
+        self.assertEqual(0.0, comparison['alpha_differs_by_more_than_one'])
+
+    def test_compare_normal_images(self):
+        from PIL import Image
+        from check_normals import compare_normal_images
+        stored = Image.new('RGBA', (4, 4), (128, 128, 255, 16))
+        derived = Image.new('RGBA', (4, 4), (128, 128, 255, 16))
+        comparison = compare_normal_images(stored, derived)
+        self.assertEqual(0.0, comparison['angle_percentiles'][99])
+        self.assertEqual(0.0, comparison['alpha_differs'])
+
+        # tilted 45 degrees to the east, and two elevation steps up
+        derived.paste((218, 128, 218, 18), (0, 0, 4, 2))
+        comparison = compare_normal_images(stored, derived)
+        self.assertAlmostEqual(45.0, comparison['angle_percentiles'][99])
+        self.assertEqual(0.5, comparison['alpha_differs'])
+        self.assertEqual(0.5, comparison['alpha_differs_by_more_than_one'])
+
+
+class MultiOriginTest(unittest.TestCase):
+
+    class StubClock(object):
+
+        def __init__(self):
+            self.now = 0.0
+
+        def __call__(self):
+            return self.now
+
+    def _origin(self, clock, latency, error=None):
+        from zaloa import FetchResult
+        calls = []
+
+        def tile_fetcher(tileset, tile):
+            calls.append(tile)
+            clock.now += latency
+            if error is not None:
+                raise error
+            return FetchResult(b'data', tile)
+
+        return tile_fetcher, calls
+
+    def test_fastest_origin_chosen(self):
+        from zaloa import MultiOriginTileFetcher
+        from zaloa import Tile
+        clock = self.StubClock()
+        slow, slow_calls = self._origin(clock, 0.2)
+        fast, fast_calls = self._origin(clock, 0.01)
+        tile_fetcher = MultiOriginTileFetcher(
+            [('slow', slow), ('fast', fast)], clock=clock)
+        # both are measured once, before their latencies are compared
+        for i in range(4):
+            tile_fetcher('terrarium', Tile(3, 2, i))
+        self.assertEqual(1, len(slow_calls))
+        self.assertEqual(3, len(fast_calls))
+        (slow_name, slow_latency, slow_errors), \
+            (fast_name, fast_latency, fast_errors) = tile_fetcher.report()
+        self.assertAlmostEqual(0.2, slow_latency)
+        self.assertAlmostEqual(0.01, fast_latency)
+
+    def test_needs_an_origin(self):
+        from zaloa import MultiOriginTileFetcher
+        with self.assertRaises(AssertionError):
+            MultiOriginTileFetcher([])
+
+    def test_fallback_on_error(self):
+        from zaloa import MultiOriginTileFetcher
+        from zaloa import OriginErrorException
+        from zaloa import Tile
+        clock = self.StubClock()
+        failing, failing_calls = self._origin(
+            clock, 0.0, OriginErrorException(Tile(3, 2, 1), 503))
+        working, working_calls = self._origin(clock, 0.1)
+        tile_fetcher = MultiOriginTileFetcher(
+            [('failing', failing), ('working', working)],
+            alpha=0.5, max_error_rate=0.25, retry_after=10.0, clock=clock)
+        fetch_result = tile_fetcher('terrarium', Tile(3, 2, 1))
+        self.assertEqual(b'data', fetch_result.image_bytes)
+        self.assertEqual(1, len(failing_calls))
+
+        # unhealthy after the error, so not tried until retry_after
+        tile_fetcher('terrarium', Tile(3, 2, 1))
+        self.assertEqual(1, len(failing_calls))
+        clock.now += 10.0
+        tile_fetcher('terrarium', Tile(3, 2, 1))
+        self.assertEqual(2, len(failing_calls))
+        self.assertEqual(3, len(working_calls))
+
+    def test_all_origins_failing(self):
+        from zaloa import MultiOriginTileFetcher
+        from zaloa import Tile
+        clock = self.StubClock()
+        first, first_calls = self._origin(clock, 0.0, IOError('first'))
+        second, second_calls = self._origin(clock, 0.0, IOError('second'))
+        tile_fetcher = MultiOriginTileFetcher(
+            [('first', first), ('second', second)], clock=clock)
+        with self.assertRaises(IOError) as cm:
+            tile_fetcher('terrarium', Tile(3, 2, 1))
+        self.assertEqual('second', str(cm.exception))
+
+    def test_missing_is_authoritative(self):
+        from zaloa import MissingTileException
+        from zaloa import MultiOriginTileFetcher
+        from zaloa import Tile
+        clock = self.StubClock()
+        missing, missing_calls = self._origin(
+            clock, 0.0, MissingTileException(Tile(3, 2, 1)))
+        other, other_calls = self._origin(clock, 0.0)
+        tile_fetcher = MultiOriginTileFetcher(
+            [('missing', missing), ('other', other)], clock=clock)
+        with self.assertRaises(MissingTileException):
+            tile_fetcher('terrarium', Tile(3, 2, 1))
+        self.assertEqual([], other_calls)
+        self.assertEqual(0.0, tile_fetcher.report()[0][2])
+
+    def test_disk_fetcher(self):
+        import os
+        import tempfile
+        from zaloa import DiskTileFetcher
+        from zaloa import MissingTileException
+        from zaloa import Tile
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'terrarium', '3', '2'))
+            path = os.path.join(root, 'terrarium', '3', '2', '1.png')
+            with open(path, 'wb') as fp:
+                fp.write(b'image data')
+            tile_fetcher = DiskTileFetcher(root)
+            fetch_result = tile_fetcher('terrarium', Tile(3, 2, 1))
+            self.assertEqual(b'image data', fetch_result.image_bytes)
+            with self.assertRaises(MissingTileException):
+                tile_fetcher('terrarium', Tile(3, 2, 2))
+
+    def test_mbtiles_fetcher(self):
+        import os
+        import sqlite3
+        import tempfile
+        from zaloa import MBTilesTileFetcher
+        from zaloa import MissingTileException
+        from zaloa import Tile
+        with tempfile.TemporaryDirectory() as root:
+            connection = sqlite3.connect(
+                os.path.join(root, 'terrarium.mbtiles'))
+            connection.execute(
+                'CREATE TABLE tiles (zoom_level integer, tile_column '
+                'integer, tile_row integer, tile_data blob)')
+            # row 1 from the top at zoom 3 is row 6 from the bottom
+            connection.execute(
+                'INSERT INTO tiles VALUES (3, 2, 6, ?)', (b'image data',))
+            connection.commit()
+            connection.close()
+
+            tile_fetcher = MBTilesTileFetcher(
+                os.path.join(root, '{tileset}.mbtiles'))
+            for i in range(2):
+                fetch_result = tile_fetcher('terrarium', Tile(3, 2, 1))
+                self.assertEqual(b'image data', fetch_result.image_bytes)
+            with self.assertRaises(MissingTileException):
+                tile_fetcher('terrarium', Tile(3, 2, 6))
+            self.assertEqual(
+                1, len(tile_fetcher.idle_connections['terrarium']))
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_shared_sources_fetched_once(self):
+        from fake_origins import FakeS3Client
+        from zaloa import make_render_plan
+        from zaloa import process_tile
+        from zaloa import process_tiles
+        from zaloa import S3TileFetcher
+        from zaloa import Tile
+        s3_tile_fetcher = S3TileFetcher(FakeS3Client(), 'fake-bucket')
+        fetched = []
+
+        def tile_fetcher(tileset, tile):
+            fetched.append(tile)
+            return s3_tile_fetcher(tileset, tile)
+
+        tiles = [Tile(10, x, y) for y in (395, 396, 397)
+                 for x in (163, 164, 165)]
+        tile_plans = [(tile, make_render_plan('terrarium', 260, tile))
+                      for tile in tiles]
+        outputs, timing_metadata, num_source_tiles = process_tiles(
+            tile_plans, tile_fetcher)
+        # (N+2)**2 rather than 9*N**2 for the 3x3 block
+        self.assertEqual(25, num_source_tiles)
+        self.assertEqual(25, len(fetched))
+        self.assertEqual(25, len(set(fetched)))
+        self.assertEqual(tiles, [tile for tile, image_bytes in outputs])
+
+        plan = make_render_plan('terrarium', 260, tiles[4])
+        image_bytes, timing_metadata, tile_coords = process_tile(
+            plan.coords_generator, s3_tile_fetcher, plan.image_reducer,
+            plan.source_tileset, tiles[4])
+        self.assertEqual(image_bytes, outputs[4][1])
+
+    def test_no_tiles(self):
+        from zaloa import process_tiles
+        outputs, timing_metadata, num_source_tiles = process_tiles([], None)
+        self.assertEqual([], outputs)
+        self.assertEqual(0, num_source_tiles)
+
+    def test_tiles_in_bbox(self):
+        from zaloa import Tile
+        from zaloa import tiles_in_bbox
+        self.assertEqual(
+            [Tile(10, 163, 395), Tile(10, 164, 395),
+             Tile(10, 163, 396), Tile(10, 164, 396)],
+            list(tiles_in_bbox(10, -122.5, 37.7, -122.3, 37.8)))
+        self.assertEqual(16, len(list(tiles_in_bbox(2, -180, -90, 180, 90))))
+
+    def test_tiles_in_bbox_across_antimeridian(self):
+        from zaloa import Tile
+        from zaloa import tiles_in_bbox
+        self.assertEqual(
+            [Tile(3, 7, 3), Tile(3, 0, 3), Tile(3, 7, 4), Tile(3, 0, 4)],
+            list(tiles_in_bbox(3, 170, -10, -170, 10)))
+        # all the way around, the tiles are not repeated
+        self.assertEqual(2, len(list(tiles_in_bbox(1, 10, 1, 9, 2))))
+
+
+class OutputStoreTest(unittest.TestCase):
+
+    def _check_store(self, output_store):
+        self.assertIsNone(output_store.get('256/terrarium/3/2/1.png'))
+        self.assertIsNone(output_store.head('256/terrarium/3/2/1.png'))
+        output_store.put('256/terrarium/3/2/1.png', b'image data',
+                         {'3/2/1': '"0123456789abcdef0123"', '3/2/2': None},
+                         'image/png')
+        stored = output_store.get('256/terrarium/3/2/1.png')
+        self.assertEqual(b'image data', stored.image_bytes)
+        self.assertEqual({'3/2/1': '0123456789abcdef'}, stored.source_etags)
+        self.assertEqual(
+            stored.source_etags,
+            output_store.head('256/terrarium/3/2/1.png').source_etags)
+
+    def test_s3_store(self):
+        from fake_origins import FakeS3Client
+        from output_store import S3OutputStore
+        s3_client = FakeS3Client(tile_buckets=())
+        self._check_store(S3OutputStore(s3_client, 'outputs', 'v1/'))
+        self.assertIn(('outputs', 'v1/256/terrarium/3/2/1.png'),
+                      s3_client.objects)
+
+    def test_local_store(self):
+        import tempfile
+        from output_store import LocalOutputStore
+        with tempfile.TemporaryDirectory() as root:
+            self._check_store(LocalOutputStore(root))
+
+    def test_is_stale(self):
+        from output_store import is_stale
+        stored_etags = {'3/2/1': 'aaaa', '3/2/2': 'bbbb'}
+        self.assertFalse(is_stale(stored_etags, {}))
+        self.assertFalse(is_stale(stored_etags, {'3/2/1': '"aaaa"'}))
+        self.assertFalse(is_stale(stored_etags, {'3/2/1': None}))
+        self.assertFalse(is_stale(stored_etags, {'3/2/3': '"cccc"'}))
+        self.assertTrue(is_stale(stored_etags, {'3/2/2': '"cccc"'}))
+
+    def test_same_sources(self):
+        from output_store import same_sources
+        stored_etags = {'3/2/1': 'aaaa', '3/2/2': 'bbbb'}
+        self.assertTrue(same_sources(
+            stored_etags, {'3/2/1': '"aaaa"', '3/2/2': '"bbbb"'}))
+        self.assertFalse(same_sources(
+            stored_etags, {'3/2/1': '"aaaa"', '3/2/2': '"cccc"'}))
+        # unknown etags or sources are not known to be unchanged
+        self.assertFalse(same_sources(
+            stored_etags, {'3/2/1': '"aaaa"', '3/2/2': None}))
+        self.assertFalse(same_sources(stored_etags, {'3/2/1': '"aaaa"'}))
+        self.assertFalse(same_sources({}, {}))
+
+    def test_source_etags_recorded(self):
+        from fake_origins import FakeS3Client
+        from fake_origins import make_etag
+        from output_store import SourceEtagRecorder
+        from zaloa import S3TileFetcher
+        from zaloa import Tile
+        recorder = SourceEtagRecorder(
+            S3TileFetcher(FakeS3Client(), 'fake-bucket'))
+        fetch_result = recorder('terrarium', Tile(3, 2, 1))
+        self.assertEqual(make_etag(fetch_result.image_bytes),
+                         fetch_result.etag)
+        self.assertEqual({'3/2/1': fetch_result.etag}, recorder.etags)
+
+    def test_writer(self):
+        from output_store import OutputStoreWriter
+
+        class StubOutputStore(object):
+
+            def __init__(self):
+                self.keys = []
+
+            def put(self, key, image_bytes, source_etags, content_type):
+                if key == 'fail':
+                    raise IOError('failed')
+                self.keys.append(key)
+
+        output_store = StubOutputStore()
+        events = []
+        writer = OutputStoreWriter(output_store, 2, events.append)
+        for key in ('a', 'fail', 'dropped'):
+            writer.put(key, b'', {}, 'image/png')
+        writer.start()
+        writer.flush()
+        writer.stop()
+        self.assertEqual(['a'], output_store.keys)
+        self.assertEqual(['dropped', 'written', 'failed'], events)
+
+
+class RevalidatorTest(unittest.TestCase):
+
+    def test_coalesced_per_key(self):
+        import threading
+        from revalidation import Revalidator
+        events = []
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def revalidate_a():
+            calls.append('a')
+            started.set()
+            release.wait(5)
+            return 'rendered'
+
+        revalidator = Revalidator(max_workers=2, on_event=events.append)
+        future = revalidator.revalidate('a', revalidate_a)
+        self.assertTrue(started.wait(5))
+        self.assertIsNone(revalidator.revalidate('a', revalidate_a))
+        release.set()
+        future.result(5)
+        # once done, the key can be revalidated again
+        revalidator.revalidate('a', lambda: 'unchanged').result(5)
+        revalidator.shutdown()
+        self.assertEqual(['a'], calls)
+        self.assertEqual(
+            ['scheduled', 'coalesced', 'rendered', 'scheduled', 'unchanged'],
+            events)
+
+    def test_dropped_and_failed(self):
+        import threading
+        from revalidation import Revalidator
+        events = []
+        release = threading.Event()
+
+        def fail():
+            release.wait(5)
+            raise IOError('origin down')
+
+        revalidator = Revalidator(
+            max_workers=1, max_pending=1, on_event=events.append)
+        future = revalidator.revalidate('a', fail)
+        self.assertIsNone(revalidator.revalidate('b', lambda: 'rendered'))
+        release.set()
+        future.result(5)
+        revalidator.shutdown()
+        self.assertEqual(['scheduled', 'dropped', 'failed'], events)
+        self.assertEqual(set(), revalidator.pending)
+
+
+class PeerTest(unittest.TestCase):
+
+    PEERS = ('http://a:5000', 'http://b:5000', 'http://c:5000')
+
+    class StubResponse(object):
+
+        def __init__(self, status_code, content=b'', headers=None):
+            self.status_code = status_code
+            self.content = content
+            self.headers = headers or {}
+
+    class StubHttpClient(object):
+
+        def __init__(self, respond):
+            self.respond = respond
+            self.urls = []
+
+        def get(self, url, timeout=None):
+            self.urls.append(url)
+            return self.respond(url)
+
+    def test_ring_consistent(self):
+        from collections import Counter
+        from peers import HashRing
+        keys = ['terrarium/10/%d/%d.png' % (x, y)
+                for x in range(30) for y in range(30)]
+        ring = HashRing(self.PEERS)
+        owners = dict((key, ring.owner(key)) for key in keys)
+        # the same ring whatever order the peers are listed in
+        reordered = HashRing(reversed(self.PEERS))
+        self.assertEqual(owners, dict(
+            (key, reordered.owner(key)) for key in keys))
+        for count in Counter(owners.values()).values():
+            self.assertGreater(count, len(keys) / 6)
+        # removing a peer only moves the keys it owned
+        smaller = HashRing(self.PEERS[:2])
+        for key, owner in owners.items():
+            if owner != self.PEERS[2]:
+                self.assertEqual(owner, smaller.owner(key))
+        self.assertIsNone(HashRing([]).owner(keys[0]))
+
+    def test_coalescing(self):
+        import threading
+        from peers import CoalescingTileFetcher
+        from zaloa import FetchResult
+        from zaloa import Tile
+        events = []
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def tile_fetcher(tileset, tile):
+            calls.append(tile)
+            started.set()
+            release.wait(5)
+            return FetchResult(b'data', tile)
+
+        coalescing = CoalescingTileFetcher(tile_fetcher, events.append)
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            coalescing('terrarium', Tile(3, 2, 1))))
+        leader.start()
+        self.assertTrue(started.wait(5))
+        follower = threading.Thread(target=lambda: results.append(
+            coalescing('terrarium', Tile(3, 2, 1))))
+        follower.start()
+        while not events:
+            release.wait(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual([Tile(3, 2, 1)], calls)
+        self.assertEqual(['coalesced'], events)
+        self.assertEqual([b'data', b'data'],
+                         [result.image_bytes for result in results])
+        self.assertEqual({}, coalescing.calls)
+
+    def _peer_fetcher(self, respond):
+        from peers import HashRing
+        from peers import PeerTileFetcher
+        from zaloa import FetchResult
+        origin_calls = []
+        events = []
+
+        def origin_fetcher(tileset, tile):
+            origin_calls.append(tile)
+            return FetchResult(b'origin', tile)
+
+        http_client = self.StubHttpClient(respond)
+        peer_fetcher = PeerTileFetcher(
+            HashRing(self.PEERS), self.PEERS[0], origin_fetcher, http_client,
+            on_event=events.append)
+        return peer_fetcher, http_client, origin_calls, events
+
+    def _tiles_by_owner(self, peer_fetcher):
+        from zaloa import Tile
+        tiles = {}
+        for x in range(50):
+            tile = Tile(10, x, 0)
+            tiles.setdefault(peer_fetcher.owner('terrarium', tile), tile)
+        return tiles
+
+    def test_fetch_from_owner(self):
+        peer_fetcher, http_client, origin_calls, events = \
+            self._peer_fetcher(lambda url: self.StubResponse(
+                200, b'peer', {'ETag': '"abc"'}))
+        tiles = self._tiles_by_owner(peer_fetcher)
+
+        fetch_result = peer_fetcher('terrarium', tiles[self.PEERS[1]])
+        self.assertEqual(b'peer', fetch_result.image_bytes)
+        self.assertEqual('"abc"', fetch_result.etag)
+        self.assertEqual(
+            ['http://b:5000/peer/v1/terrarium/%s.png' % tiles[self.PEERS[1]]],
+            http_client.urls)
+
+        fetch_result = peer_fetcher('terrarium', tiles[self.PEERS[0]])
+        self.assertEqual(b'origin', fetch_result.image_bytes)
+        self.assertEqual([tiles[self.PEERS[0]]], origin_calls)
+        self.assertEqual(1, len(http_client.urls))
+        self.assertEqual(['peer', 'local'], events)
+
+    def test_fallback_and_missing(self):
+        from peers import MISSING_TILE_HEADER
+        from zaloa import MissingTileException
+        responses = {
+            'http://b:5000': self.StubResponse(
+                404, headers={MISSING_TILE_HEADER: '1'}),
+            # eg an instance that does not serve the peer route yet
+            'http://c:5000': self.StubResponse(404),
+        }
+        peer_fetcher, http_client, origin_calls, events = \
+            self._peer_fetcher(lambda url: responses[url[:13]])
+        tiles = self._tiles_by_owner(peer_fetcher)
+
+        with self.assertRaises(MissingTileException):
+            peer_fetcher('terrarium', tiles[self.PEERS[1]])
+        self.assertEqual([], origin_calls)
+
+        fetch_result = peer_fetcher('terrarium', tiles[self.PEERS[2]])
+        self.assertEqual(b'origin', fetch_result.image_bytes)
+
+        def refuse(url):
+            raise IOError('connection refused')
+
+        peer_fetcher.http_client = self.StubHttpClient(refuse)
+        fetch_result = peer_fetcher('terrarium', tiles[self.PEERS[1]])
+        self.assertEqual(b'origin', fetch_result.image_bytes)
+        self.assertEqual(['fallback', 'fallback'], events)
+
+
+class PointElevationTest(unittest.TestCase):
+
+    def _column_tile_fetcher(self, missing=()):
+        # tiles whose elevation is the column of the pixel, in meters
+        from io import BytesIO
+        from PIL import Image
+        from zaloa import FetchResult
+        from zaloa import MissingTileException
+        image = Image.new('RGB', (256, 256))
+        image.putdata([(128, x, 0) for y in range(256) for x in range(256)])
+        buf = BytesIO()
+        image.save(buf, 'PNG')
+        calls = []
+
+        def tile_fetcher(tileset, tile):
+            calls.append((tileset, tile))
+            if tile in missing:
+                raise MissingTileException(tile)
+            return FetchResult(buf.getvalue(), tile)
+
+        return tile_fetcher, calls
+
+    def _lng_of_pixel(self, z, px):
+        return px / (256.0 * 2 ** z) * 360.0 - 180.0
+
+    def test_nearest_and_interpolated(self):
+        from elevation import plan_points
+        from elevation import PointSampler
+        from zaloa import Tile
+        tile_fetcher, calls = self._column_tile_fetcher()
+        sampler = PointSampler(tile_fetcher)
+        # the centers of columns 10 and 11 of tile 1/0/0, and between them
+        lngs = [self._lng_of_pixel(1, px) for px in (10.5, 11.5, 11.0)]
+        lats = [45.0] * 3
+
+        plan = plan_points(lngs, lats, 1)
+        self.assertEqual([Tile(1, 0, 0)], plan.tiles)
+        elevations, timing_metadata = sampler.sample(plan)
+        self.assertEqual([10.0, 11.0, 11.0], elevations.tolist())
+        self.assertIn('total', timing_metadata['fetch'])
+
+        elevations, _ = sampler.sample(plan_points(lngs, lats, 1, True))
+        self.assertEqual([10.0, 11.0, 10.5], elevations.tolist())
+        self.assertEqual(2, len(calls))
+
+    def test_tiles_grouped(self):
+        from elevation import plan_points
+        from elevation import PointSampler
+        from zaloa import Tile
+        tile_fetcher, calls = self._column_tile_fetcher()
+        sampler = PointSampler(tile_fetcher, cache_size=4)
+        lngs = [self._lng_of_pixel(2, 256 * 1 + px) for px in range(0, 256, 8)]
+        plan = plan_points(lngs, [10.0] * len(lngs), 2)
+        self.assertEqual([Tile(2, 1, 1)], plan.tiles)
+        sampler.sample(plan)
+        # decoded once, and kept for the next request
+        sampler.sample(plan)
+        self.assertEqual([('terrarium', Tile(2, 1, 1))], calls)
+
+    def test_antimeridian_and_missing(self):
+        import math
+        from elevation import plan_points
+        from elevation import PointSampler
+        from zaloa import Tile
+        tile_fetcher, calls = self._column_tile_fetcher(
+            missing=(Tile(1, 1, 0),))
+        sampler = PointSampler(tile_fetcher)
+        # the pixel centers on either side of the antimeridian are
+        # interpolated across it
+        plan = plan_points([180.0], [45.0], 1, interpolate=True)
+        self.assertEqual([Tile(1, 0, 0), Tile(1, 1, 0)], plan.tiles)
+        elevations, _ = sampler.sample(plan)
+        self.assertTrue(math.isnan(elevations[0]))
+
+        elevations, _ = sampler.sample(plan_points(
+            [self._lng_of_pixel(1, 0.5), 179.0], [45.0, 45.0], 1))
+        self.assertEqual(0.0, elevations[0])
+        self.assertTrue(math.isnan(elevations[1]))
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    class StubClock(object):
+
+        def __init__(self):
+            self.now = 1000000.0
+
+        def __call__(self):
+            return self.now
+
+    def test_put_and_get(self):
+        import os
+        import tempfile
+        from disk_cache import DiskTileCache
+        with tempfile.TemporaryDirectory() as root:
+            disk_cache = DiskTileCache(root, 1000)
+            self.assertIsNone(disk_cache.get('tile/256/terrarium/1/0/0'))
+            disk_cache.put('tile/256/terrarium/1/0/0', b'png',
+                           {'1/0/0': '"abcdef"'})
+            disk_tile = disk_cache.get('tile/256/terrarium/1/0/0')
+            with disk_tile.file:
+                self.assertEqual(b'png', disk_tile.file.read())
+            self.assertEqual(3, disk_tile.size)
+            self.assertEqual({'1/0/0': 'abcdef'}, disk_tile.source_etags)
+            # sharded by the hash of the key, with no temporary files left
+            shard, subshard, name = disk_tile.relative_path.split('/')
+            self.assertEqual((shard, subshard), (name[:2], name[2:4]))
+            self.assertEqual([name, name + '.meta'], sorted(os.listdir(
+                os.path.dirname(disk_tile.path))))
+            # readable by the web server in front, for the proxy modes
+            self.assertEqual(0o644, os.stat(disk_tile.path).st_mode & 0o777)
+            # the size of the files already there is counted
+            self.assertEqual(3, DiskTileCache(root, 1000).approx_bytes)
+
+    def test_evicts_least_recently_used(self):
+        import os
+        import tempfile
+        import time
+        from disk_cache import DiskTileCache
+        clock = self.StubClock()
+        events = []
+        with tempfile.TemporaryDirectory() as root:
+            disk_cache = DiskTileCache(root, 350, events.append, clock)
+            for key in ('a', 'b', 'c'):
+                disk_cache.put(key, b'x' * 100)
+                path = os.path.join(root, disk_cache.relative_path(key))
+                os.utime(path, (clock.now, clock.now))
+                clock.now += 100.0
+            self.assertFalse(disk_cache.evicting)
+            # a hit makes a tile the most recently used
+            disk_cache.get('a').file.close()
+            # going over the budget evicts down to 90% of it, in the
+            # background
+            disk_cache.put('d', b'x' * 100)
+            self.assertTrue(disk_cache.evicting)
+            while disk_cache.evicting:
+                time.sleep(0.01)
+            self.assertEqual(['a', 'c', 'd'], [
+                key for key in 'abcd' if os.path.exists(
+                    os.path.join(root, disk_cache.relative_path(key)))])
+            self.assertEqual(300, disk_cache.approx_bytes)
+            self.assertEqual(['written'] * 4 + ['evicted'], events)
+
+    def test_metadata(self):
+        import os
+        import tempfile
+        from disk_cache import DiskTileCache
+        clock = self.StubClock()
+        with tempfile.TemporaryDirectory() as root:
+            disk_cache = DiskTileCache(root, 1000, clock=clock)
+            disk_cache.put('a', b'png', {'1/0/0': 'v1'})
+            written_at = clock.now
+            clock.now += 100.0
+            disk_tile = disk_cache.get('a')
+            disk_tile.file.close()
+            # hits do not change when the tile was written
+            self.assertEqual(written_at, disk_tile.written_at)
+            disk_cache.refresh('a', {'1/0/0': 'v1'})
+            disk_tile = disk_cache.get('a')
+            disk_tile.file.close()
+            self.assertEqual(clock.now, disk_tile.written_at)
+            # nothing to refresh once evicted
+            disk_cache.refresh('b', {})
+            self.assertIsNone(disk_cache.get('b'))
+            # a tile without its metadata is missing
+            os.unlink(disk_tile.path + '.meta')
+            self.assertIsNone(disk_cache.get('a'))
+
+    def test_stale_temporary_files_removed(self):
+        import os
+        import tempfile
+        from disk_cache import DiskTileCache
+        clock = self.StubClock()
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'ab', 'cd'))
+            for name, age in (('.tmpold', 7200.0), ('.tmpnew', 10.0)):
+                path = os.path.join(root, 'ab', 'cd', name)
+                with open(path, 'wb') as fp:
+                    fp.write(b'partial')
+                os.utime(path, (clock.now - age, clock.now - age))
+            disk_cache = DiskTileCache(root, 1000, clock=clock)
+            self.assertEqual(0, disk_cache.approx_bytes)
+            self.assertEqual(
+                ['.tmpnew'], os.listdir(os.path.join(root, 'ab', 'cd')))
+
+
+class PinnedTest(unittest.TestCase):
+
+    def test_build_pinned_pyramid(self):
+        from fake_origins import FakeS3Client
+        from pinned import build_pinned_pyramid
+        from zaloa import S3TileFetcher
+        from zaloa import Tile
+        tile_fetcher = S3TileFetcher(FakeS3Client(), 'fake-bucket')
+        pyramid = build_pinned_pyramid(
+            tile_fetcher, 1, (256, 512), ('terrarium',))
+        self.assertEqual(2 * 5, len(pyramid))
+        self.assertTrue(pyramid.covers(Tile(1, 1, 0)))
+        self.assertFalse(pyramid.covers(Tile(2, 1, 0)))
+
+        # not copied out of the buffer
+        image_bytes = pyramid.get(512, 'terrarium', Tile(1, 1, 0))
+        self.assertIsInstance(image_bytes, memoryview)
+        self.assertTrue(image_bytes.tobytes().startswith(b'\x89PNG'))
+        self.assertIsNone(pyramid.get(260, 'terrarium', Tile(1, 1, 0)))
+        self.assertIsNone(pyramid.get(512, 'normal', Tile(1, 1, 0)))
+
+    def test_failed_tiles_left_out(self):
+        from pinned import build_pinned_pyramid
+        from zaloa import MissingTileException
+
+        def tile_fetcher(tileset, tile):
+            raise MissingTileException(tile)
+
+        pyramid = build_pinned_pyramid(tile_fetcher, 1, (256,), ('normal',))
+        self.assertEqual(0, len(pyramid))
+
+    def test_refresher(self):
+        import threading
+        from pinned import PinnedPyramid
+        from pinned import PinnedPyramidRefresher
+        from zaloa import Tile
+        built = []
+        refreshed = threading.Event()
+
+        def build_pyramid():
+            built.append(1)
+            if len(built) > 1:
+                refreshed.set()
+            return PinnedPyramid(0, b'', {})
+
+        refresher = PinnedPyramidRefresher(build_pyramid, 0.01)
+        # built in the background, when started
+        self.assertEqual(0, len(built))
+        self.assertFalse(refresher.pyramid.covers(Tile(0, 0, 0)))
+        refresher.start()
+        self.assertTrue(refresher.built.wait(5))
+        self.assertTrue(refresher.pyramid.covers(Tile(0, 0, 0)))
+        self.assertTrue(refreshed.wait(5))
+        refresher.stop()
+
+
+class ServerTest(unittest.TestCase):
+    """The routes of the flask app, through its test client"""
+
+    TILE_URL = '/tilezen/terrain/v1/256/terrarium/3/1/1.png'
+
+    def _make_app(self, s3_client=None, **config):
+        from fake_origins import FakeS3Client
+        from zaloa import S3TileFetcher
+        from server import create_app
+        return create_app(
+            dict(dict(TILES_FETCH_METHOD='s3'), **config),
+            tile_fetcher=S3TileFetcher(
+                s3_client or FakeS3Client(), 'fake-bucket'))
+
+    def _cached(self, app, cache_key):
+        from server import cache
+        with app.app_context():
+            return cache.get(cache_key)
+
+    def test_batch(self):
+        import zipfile
+        from io import BytesIO
+        app = self._make_app(CACHE_TYPE='simple', CACHE_THRESHOLD=10)
+        resp = app.test_client().get(
+            '/tilezen/terrain/v1/260/terrarium/batch.zip?tiles=3/1/1,3/2/1')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('application/zip', resp.content_type)
+        with zipfile.ZipFile(BytesIO(resp.data)) as zip_file:
+            self.assertEqual(['3/1/1.png', '3/2/1.png'], zip_file.namelist())
+            image_bytes = zip_file.read('3/1/1.png')
+        # cached with the etags of its own sources, to revalidate against
+        cached = self._cached(app, 'tile/260/terrarium/3/1/1')
+        self.assertEqual(image_bytes, cached.image_bytes)
+        self.assertEqual(9, len(cached.source_etags))
+        self.assertTrue(all(cached.source_etags.values()))
+        self.assertNotIn('3/3/1', cached.source_etags)
+
+        resp = app.test_client().get(
+            '/tilezen/terrain/v1/260/terrarium/batch.zip?tiles=3/1/x')
+        self.assertEqual(400, resp.status_code)
+
+    def test_batch_lookup(self):
+        import tempfile
+        import zipfile
+        from io import BytesIO
+        from fake_origins import FakeS3Client
+        batch_url = '/tilezen/terrain/v1/256/terrarium/batch.zip?tiles=3/1/1'
+        with tempfile.TemporaryDirectory() as root:
+            for config in (dict(DISK_CACHE_DIR=root),
+                           dict(OUTPUT_STORE='disk:' + root,
+                                SOURCE_CACHE_SIZE=10)):
+                app = self._make_app(**config)
+                image_bytes = app.test_client().get(self.TILE_URL).data
+                store_writer = app.extensions['zaloa']['output_store_writer']
+                if store_writer is not None:
+                    store_writer.flush()
+
+                # found as on the single tile route, without rendering it
+                s3_client = FakeS3Client()
+                app = self._make_app(s3_client=s3_client, **config)
+                resp = app.test_client().get(batch_url)
+                self.assertEqual(200, resp.status_code)
+                self.assertEqual(1200, resp.cache_control.max_age)
+                with zipfile.ZipFile(BytesIO(resp.data)) as zip_file:
+                    self.assertEqual(image_bytes, zip_file.read('3/1/1.png'))
+                self.assertEqual(0, s3_client.num_requests)
+
+    def test_batch_missing_tile(self):
+        import zipfile
+        from io import BytesIO
+        from fake_origins import FakeS3Client
+        from fake_origins import FakeS3Error
+
+        class MissingS3Client(FakeS3Client):
+            def _lookup(self, Bucket, Key):
+                if Key == 'terrarium/3/5/1.png':
+                    raise FakeS3Error('NoSuchKey', Key)
+                return super(MissingS3Client, self)._lookup(Bucket, Key)
+
+        app = self._make_app(s3_client=MissingS3Client(), CACHE_TYPE='simple',
+                             CACHE_THRESHOLD=10)
+        resp = app.test_client().get(
+            '/tilezen/terrain/v1/260/terrarium/batch.zip?tiles=3/1/1,3/5/1')
+        self.assertEqual(200, resp.status_code)
+        with zipfile.ZipFile(BytesIO(resp.data)) as zip_file:
+            self.assertEqual(['3/1/1.png', 'missing.txt'],
+                             zip_file.namelist())
+            self.assertEqual(b'3/5/1\n', zip_file.read('missing.txt'))
+        self.assertIsNotNone(self._cached(app, 'tile/260/terrarium/3/1/1'))
+        self.assertIsNone(self._cached(app, 'tile/260/terrarium/3/5/1'))
+
+    def test_tile(self):
+        from io import BytesIO
+        from PIL import Image
+        app = self._make_app()
+        resp = app.test_client().get(
+            '/tilezen/terrain/v1/260/terrarium/3/1/1.png')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('image/png', resp.content_type)
+        self.assertEqual((260, 260), Image.open(BytesIO(resp.data)).size)
+        self.assertIn('total;dur=', resp.headers['Server-Timing'])
+        self.assertEqual(1200, resp.cache_control.max_age)
+
+        resp = app.test_client().get(
+            '/tilezen/terrain/v1/260/foo/3/1/1.png')
+        self.assertEqual(404, resp.status_code)
+
+    def test_streamed_tile_cached(self):
+        from io import BytesIO
+        from PIL import Image
+        app = self._make_app(
+            STREAM_PNG_OUTPUT=True, CACHE_TYPE='simple', CACHE_THRESHOLD=10)
+        resp = app.test_client().get(self.TILE_URL)
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.is_streamed)
+        image_bytes = resp.get_data()
+        self.assertEqual((256, 256), Image.open(BytesIO(image_bytes)).size)
+        # cached once the whole output was sent
+        cached = self._cached(app, 'tile/256/terrarium/3/1/1')
+        self.assertEqual(image_bytes, cached.image_bytes)
+        self.assertEqual(['3/1/1'], list(cached.source_etags))
+
+    def _set_cached(self, app, cache_key, cached):
+        from server import cache
+        with app.app_context():
+            cache.set(cache_key, cached)
+
+    def _wait_for_revalidations(self, revalidator):
+        import time
+        deadline = time.time() + 5
+        while revalidator.pending and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(revalidator.pending)
+
+    def test_revalidation(self):
+        from fake_origins import FakeS3Client
+        from fake_origins import SyntheticTileSource
+        app = self._make_app(
+            s3_client=FakeS3Client(), CACHE_TYPE='simple',
+            CACHE_THRESHOLD=10, OUTPUT_CACHE_SOFT_TTL=60,
+            OUTPUT_CACHE_HARD_TTL=600)
+        revalidator = app.extensions['zaloa']['revalidator']
+        events = []
+        revalidator.on_event = events.append
+        client = app.test_client()
+        image_bytes = client.get(self.TILE_URL).data
+        cache_key = 'tile/256/terrarium/3/1/1'
+
+        def make_stale():
+            cached = self._cached(app, cache_key)
+            self._set_cached(app, cache_key, cached._replace(
+                rendered_at=cached.rendered_at - 120))
+
+        # a stale tile is served, and revalidated in the background
+        make_stale()
+        self.assertEqual(image_bytes, client.get(self.TILE_URL).data)
+        self._wait_for_revalidations(revalidator)
+        self.assertEqual(['scheduled', 'unchanged'], events)
+
+        # the source changed at the origin, behind the source cache
+        s3_client = app.extensions['zaloa']['tile_fetcher'] \
+            .tile_fetcher.s3_client
+        s3_client.put_object(
+            Bucket='fake-bucket', Key='terrarium/3/1/1.png',
+            Body=SyntheticTileSource()('terrarium', 3, 1, 2))
+        make_stale()
+        self.assertEqual(image_bytes, client.get(self.TILE_URL).data)
+        self._wait_for_revalidations(revalidator)
+        self.assertEqual('rendered', events[-1])
+        self.assertNotEqual(image_bytes, client.get(self.TILE_URL).data)
+
+    def test_output_store(self):
+        import tempfile
+        from fake_origins import FakeS3Client
+        from fake_origins import SyntheticTileSource
+        from zaloa import Tile
+        with tempfile.TemporaryDirectory() as root:
+            config = dict(OUTPUT_STORE='disk:' + root, SOURCE_CACHE_SIZE=10)
+            app = self._make_app(**config)
+            image_bytes = app.test_client().get(self.TILE_URL).data
+            app.extensions['zaloa']['output_store_writer'].flush()
+
+            # another process finds the tile in the store
+            s3_client = FakeS3Client()
+            app = self._make_app(s3_client=s3_client, **config)
+            resp = app.test_client().get(self.TILE_URL)
+            self.assertEqual(image_bytes, resp.data)
+            self.assertEqual(0, s3_client.num_requests)
+
+            # and renders it again once its source has changed
+            s3_client.put_object(
+                Bucket='fake-bucket', Key='terrarium/3/1/1.png',
+                Body=SyntheticTileSource()('terrarium', 3, 1, 2))
+            app.extensions['zaloa']['source_cache'](
+                'terrarium', Tile(3, 1, 1))
+            resp = app.test_client().get(self.TILE_URL)
+            self.assertNotEqual(image_bytes, resp.data)
+
+            app = self._make_app(
+                OUTPUT_STORE_REDIRECT_URL='https://store.example.com/tiles/',
+                **config)
+            resp = app.test_client().get(self.TILE_URL)
+            self.assertEqual(302, resp.status_code)
+            self.assertEqual(
+                'https://store.example.com/tiles/256/terrarium/3/1/1.png',
+                resp.headers['Location'])
+
+            with self.assertRaises(AssertionError):
+                self._make_app(OUTPUT_STORE='disk:' + root)
+
+    def test_peers(self):
+        from fake_origins import FakeS3Client
+
+        class PeerResponse(object):
+
+            def __init__(self, resp):
+                self.status_code = resp.status_code
+                self.headers = resp.headers
+                self.content = resp.data
+
+        class PeerSession(object):
+            """Send the requests to the peers to their test clients"""
+
+            def __init__(self, apps):
+                self.apps = apps
+
+            def get(self, url, timeout=None):
+                for base_url, app in self.apps.items():
+                    if url.startswith(base_url + '/'):
+                        return PeerResponse(app.test_client().get(
+                            url[len(base_url):]))
+                raise IOError('No peer at %s' % url)
+
+        apps = {}
+        s3_clients = {}
+        for self_url in ('http://a', 'http://b'):
+            s3_clients[self_url] = FakeS3Client()
+            apps[self_url] = self._make_app(
+                s3_client=s3_clients[self_url], SOURCE_CACHE_SIZE=100,
+                PEERS=['http://a', 'http://b'], PEER_SELF_URL=self_url)
+        for app in apps.values():
+            app.extensions['zaloa']['peer_fetcher'].http_client = \
+                PeerSession(apps)
+
+        url = '/tilezen/terrain/v1/516/terrarium/3/1/1.png'
+        resp = apps['http://a'].test_client().get(url)
+        self.assertEqual(200, resp.status_code)
+        # each of the 16 sources was fetched from the origin by its owner
+        self.assertTrue(s3_clients['http://a'].num_requests)
+        self.assertTrue(s3_clients['http://b'].num_requests)
+        self.assertEqual(16, sum(
+            s3_client.num_requests for s3_client in s3_clients.values()))
+        # and is cached there for the other peers
+        self.assertEqual(resp.data, apps['http://b'].test_client().get(
+            url).data)
+        self.assertEqual(16, sum(
+            s3_client.num_requests for s3_client in s3_clients.values()))
+
+    def test_peer_missing_tile(self):
+        from fake_origins import FakeS3Client
+        from peers import MISSING_TILE_HEADER
+        app = self._make_app(
+            s3_client=FakeS3Client(tile_buckets=()), SOURCE_CACHE_SIZE=10,
+            PEERS=['http://a'], PEER_SELF_URL='http://a')
+        resp = app.test_client().get('/peer/v1/terrarium/3/1/1.png')
+        self.assertEqual(404, resp.status_code)
+        self.assertIn(MISSING_TILE_HEADER, resp.headers)
+
+    def test_elevation(self):
+        import json
+        import numpy
+        from fake_origins import FakeS3Client
+        app = self._make_app()
+        # the center of the synthetic 0/0/0 tile, where r=128 g=128 b=0
+        resp = app.test_client().post(
+            '/tilezen/terrain/v1/elevation.json?z=0',
+            data=json.dumps([[0.0, 0.0], [0.1, 0.1]]))
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('application/json', resp.content_type)
+        self.assertEqual(128.0, json.loads(resp.data.decode('utf-8'))[0])
+
+        resp = app.test_client().post(
+            '/tilezen/terrain/v1/elevation.f32?z=0',
+            data=numpy.array([0.0, 0.0], '<f8').tobytes(),
+            content_type='application/octet-stream')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([128.0], numpy.frombuffer(resp.data, '<f4').tolist())
+
+        resp = app.test_client().post(
+            '/tilezen/terrain/v1/elevation.json?z=0', data='[[0.0]]')
+        self.assertEqual(400, resp.status_code)
+
+        app = self._make_app(s3_client=FakeS3Client(tile_buckets=()))
+        resp = app.test_client().post(
+            '/tilezen/terrain/v1/elevation.json?z=3', data='[[0.0, 0.0]]')
+        self.assertEqual([None], json.loads(resp.data.decode('utf-8')))
+
+    def test_elevation_metrics(self):
+        import json
+        from metrics import REQUEST_ERRORS
+        from metrics import STAGE_DURATION
+
+        def num_observed(tileset):
+            state = STAGE_DURATION.values.get(
+                ('elevation', tileset, 256, 's3'))
+            return state[2] if state else 0
+
+        class FailingSampler(object):
+            def sample(self, plan, tracer):
+                raise RuntimeError('sample failed')
+
+        app = self._make_app()
+        num_terrarium = num_observed('terrarium')
+        num_elevation = num_observed('elevation')
+        resp = app.test_client().post(
+            '/tilezen/terrain/v1/elevation.json?z=0', data='[[0.0, 0.0]]')
+        self.assertEqual(200, resp.status_code)
+        # labelled apart from the tiles
+        self.assertEqual(num_elevation + 1, num_observed('elevation'))
+        self.assertEqual(num_terrarium, num_observed('terrarium'))
+
+        num_errors = REQUEST_ERRORS.get(('elevation', 256, 'RuntimeError'))
+        num_tile_errors = REQUEST_ERRORS.get(
+            ('terrarium', 256, 'RuntimeError'))
+        app.extensions['zaloa']['point_sampler'] = FailingSampler()
+        resp = app.test_client().post(
+            '/tilezen/terrain/v1/elevation.json?z=0',
+            data=json.dumps([[0.0, 0.0]]))
+        self.assertEqual(500, resp.status_code)
+        self.assertEqual(num_errors + 1, REQUEST_ERRORS.get(
+            ('elevation', 256, 'RuntimeError')))
+        self.assertEqual(num_tile_errors, REQUEST_ERRORS.get(
+            ('terrarium', 256, 'RuntimeError')))
+
+    def test_disk_cache(self):
+        import os
+        import tempfile
+        from fake_origins import FakeS3Client
+        with tempfile.TemporaryDirectory() as root:
+            s3_client = FakeS3Client()
+            app = self._make_app(s3_client=s3_client, DISK_CACHE_DIR=root)
+            client = app.test_client()
+            image_bytes = client.get(self.TILE_URL).data
+            self.assertEqual(1, s3_client.num_requests)
+
+            # sent from the file, without rendering it again
+            resp = client.get(self.TILE_URL)
+            self.assertEqual(image_bytes, resp.data)
+            self.assertEqual(len(image_bytes), resp.content_length)
+            self.assertEqual('image/png', resp.content_type)
+            self.assertEqual(1, s3_client.num_requests)
+            resp.close()
+
+            # rendered again once it has expired
+            disk_cache = app.extensions['zaloa']['disk_cache']
+            path = os.path.join(root, disk_cache.relative_path(
+                'tile/256/terrarium/3/1/1'))
+            with open(path + '.meta', 'w') as fp:
+                fp.write('0\n')
+            self.assertEqual(image_bytes, client.get(self.TILE_URL).data)
+            self.assertEqual(2, s3_client.num_requests)
+
+            app = self._make_app(
+                DISK_CACHE_DIR=root, DISK_CACHE_SENDFILE='x-accel-redirect')
+            resp = app.test_client().get(self.TILE_URL)
+            self.assertEqual(b'', resp.data)
+            self.assertEqual(
+                '/zaloa-disk-cache/' + disk_cache.relative_path(
+                    'tile/256/terrarium/3/1/1'),
+                resp.headers['X-Accel-Redirect'])
+
+            app = self._make_app(
+                DISK_CACHE_DIR=root, DISK_CACHE_SENDFILE='x-sendfile')
+            resp = app.test_client().get(self.TILE_URL)
+            self.assertEqual(path, resp.headers['X-Sendfile'])
+
+    def test_prefetch_at_max_zoom(self):
+        app = self._make_app(PREFETCH_MAX_TILES=16, SOURCE_CACHE_SIZE=1000)
+        client = app.test_client()
+        # the zoom in predicts tiles past what the 512s go up to
+        for url in ('/tilezen/terrain/v1/512/terrarium/13/10/10.png',
+                    '/tilezen/terrain/v1/512/terrarium/14/20/20.png',
+                    '/tilezen/terrain/v1/1024/terrarium/13/5/5.png'):
+            self.assertEqual(200, client.get(url).status_code, url)
+        app.extensions['zaloa']['prefetcher'].stop()
+
+    def test_profiled_tile_not_streamed(self):
+        from profiling import PROFILE_HEADER
+        app = self._make_app(STREAM_PNG_OUTPUT=True, PROFILE_TOKEN='secret')
+        client = app.test_client()
+        # a streamed response has no length
+        self.assertNotIn('Content-Length', client.get(self.TILE_URL).headers)
+        resp = client.get(self.TILE_URL, headers={PROFILE_HEADER: 'secret'})
+        self.assertEqual(len(resp.data), resp.content_length)
+        self.assertIn('wall=', resp.headers[PROFILE_HEADER])
+
+    def test_pinned_tiles(self):
+        from fake_origins import FakeS3Client
+        s3_client = FakeS3Client()
+        app = self._make_app(
+            s3_client=s3_client, PINNED_MAX_ZOOM=1, PINNED_TILESIZES=[256],
+            PINNED_REFRESH_INTERVAL=0)
+        pinned = app.extensions['zaloa']['pinned']
+        self.assertTrue(pinned.built.wait(5))
+        num_requests = s3_client.num_requests
+        resp = app.test_client().get(
+            '/tilezen/terrain/v1/256/terrarium/1/1/0.png')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(
+            pinned.pyramid.get(256, 'terrarium', Tile(1, 1, 0)).tobytes(),
+            resp.data)
+        self.assertEqual(num_requests, s3_client.num_requests)
+
+    def test_multi_origin_fetches_measured_once(self):
+        import os
+        import tempfile
+        from fake_origins import SyntheticTileSource
+        from metrics import SOURCE_FETCH_DURATION
+        from server import create_app
+
+        def num_fetches(backend):
+            state = SOURCE_FETCH_DURATION.values.get(('terrarium', backend))
+            return state[2] if state else 0
+
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, 'terrarium', '3', '1', '1.png')
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fp:
+                fp.write(SyntheticTileSource()('terrarium', 3, 1, 1))
+            app = create_app(dict(
+                TILES_FETCH_METHOD='multi', TILES_ORIGINS=['disk:' + root]))
+            before = num_fetches('disk'), num_fetches('multi')
+            resp = app.test_client().get(self.TILE_URL)
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual((before[0] + 1, before[1]),
+                             (num_fetches('disk'), num_fetches('multi')))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,171 @@
+"""
+Structured per request tracing
+
+A Tracer collects nested spans for a single request. Spans are timed with
+the monotonic high resolution perf_counter and record the thread that ran
+them, so the fan out of the fetch threads is visible. Nesting follows the
+spans opened on the current thread; work handed to another thread passes
+its parent span explicitly.
+
+Finished traces are emitted as one JSON object per line, see
+analyze_traces.py for the offline analysis.
+"""
+
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from time import perf_counter
+
+
+trace_logger = logging.getLogger('zaloa.trace')
+
+
+class Span(object):
+
+    def __init__(self, tracer, span_id, parent_id, name, attrs):
+        self.tracer = tracer
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        self.thread = None
+        self.start = None
+        self.end = None
+
+    def __enter__(self):
+        current_thread = threading.current_thread()
+        self.thread = '%s:%d' % (current_thread.name, current_thread.ident)
+        self.tracer._push(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = perf_counter()
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer._pop(self)
+        suppress_exception = False
+        return suppress_exception
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def as_dict(self, origin):
+        return dict(
+            id=self.span_id,
+            parent=self.parent_id,
+            name=self.name,
+            thread=self.thread,
+            start=self.start - origin,
+            duration=self.duration,
+            attrs=self.attrs,
+        )
+
+
+class Tracer(object):
+    """Collects the spans for a single request"""
+
+    def __init__(self, name, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.wall_time = time.time()
+        self.origin = perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+
+    def span(self, name, parent=None, **attrs):
+        """
+        Create a new span, to be used as a context manager
+
+        The parent defaults to the innermost open span on this thread.
+        """
+        if parent is None:
+            stack = getattr(self.local, 'stack', None)
+            if stack:
+                parent = stack[-1]
+        parent_id = parent.span_id if parent is not None else None
+        with self.lock:
+            span_id = next(self.ids)
+        return Span(self, span_id, parent_id, name, attrs)
+
+    def _push(self, span):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(span)
+
+    def _pop(self, span):
+        # coroutines sharing a thread can close their spans out of order
+        self.local.stack.remove(span)
+        with self.lock:
+            self.spans.append(span)
+
+    def as_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        return dict(
+            trace_id=self.trace_id,
+            name=self.name,
+            time=self.wall_time,
+            attrs=self.attrs,
+            spans=[span.as_dict(self.origin) for span in spans],
+        )
+
+    def emit(self):
+        trace_logger.info(json.dumps(self.as_dict(), sort_keys=True))
+
+
+class _NullSpan(object):
+
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        suppress_exception = False
+        return suppress_exception
+
+
+class NullTracer(object):
+    """Tracer that records nothing, used for unsampled requests"""
+
+    _null_span = _NullSpan()
+
+    def span(self, name, parent=None, **attrs):
+        return self._null_span
+
+    def emit(self):
+        pass
+
+
+NULL_TRACER = NullTracer()
+
+
+def make_tracer(sample_rate, name, **attrs):
+    """Create a recording tracer for a sample_rate fraction of requests"""
+    if sample_rate and random.random() < sample_rate:
+        return Tracer(name, **attrs)
+    return NULL_TRACER
+
+
+def configure_trace_logging(path=None):
+    """Send the trace json lines to a file, or stderr, unadorned"""
+    if trace_logger.handlers:
+        return
+    if path:
+        handler = logging.FileHandler(path)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
@@ -1,3 +1,7 @@
-from server import create_app
+from startup import StartupTimer
 
-app = create_app()
+startup_timer = StartupTimer()
+with startup_timer.phase('import server'):
+    from server import create_app
+
+app = create_app(startup_timer=startup_timer)
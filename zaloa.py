@@ -1,12 +1,22 @@
 from __future__ import print_function
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from io import BytesIO
 from PIL import Image
-from time import time
+from time import perf_counter
+import asyncio
+import hashlib
 import math
+import os
 import queue
+import re
+import sqlite3
+import struct
 import threading
+import zlib
+from urllib.parse import quote
+
+from tracing import NULL_TRACER
 
 
 def is_tile_valid(z, x, y):
@@ -40,9 +50,15 @@ class Tile(object):
                 self.x == that.x and
                 self.y == that.y)
 
+    def __hash__(self):
+        return hash((self.z, self.x, self.y))
+
 
 # TODO fetchresult can grow to contain response caching headers
-FetchResult = namedtuple('FetchResult', 'image_bytes tile')
+# the etag identifies the version of the source, and is None where the
+# origin does not give one
+FetchResult = namedtuple('FetchResult', 'image_bytes tile etag')
+FetchResult.__new__.__defaults__ = (None,)
 
 # image specification defines the image placement of the source in the
 # final destination
@@ -54,8 +70,13 @@ ImageSpec = namedtuple('ImageSpec', 'location crop_bounds')
 
 TileCoordinates = namedtuple('TileCoordinates', 'tile image_spec')
 ImageInput = namedtuple('ImageInput', 'image_bytes image_spec tile')
-PathParseResult = namedtuple('PathParseResult',
-                             'not_found_reason tileset tilesize tile')
+PathParseResult = namedtuple(
+    'PathParseResult', 'not_found_reason tileset tilesize tile output_format')
+
+# the tilesets are None for formats that any tileset can be encoded in
+OutputFormat = namedtuple('OutputFormat', 'name content_type tilesets')
+RenderPlan = namedtuple(
+    'RenderPlan', 'source_tileset coords_generator image_reducer')
 
 
 class MissingTileException(Exception):
@@ -71,8 +92,18 @@ class MissingTileException(Exception):
         self.tile = tile
 
 
+class OriginErrorException(Exception):
+    """The origin failed to serve a tile, eg with a 5xx response"""
+
+    def __init__(self, tile, status):
+        super(OriginErrorException, self).__init__(
+            'Origin error %s for tile: %s' % (status, tile))
+        self.tile = tile
+        self.status = status
+
+
 def invalid_parse_result(reason):
-    return PathParseResult(reason, None, None, None)
+    return PathParseResult(reason, None, None, None, None)
 
 
 def make_s3_key(tileset, tile):
@@ -80,6 +111,19 @@ def make_s3_key(tileset, tile):
     return s3_key
 
 
+def make_http_url(url_prefix, tileset, tile):
+    url = '%s/%s/%s.png' % (url_prefix, tileset, tile)
+    return url
+
+
+def is_s3_missing_key_error(e):
+    try:
+        err_code = e.response.get('Error', {}).get('Code')
+    except Exception:
+        err_code = None
+    return err_code == 'NoSuchKey'
+
+
 class S3TileFetcher(object):
     """Fetch the source tile data"""
 
@@ -98,14 +142,9 @@ class S3TileFetcher(object):
             image_bytes = body_file.read()
             body_file.close()
             # TODO caching response headers
-            return FetchResult(image_bytes, tile)
+            return FetchResult(image_bytes, tile, resp.get('ETag'))
         except Exception as e:
-            try:
-                err_code = e.response.get('Error', {}).get('Code')
-            except Exception:
-                err_code = None
-
-            if err_code == 'NoSuchKey':
+            if is_s3_missing_key_error(e):
                 # opt to return these more specifically as an exception
                 # we want to early out in all cases, but we might
                 # want to know about missing tiles in particular
@@ -122,38 +161,736 @@ class HttpTileFetcher(object):
         self.url_prefix = url_prefix
 
     def __call__(self, tileset, tile):
-        url = '%s/%s/%s.png' % (self.url_prefix, tileset, tile)
+        url = make_http_url(self.url_prefix, tileset, tile)
         resp = self.http_client.get(url)
         if resp.status_code == 404:
             raise MissingTileException(tile)
-        return FetchResult(resp.content, tile)
+        if resp.status_code >= 500:
+            raise OriginErrorException(tile, resp.status_code)
+        return FetchResult(resp.content, tile, resp.headers.get('ETag'))
+
+
+class AsyncS3TileFetcher(object):
+    """Fetch the source tile data with an asyncio s3 client
+
+    The client is expected to behave like an aiobotocore client, ie
+    get_object is a coroutine and the body has a coroutine read.
+    """
+
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    async def __call__(self, tileset, tile):
+        s3_key = make_s3_key(tileset, tile)
+        try:
+            resp = await self.s3_client.get_object(
+                Bucket=self.bucket,
+                Key=s3_key,
+            )
+            body_file = resp['Body']
+            image_bytes = await body_file.read()
+            body_file.close()
+            return FetchResult(image_bytes, tile, resp.get('ETag'))
+        except Exception as e:
+            if is_s3_missing_key_error(e):
+                raise MissingTileException(tile)
+            else:
+                raise e
+
+
+class AsyncHttpTileFetcher(object):
+    """Fetch the source tile data with an aiohttp style client session"""
+
+    def __init__(self, http_session, url_prefix):
+        self.http_session = http_session
+        self.url_prefix = url_prefix
+
+    async def __call__(self, tileset, tile):
+        url = make_http_url(self.url_prefix, tileset, tile)
+        async with self.http_session.get(url) as resp:
+            if resp.status == 404:
+                raise MissingTileException(tile)
+            if resp.status >= 500:
+                raise OriginErrorException(tile, resp.status)
+            image_bytes = await resp.read()
+            etag = resp.headers.get('ETag')
+        return FetchResult(image_bytes, tile, etag)
+
+
+class DiskTileFetcher(object):
+    """Read the source tiles from a directory laid out like the bucket"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def __call__(self, tileset, tile):
+        path = os.path.join(self.root, make_s3_key(tileset, tile))
+        try:
+            with open(path, 'rb') as fp:
+                return FetchResult(fp.read(), tile)
+        except FileNotFoundError:
+            raise MissingTileException(tile)
+
+
+class MBTilesTileFetcher(object):
+    """
+    Read the source tiles from MBTiles files, one per tileset
+
+    path_template is the path of the files with a {tileset} placeholder.
+    The files are opened read only, with a pool of connections per
+    tileset since a connection can only be used by one thread at a time.
+    """
+
+    def __init__(self, path_template):
+        self.path_template = path_template
+        self.lock = threading.Lock()
+        self.idle_connections = {}
+
+    def _acquire_connection(self, tileset):
+        with self.lock:
+            idle = self.idle_connections.setdefault(tileset, [])
+            if idle:
+                return idle.pop()
+        path = self.path_template.format(tileset=tileset)
+        return sqlite3.connect(
+            'file:%s?mode=ro' % quote(path), uri=True,
+            check_same_thread=False)
+
+    def _release_connection(self, tileset, connection):
+        with self.lock:
+            self.idle_connections[tileset].append(connection)
+
+    def __call__(self, tileset, tile):
+        # the rows of MBTiles are numbered from the bottom, as in TMS
+        tile_row = 2 ** tile.z - 1 - tile.y
+        connection = self._acquire_connection(tileset)
+        try:
+            row = connection.execute(
+                'SELECT tile_data FROM tiles WHERE zoom_level = ? AND '
+                'tile_column = ? AND tile_row = ?',
+                (tile.z, tile.x, tile_row)).fetchone()
+        finally:
+            self._release_connection(tileset, connection)
+        if row is None:
+            raise MissingTileException(tile)
+        return FetchResult(bytes(row[0]), tile)
+
+
+class OriginStats(object):
+    """Moving averages of an origin's latency and error rate"""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.last_error = None
+
+    def record(self, latency, now):
+        """Record a fetch that took latency seconds, or failed with None"""
+        failed = latency is None
+        self.error_rate += self.alpha * (float(failed) - self.error_rate)
+        if failed:
+            self.last_error = now
+        elif self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+
+
+class MultiOriginTileFetcher(object):
+    """
+    Fetch each source tile from the fastest healthy origin
+
+    origins are (name, tile fetcher) pairs of mirrors of the tiles, eg a
+    local disk, a CDN and S3, cheapest first. Their latencies and error
+    rates are tracked as exponentially weighted moving averages with
+    weight alpha. Each fetch goes to the healthy origin with the lowest
+    latency, the origins with none measured yet first in the order given,
+    and falls back to the next one on errors.
+
+    An origin whose error rate is over max_error_rate is unhealthy, and
+    only tried after the healthy ones, until retry_after seconds after
+    its last error, when it gets requests again to measure it.
+
+    MissingTileException is authoritative: the origins are mirrors, so a
+    tile missing from one is not looked for in the others.
+    """
+
+    def __init__(self, origins, alpha=0.1, max_error_rate=0.5,
+                 retry_after=30.0, clock=perf_counter):
+        self.origins = list(origins)
+        assert self.origins, "At least one origin is needed"
+        self.stats = [OriginStats(alpha) for origin in self.origins]
+        self.max_error_rate = max_error_rate
+        self.retry_after = retry_after
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def ranked_origins(self):
+        now = self.clock()
+        healthy = []
+        unhealthy = []
+        with self.lock:
+            for index, stats in enumerate(self.stats):
+                if stats.error_rate > self.max_error_rate and \
+                        now - stats.last_error < self.retry_after:
+                    unhealthy.append((stats.error_rate, index))
+                else:
+                    healthy.append(
+                        (stats.latency is not None, stats.latency, index))
+        return [index for rank in (sorted(healthy), sorted(unhealthy))
+                for index in (entry[-1] for entry in rank)]
+
+    def _record(self, index, latency):
+        with self.lock:
+            self.stats[index].record(latency, self.clock())
+
+    def __call__(self, tileset, tile):
+        error = None
+        for index in self.ranked_origins():
+            name, tile_fetcher = self.origins[index]
+            start = self.clock()
+            try:
+                fetch_result = tile_fetcher(tileset, tile)
+            except MissingTileException:
+                self._record(index, self.clock() - start)
+                raise
+            except Exception as e:
+                self._record(index, None)
+                error = e
+                continue
+            self._record(index, self.clock() - start)
+            return fetch_result
+        raise error
+
+    def report(self):
+        """The name, latency and error rate of each origin"""
+        with self.lock:
+            return [(name, stats.latency, stats.error_rate)
+                    for (name, tile_fetcher), stats in zip(
+                        self.origins, self.stats)]
+
+
+class LRUCache(object):
+    """Thread safe mapping that evicts the least recently used items"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.items.move_to_end(key)
+            except KeyError:
+                return default
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+
+class CachingTileFetcher(object):
+    """
+    Keep recently fetched source tiles in memory
+
+    Neighboring output tiles share most of their source tiles, eg
+    adjacent 260 tiles share 6 of their 9 sources. Missing tiles are not
+    cached. on_lookup, if set, is called with whether each lookup was a
+    hit.
+    """
+
+    def __init__(self, tile_fetcher, maxsize, on_lookup=None):
+        self.tile_fetcher = tile_fetcher
+        self.cache = LRUCache(maxsize)
+        self.on_lookup = on_lookup
+
+    def __call__(self, tileset, tile):
+        key = (tileset, tile)
+        fetch_result = self.cache.get(key)
+        if self.on_lookup is not None:
+            self.on_lookup(fetch_result is not None)
+        if fetch_result is None:
+            fetch_result = self.tile_fetcher(tileset, tile)
+            self.cache.put(key, fetch_result)
+        return fetch_result
+
+
+class OutputMemo(object):
+    """
+    Reuse the outputs of plans with identical sources
+
+    Large areas of the tilesets are byte-identical tiles, eg the open
+    ocean, so many output tiles are made of exactly the same sources. The
+    memo is keyed by a digest of the source bytes and where each one goes
+    in the output, so those are only reduced and encoded once.
+
+    Plans whose sources are all the same single color are synthesized
+    without decoding them. Uniform pngs compress to a few hundred bytes,
+    so only sources up to uniform_max_bytes are checked, and the result
+    of checking each distinct source is kept.
+    """
+
+    def __init__(self, maxsize, on_lookup=None, uniform_max_bytes=4096):
+        self.outputs = LRUCache(maxsize)
+        self.source_colors = LRUCache(maxsize)
+        self.on_lookup = on_lookup
+        self.uniform_max_bytes = uniform_max_bytes
+
+    def key(self, image_reducer, image_inputs):
+        digest = hashlib.sha1(image_reducer.memo_scope().encode('ascii'))
+        # the threaded fetch returns the inputs in completion order
+        for image_spec, image_bytes in sorted(
+                (image_input.image_spec, image_input.image_bytes)
+                for image_input in image_inputs):
+            digest.update(repr(image_spec).encode('ascii'))
+            digest.update(hashlib.sha1(image_bytes).digest())
+        return digest.digest()
+
+    def get(self, key):
+        image_bytes = self.outputs.get(key)
+        if self.on_lookup is not None:
+            self.on_lookup(image_bytes is not None)
+        return image_bytes
+
+    def put(self, key, image_bytes):
+        self.outputs.put(key, image_bytes)
+
+    def _source_color(self, image_reducer, image_bytes):
+        if len(image_bytes) > self.uniform_max_bytes:
+            return None
+        key = image_reducer.mode, hashlib.sha1(image_bytes).digest()
+        color = self.source_colors.get(key, False)
+        if color is False:
+            color = image_reducer.uniform_color(image_bytes)
+            self.source_colors.put(key, color)
+        return color
+
+    def uniform_color(self, image_reducer, image_inputs):
+        """The color shared by all the sources, or None"""
+        colors = set()
+        for image_input in image_inputs:
+            color = self._source_color(image_reducer, image_input.image_bytes)
+            if color is None:
+                return None
+            colors.add(color)
+            if len(colors) > 1:
+                return None
+        return colors.pop() if colors else None
+
+
+class CanvasPool(object):
+    """
+    Reuse the output canvases and encode buffers between requests
+
+    A 516 canvas is about 1MB, and encoding the png grows a fresh buffer
+    in steps. Canvases are kept per (mode, size), and cleared when they
+    are returned. Buffers are kept per output tilesize, since they stay
+    the size of the largest output encoded into them. At most maxsize of
+    each are kept idle, the rest are dropped. on_event, if set, is called
+    with 'created', 'reused', 'returned' or 'discarded' for the canvases.
+    """
+
+    def __init__(self, maxsize, on_event=None):
+        self.maxsize = maxsize
+        self.on_event = on_event
+        self.lock = threading.Lock()
+        self.canvases = {}
+        self.buffers = {}
+        self.counts = dict(created=0, reused=0, returned=0, discarded=0)
+
+    def _record(self, event):
+        with self.lock:
+            self.counts[event] += 1
+        if self.on_event is not None:
+            self.on_event(event)
+
+    def acquire_canvas(self, mode, size):
+        with self.lock:
+            idle = self.canvases.get((mode, size))
+            canvas = idle.pop() if idle else None
+        if canvas is None:
+            self._record('created')
+            canvas = Image.new(mode, size)
+        else:
+            self._record('reused')
+        return canvas
+
+    def release_canvas(self, canvas):
+        canvas.paste(0, (0, 0) + canvas.size)
+        with self.lock:
+            idle = self.canvases.setdefault((canvas.mode, canvas.size), [])
+            kept = len(idle) < self.maxsize
+            if kept:
+                idle.append(canvas)
+        self._record('returned' if kept else 'discarded')
+
+    def acquire_buffer(self, tilesize):
+        with self.lock:
+            idle = self.buffers.get(tilesize)
+            if idle:
+                return idle.pop()
+        return BytesIO()
+
+    def release_buffer(self, fp, tilesize):
+        # truncating would free the grown buffer, so only rewind it
+        fp.seek(0)
+        with self.lock:
+            idle = self.buffers.setdefault(tilesize, [])
+            if len(idle) < self.maxsize:
+                idle.append(fp)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['idle'] = sum(len(idle) for idle in self.canvases.values())
+        return stats
+
+
+def source_output_mode(image):
+    """The output mode that keeps all of a source image: RGBA or RGB"""
+    if 'A' in image.mode or 'transparency' in image.info:
+        return 'RGBA'
+    return 'RGB'
+
+
+def tileset_output_mode(tileset_modes, tileset):
+    """The output mode configured for a tileset, None to follow the sources"""
+    mode = (tileset_modes or {}).get(tileset, 'auto')
+    return None if mode == 'auto' else mode
+
+
+OUTPUT_FORMATS = {
+    'png': OutputFormat('png', 'image/png', None),
+    'webp': OutputFormat('webp', 'image/webp', None),
+    # little endian float32 elevations in meters, row by row
+    'f32': OutputFormat(
+        'f32', 'application/x-elevation-float32', ('terrarium',)),
+}
+
+# lossless, with the least effort that still compresses better than png.
+# At 516 this encodes in about 70% of the png time, and is 30% smaller
+WEBP_OPTIONS = dict(lossless=True, method=1, quality=0)
+
+
+def terrarium_elevations(image, dtype='float32'):
+    """Decode terrarium rgb to the grid of elevations in meters"""
+    # numpy is only needed for the elevations, and takes a while to import
+    import numpy
+    pixels = numpy.asarray(image.convert('RGB'), dtype=dtype)
+    return (pixels[:, :, 0] * 256.0 + pixels[:, :, 1] +
+            pixels[:, :, 2] / 256.0) - 32768.0
+
+
+def terrarium_to_float32(image):
+    """Decode terrarium rgb to the raw float32 elevation grid"""
+    return terrarium_elevations(image).astype('<f4').tobytes()
+
+
+EARTH_CIRCUMFERENCE = 2 * math.pi * 6378137.0
+
+
+def _normal_height_table():
+    # the elevations that the alpha channel of the normal tiles indexes
+    # into, as joerd makes them: coarse for the bathymetry, and finest
+    # below 3000m, where most of the world's population lives
+    table = [-11000 + 1000 * i for i in range(11)]
+    table.extend((-100, -50, -20, -10, -1))
+    table.extend(20 * i for i in range(150))
+    table.extend(3000 + 50 * i for i in range(60))
+    table.extend(6000 + 100 * i for i in range(29))
+    return table
+
+
+NORMAL_HEIGHT_TABLE = _normal_height_table()
+
+
+def terrarium_to_normal(image, tile, scale_zoom, buffer):
+    """
+    Compute the normal tile from a terrarium mosaic
+
+    image is the mosaic for the output tile of tile at scale_zoom with a
+    border of buffer pixels, plus one more pixel on every side, which the
+    central differences at the edges need. The RGB of the normal tile are
+    the east, north and up components of the unit surface normal, scaled
+    from -1..1 to 0..255, and the alpha is the index of the elevation in
+    NORMAL_HEIGHT_TABLE.
+    """
+    import numpy
+    elevation = terrarium_elevations(image, numpy.float64)
+    height, width = elevation.shape
+
+    # the ground size of the pixels shrinks with the cosine of the
+    # latitude of their row
+    world_pixels = 256.0 * 2 ** (tile.z + scale_zoom)
+    rows = (tile.y * 2 ** scale_zoom * 256 - buffer - 1 +
+            numpy.arange(1, height - 1) + 0.5)
+    latitude = numpy.arctan(numpy.sinh(
+        math.pi * (1.0 - 2.0 * rows / world_pixels)))
+    resolution = (EARTH_CIRCUMFERENCE / world_pixels) * numpy.cos(latitude)
+    resolution = resolution[:, numpy.newaxis]
+
+    # rows run southwards, so the rise to the south is the northward
+    # component of the normal
+    east = -(elevation[1:-1, 2:] - elevation[1:-1, :-2]) / (2.0 * resolution)
+    north = (elevation[2:, 1:-1] - elevation[:-2, 1:-1]) / (2.0 * resolution)
+    norm = numpy.sqrt(east * east + north * north + 1.0)
+
+    normal = numpy.empty((height - 2, width - 2, 4), dtype=numpy.uint8)
+    for band, component in enumerate((east, north, 1.0)):
+        normal[:, :, band] = numpy.clip(
+            128.0 * (component / norm + 1.0), 0.0, 255.0)
+    normal[:, :, 3] = numpy.clip(numpy.digitize(
+        elevation[1:-1, 1:-1], NORMAL_HEIGHT_TABLE) - 1, 0, 255)
+    return Image.fromarray(normal, 'RGBA')
+
+
+def negotiate_output_format(accept, format_names, tileset, default='png'):
+    """
+    Pick the output format from an Accept header value
+
+    format_names are the formats that may be picked, less those that the
+    tileset cannot be encoded in.
+    Only the formats that the client names explicitly are picked over the
+    default, and only when it does not prefer the default, eg
+    "image/webp,*/*" picks webp but "*/*" or "image/png,image/webp;q=0.8"
+    do not.
+    """
+    qualities = {}
+    for media_range in (accept or '').split(','):
+        parts = media_range.strip().split(';')
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[parts[0].strip().lower()] = quality
+
+    default_type = OUTPUT_FORMATS[default].content_type
+    default_quality = max(
+        qualities.get(default_type, 0.0),
+        qualities.get(default_type.split('/')[0] + '/*', 0.0),
+        qualities.get('*/*', 0.0 if qualities else 1.0))
+    best, best_quality = default, default_quality
+    for name in format_names:
+        tilesets = OUTPUT_FORMATS[name].tilesets
+        if tilesets and tileset not in tilesets:
+            continue
+        quality = qualities.get(OUTPUT_FORMATS[name].content_type, 0.0)
+        # a named format wins a tie with the default
+        if quality > best_quality or (
+                quality > 0.0 and quality == best_quality and
+                best == default):
+            best, best_quality = name, quality
+    return best
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COLOR_TYPES = {'RGB': 2, 'RGBA': 6}
+# the most compressed bytes per IDAT chunk, as Image.save writes them
+PNG_IDAT_SIZE = 65536
+
+
+def _png_chunk(chunk_type, data):
+    crc = zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff
+    return b''.join((
+        struct.pack('>I', len(data)), chunk_type, data,
+        struct.pack('>I', crc)))
+
+
+def iter_png_chunks(image, idat_size=PNG_IDAT_SIZE):
+    """
+    Encode an RGB or RGBA image as png, a chunk at a time
+
+    The signature and IHDR come first, before anything is compressed, then
+    an IDAT chunk each time the encoder has filled idat_size bytes, and
+    the IEND. Together they are the same bytes as Image.save makes with
+    the default options.
+    """
+    width, height = image.size
+    yield PNG_SIGNATURE + _png_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', width, height, 8, PNG_COLOR_TYPES[image.mode], 0, 0, 0))
+
+    image.load()
+    # optimize, compress_level, compress_type and dictionary, as the
+    # defaults of the png plugin
+    encoder_config = (False, -1, -1, b'')
+    encoder = Image._getencoder(image.mode, 'zip', image.mode, encoder_config)
+    try:
+        encoder.setimage(image.im, (0, 0) + image.size)
+        while True:
+            _, errcode, data = encoder.encode(max(idat_size, width * 4))
+            yield _png_chunk(b'IDAT', data)
+            if errcode:
+                break
+    finally:
+        encoder.cleanup()
+    if errcode < 0:
+        raise IOError('png encoder error %d' % errcode)
+
+    yield _png_chunk(b'IEND', b'')
 
 
 class ImageReducer(object):
-    """Combine or reduce multiple source images into one"""
+    """
+    Combine or reduce multiple source images into one
+
+    The output is in the given mode, eg RGB for the terrarium tiles which
+    have no alpha. With mode None, the output is RGB when none of the
+    sources have any transparency, and RGBA otherwise. output_format is
+    one of the OUTPUT_FORMATS.
+    """
 
-    def __init__(self, tilesize):
+    def __init__(self, tilesize, canvas_pool=None, mode='RGBA',
+                 output_format='png'):
         self.tilesize = tilesize
-        assert tilesize in (512, 516, 256, 260)
+        self.canvas_pool = canvas_pool
+        self.mode = mode
+        self.output_format = output_format
+        self.source_modes = set()
+        assert tilesize in COORDS_GENERATORS
+
+    # pixels the canvas extends past the output on every side
+    canvas_border = 0
+
+    def memo_scope(self):
+        """What the output depends on besides the sources, for OutputMemo"""
+        return '%s:%s:%s:%s' % (type(self).__name__, self.tilesize,
+                                self.mode, self.output_format)
+
+    def _new_canvas(self, mode):
+        size = (self.tilesize + 2 * self.canvas_border,) * 2
+        if self.canvas_pool is not None:
+            return self.canvas_pool.acquire_canvas(mode, size)
+        return Image.new(mode, size)
 
     def create_initial_state(self):
-        image_state = Image.new('RGBA', (self.tilesize, self.tilesize))
+        image_state = self._new_canvas(self.mode or 'RGBA')
+        return image_state
+
+    def create_uniform_state(self, color):
+        """The reduced state of sources that are all the one color"""
+        if self.mode is None:
+            self.source_modes.add('RGB' if len(color) == 3 else 'RGBA')
+        image_state = self._new_canvas(self.mode or 'RGBA')
+        image_state.paste(color, (0, 0) + image_state.size)
         return image_state
 
+    def uniform_color(self, image_bytes):
+        """The color of a source image if it is all one color, or None"""
+        image = Image.open(BytesIO(image_bytes))
+        image = image.convert(self.mode or source_output_mode(image))
+        extrema = image.getextrema()
+        if len(image.getbands()) == 1:
+            extrema = (extrema,)
+        if all(low == high for low, high in extrema):
+            return tuple(low for low, high in extrema)
+        return None
+
     def reduce(self, image_state, image_input):
         tile_fp = BytesIO(image_input.image_bytes)
         image_spec = image_input.image_spec
         image = Image.open(tile_fp)
+        if self.mode is None:
+            self.source_modes.add(source_output_mode(image))
         if image_spec.crop_bounds:
             image = image.crop(image_spec.crop_bounds)
         image_state.paste(image, image_spec.location)
 
+    def encode(self, image, fp):
+        if self.output_format == 'png':
+            image.save(fp, format='PNG')
+        elif self.output_format == 'webp':
+            image.save(fp, format='WEBP', **WEBP_OPTIONS)
+        elif self.output_format == 'f32':
+            fp.write(terrarium_to_float32(image))
+        else:
+            raise ValueError('Unknown output format: %s' % self.output_format)
+
+    def _output_image(self, image_state):
+        if self.mode is None and self.source_modes == {'RGB'}:
+            return image_state.convert('RGB')
+        return image_state
+
     def finalize(self, image_state):
-        out_fp = BytesIO()
-        image_state.save(out_fp, format='PNG')
-        image_bytes = out_fp.getvalue()
+        # a pooled image_state is returned to the pool here, even when the
+        # encode fails, and must not be used afterwards
+        if self.canvas_pool is None:
+            out_fp = BytesIO()
+            self.encode(self._output_image(image_state), out_fp)
+            image_bytes = out_fp.getvalue()
+            return image_bytes
+
+        # the pooled buffer can hold a longer previous output
+        out_fp = self.canvas_pool.acquire_buffer(self.tilesize)
+        try:
+            self.encode(self._output_image(image_state), out_fp)
+            size = out_fp.tell()
+            out_fp.seek(0)
+            image_bytes = out_fp.read(size)
+        finally:
+            self.canvas_pool.release_buffer(out_fp, self.tilesize)
+            self.canvas_pool.release_canvas(image_state)
         return image_bytes
 
+    def finalize_stream(self, image_state):
+        """
+        Like finalize, but yield the png output chunk by chunk as it is
+        encoded, without ever holding all of it
+        """
+        assert self.output_format == 'png'
+        try:
+            for chunk in iter_png_chunks(self._output_image(image_state)):
+                yield chunk
+        finally:
+            if self.canvas_pool is not None:
+                self.canvas_pool.release_canvas(image_state)
+
+
+class NormalReducer(ImageReducer):
+    """
+    Derive a normal tile from terrarium sources
+
+    The sources are planned by NORMAL_COORDS_GENERATORS, one pixel wider
+    on every side than the output, and merged as terrarium before the
+    normals are computed.
+    """
+
+    canvas_border = 1
+
+    def __init__(self, tilesize, tile, canvas_pool=None,
+                 output_format='png'):
+        super(NormalReducer, self).__init__(
+            tilesize, canvas_pool, 'RGB', output_format)
+        self.tile = tile
+
+    def memo_scope(self):
+        # the normals depend on the latitude of the tile
+        return '%s:%s/%s' % (super(NormalReducer, self).memo_scope(),
+                             self.tile.z, self.tile.y)
+
+    def _output_image(self, image_state):
+        planner = COORDS_GENERATORS[self.tilesize]
+        return terrarium_to_normal(
+            image_state, self.tile, planner.scale_zoom, planner.buffer)
+
 
 class time_block(object):
     """Convenience to capture timing information"""
@@ -164,286 +901,251 @@ class time_block(object):
         self.start = None
 
     def __enter__(self):
-        self.start = time()
+        self.start = perf_counter()
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        stop = time()
+        stop = perf_counter()
         duration = stop - self.start
         self.timing[self.metadata_key] = duration
         suppress_exception = False
         return suppress_exception
 
 
-def img_pos(x, y):
-    pos = x, y
-    crop = None
-    return ImageSpec(pos, crop)
+class CoordinatePlanner(object):
+    """
+    Generate the coordinates for any scale and buffer
 
+    The output is scale x scale source tiles from scale_zoom zooms below,
+    surrounded by a border of buffer pixels taken from the neighbouring
+    tiles, ie the 516 tiles are CoordinatePlanner(1, 2). The border wraps
+    around horizontally, and at the top and bottom of the world repeats
+    the edge pixels of the outermost tiles.
 
-def generate_coordinates_256(tile):
-    tile_coordinates = (
-        TileCoordinates(tile, img_pos(0, 0)),
-    )
-    return tile_coordinates
+    The locations and crop bounds only depend on whether the tile is at
+    the top and/or bottom of the world, so they are computed once for each
+    of these edge classes, leaving only the tile coordinates to fill in.
+    """
 
+    def __init__(self, scale_zoom, buffer):
+        assert 0 <= buffer < 256
+        self.scale_zoom = scale_zoom
+        self.scale = 2 ** scale_zoom
+        self.buffer = buffer
+        self.tilesize = 256 * self.scale + 2 * buffer
+        self._templates = {}
+
+    def _axis_offsets(self):
+        offsets = list(range(self.scale))
+        if self.buffer:
+            offsets = [-1] + offsets + [self.scale]
+        return offsets
+
+    def _axis_location(self, offset):
+        if offset < 0:
+            return 0
+        return self.buffer + offset * 256
+
+    def _axis_crop(self, offset, at_edge):
+        # the (min, max) pixels of the source tile on one axis, or None for
+        # the whole tile. Past the edge of the world, the pixels on the
+        # near side of the clamped tile are used instead of the far side
+        if offset < 0:
+            use_far_side = not at_edge
+        elif offset >= self.scale:
+            use_far_side = at_edge
+        else:
+            return None
+        if use_far_side:
+            return 256 - self.buffer, 256
+        return 0, self.buffer
+
+    def _make_template(self, at_top, at_bottom):
+        template = []
+        for dy in self._axis_offsets():
+            y_crop = self._axis_crop(dy, at_top if dy < 0 else at_bottom)
+            for dx in self._axis_offsets():
+                # the neighbours wrap around horizontally, so the far side
+                # of the left neighbour always borders the tile
+                x_crop = self._axis_crop(dx, False)
+                if x_crop is None and y_crop is None:
+                    crop_bounds = None
+                else:
+                    min_x, max_x = x_crop or (0, 256)
+                    min_y, max_y = y_crop or (0, 256)
+                    crop_bounds = (min_x, min_y, max_x, max_y)
+                location = (self._axis_location(dx),
+                            self._axis_location(dy))
+                template.append((dx, dy, ImageSpec(location, crop_bounds)))
+        return tuple(template)
+
+    def template(self, at_top, at_bottom):
+        key = at_top, at_bottom
+        template = self._templates.get(key)
+        if template is None:
+            template = self._templates[key] = self._make_template(*key)
+        return template
+
+    def __call__(self, tile):
+        z = tile.z + self.scale_zoom
+        x = tile.x * self.scale
+        y = tile.y * self.scale
+        x_y_max = 2 ** z - 1
+        template = self.template(y == 0, y + self.scale - 1 == x_y_max)
+        tile_coordinates = []
+        for dx, dy, image_spec in template:
+            tile_x = (x + dx) % (x_y_max + 1)
+            tile_y = min(max(y + dy, 0), x_y_max)
+            tile_coordinates.append(
+                TileCoordinates(Tile(z, tile_x, tile_y), image_spec))
+        return tile_coordinates
+
+
+# both terrarium and normal tiles follow the same coordinate generation
+# strategy. They just point to a different location for the source data
+COORDS_GENERATORS = {
+    256: CoordinatePlanner(0, 0),
+    260: CoordinatePlanner(0, 2),
+    512: CoordinatePlanner(1, 0),
+    516: CoordinatePlanner(1, 2),
+    1024: CoordinatePlanner(2, 0),
+    1028: CoordinatePlanner(2, 2),
+}
+
+# the terrarium sources of the normal tiles, when they are derived
+NORMAL_COORDS_GENERATORS = dict(
+    (tilesize, CoordinatePlanner(planner.scale_zoom, planner.buffer + 1))
+    for tilesize, planner in COORDS_GENERATORS.items())
+
+TILESETS = ('terrarium', 'normal')
+
+
+def make_render_plan(tileset, tilesize, tile, canvas_pool=None, mode='RGBA',
+                     output_format='png', derive_normals=False):
+    """
+    Pick the sources and the reducer for a tile
 
-def generate_coordinates_512(tile):
-    zp1 = tile.z + 1
-    dbl_x = tile.x * 2
-    dbl_y = tile.y * 2
-    # see ImageSpec description above for coordinate meaning
+    With derive_normals, the normal tiles are computed from the terrarium
+    sources rather than merged from the normal ones, so mixed workloads
+    fetch and cache half as many distinct source tiles.
+    """
+    if tileset == 'normal' and derive_normals:
+        return RenderPlan(
+            'terrarium', NORMAL_COORDS_GENERATORS[tilesize],
+            NormalReducer(tilesize, tile, canvas_pool, output_format))
+    return RenderPlan(
+        tileset, COORDS_GENERATORS[tilesize],
+        ImageReducer(tilesize, canvas_pool, mode, output_format))
 
-    tile_coordinates = (
-        TileCoordinates(Tile(zp1, dbl_x, dbl_y), img_pos(0, 0)),
-        TileCoordinates(Tile(zp1, dbl_x+1, dbl_y), img_pos(256, 0)),
-        TileCoordinates(Tile(zp1, dbl_x, dbl_y+1), img_pos(0, 256)),
-        TileCoordinates(Tile(zp1, dbl_x+1, dbl_y+1), img_pos(256, 256)),
-    )
-    return tile_coordinates
-
-
-def generate_coordinates_260(tile):
-    """
-    generate a 3x3 grid with the source tile in the center
-
-    x x x
-    x o x
-    x x x
-
-    """
-
-    # see ImageSpec description above for coordinate meaning
-
-    tile_coordinates = []
-
-    x_y_max = int(math.pow(2, tile.z)) - 1
-
-    # NOTE: using a north, east, south, west naming scheme
-    # top row placement positions
-    loc_nw, loc_n, loc_ne = (0, 0), (2, 0), (258, 0)
-    # mid row placement positions
-    loc_w, loc_c, loc_e = (0, 2), (2, 2), (258, 2)
-    # bot row placement positions
-    loc_sw, loc_s, loc_se = (0, 258), (2, 258), (258, 258)
-
-    # set the top row tiles to account for edge cases
-    top_y = 0 if tile.y == 0 else tile.y-1
-    if tile.x == 0:
-        nw_tile = Tile(tile.z, x_y_max, top_y)
-    else:
-        nw_tile = Tile(tile.z, tile.x-1, top_y)
-    n_tile = Tile(tile.z, tile.x, top_y)
-    if tile.x == x_y_max:
-        ne_tile = Tile(tile.z, 0, top_y)
-    else:
-        ne_tile = Tile(tile.z, tile.x+1, top_y)
-
-    # set the mid row of tiles
-    if tile.x == 0:
-        w_tile = Tile(tile.z, x_y_max, tile.y)
-    else:
-        w_tile = Tile(tile.z, tile.x-1, tile.y)
-    c_tile = Tile(tile.z, tile.x, tile.y)
-    if tile.x == x_y_max:
-        e_tile = Tile(tile.z, 0, tile.y)
-    else:
-        e_tile = Tile(tile.z, tile.x+1, tile.y)
-
-    # set the bot row of tiles
-    bot_y = x_y_max if tile.y == x_y_max else tile.y+1
-    if tile.x == 0:
-        sw_tile = Tile(tile.z, x_y_max, bot_y)
-    else:
-        sw_tile = Tile(tile.z, tile.x-1, bot_y)
-    s_tile = Tile(tile.z, tile.x, bot_y)
-    if tile.x == x_y_max:
-        se_tile = Tile(tile.z, 0, bot_y)
-    else:
-        se_tile = Tile(tile.z, tile.x+1, bot_y)
-
-    # relevant tiles are set appropriately
-    # now we need to figure out the parts that are cropped from each
-    # if we are the top or bot, we need to invert the piece that gets cropped
-    if tile.y == 0:
-        # the tiles will be set to be the top row
-        # we'll be extracting the top bounds from these
-        top_crop_bounds = (
-            (254, 0, 256, 2),
-            (0, 0, 256, 2),
-            (0, 0, 2, 2),
-        )
-    else:
-        # we are not the top row
-        # we'll be extracting the bot bounds from the row above us
-        top_crop_bounds = (
-            (254, 254, 256, 256),
-            (0, 254, 256, 256),
-            (0, 254, 2, 256),
-        )
-    mid_crop_bounds = (
-        (254, 0, 256, 256),
-        None,
-        (0, 0, 2, 256),
-    )
-    if tile.y == x_y_max:
-        # the tiles will be set to the bot row
-        # we'll be extrating the bot bounds from these
-        bot_crop_bounds = (
-            (254, 254, 256, 256),
-            (0, 254, 256, 256),
-            (0, 254, 2, 256),
-        )
-    else:
-        # we are not the bot row
-        # we'll be extracting the top bounds from the row below us
-        bot_crop_bounds = (
-            (254, 0, 256, 2),
-            (0, 0, 256, 2),
-            (0, 0, 2, 2),
-        )
-
-    # the tiles, locations, and bounds are now all assembled
-    # weave them together to generate the list of all tile coordinates
-    all_tiles = (
-        nw_tile, n_tile, ne_tile,
-        w_tile, c_tile, e_tile,
-        sw_tile, s_tile, se_tile,
-    )
-    all_locs = (
-        loc_nw, loc_n, loc_ne,
-        loc_w, loc_c, loc_e,
-        loc_sw, loc_s, loc_se,
-    )
-    all_bounds = (list(top_crop_bounds) +
-                  list(mid_crop_bounds) +
-                  list(bot_crop_bounds))
 
-    for tile, loc, crop_bounds in zip(all_tiles, all_locs, all_bounds):
-        tc = TileCoordinates(tile, ImageSpec(loc, crop_bounds))
-        tile_coordinates.append(tc)
+TILE_PATH_RE = re.compile(
+    r'^/tilezen/terrain/v1/(?:(?P<tilesize>\d+)/)?(?P<tileset>[^/]+)/'
+    r'(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<output_format>[a-z0-9]+)$')
 
-    return tile_coordinates
 
+def max_zoom_for_tilesize(tilesize):
+    """The highest zoom that tiles of this size can be requested at"""
+    # the source tiles go up to zoom 15, but only the 260s were made
+    # available at that zoom
+    if tilesize == 260:
+        return 15
+    return min(14, 15 - COORDS_GENERATORS[tilesize].scale_zoom)
 
-def generate_coordinates_516(tile):
-    """
-    generate a 4x4 grid with the source tiles being the 4 in the middle
 
-    The source tile is zoomed in one, which generates 4 tiles. Then
-    the border around these 4 is used.
+def parse_tile_request(tileset, tilesize, z, x, y, output_format='png'):
+    """Validate the components of a tile request"""
 
-    x x x x
-    x O o x
-    x o o x
-    x x x x
+    tilesize = tilesize or 256
+    output_format = output_format or 'png'
 
-    """
+    if tilesize not in COORDS_GENERATORS:
+        return invalid_parse_result('Invalid tilesize')
 
-    tile_coordinates = []
+    if tileset not in TILESETS:
+        return invalid_parse_result('Invalid tileset')
 
-    # pre-bump the coordinates to the next highest zoom
-    z = tile.z + 1
-    x = tile.x * 2
-    y = tile.y * 2
+    if not is_tile_valid(z, x, y):
+        return invalid_parse_result('Invalid tile coordinate')
 
-    x_y_max = int(math.pow(2, z)) - 1
+    if z > max_zoom_for_tilesize(tilesize):
+        return invalid_parse_result('Invalid zoom')
 
-    # see ImageSpec description above for coordinate meaning
+    fmt = OUTPUT_FORMATS.get(output_format)
+    if fmt is None or (fmt.tilesets and tileset not in fmt.tilesets):
+        return invalid_parse_result('Invalid format')
 
-    # NOTE: using a row/col scheme to organize the values
+    return PathParseResult(
+        None, tileset, tilesize, Tile(z, x, y), output_format)
 
-    # these are the origin locations where the images will be placed
-    locations = (
-        # first row
-        (0, 0), (2, 0), (258, 0), (514, 0),
-        # second row
-        (0, 2), (2, 2), (258, 2), (514, 2),
-        # third row
-        (0, 258), (2, 258), (258, 258), (514, 258),
-        # fourth row
-        (0, 514), (2, 514), (258, 514), (514, 514),
-    )
 
-    # set the row tiles to account for edge cases
-    tiles = []
-    for y_iter in range(y-1, y+3):
+# the latitude of the top and bottom edges of the web mercator tiles
+MAX_LATITUDE = math.degrees(math.atan(math.sinh(math.pi)))
 
-        if y_iter < 0:
-            y_val = 0
-        elif y_iter > x_y_max:
-            y_val = x_y_max
-        else:
-            y_val = y_iter
-
-        for x_iter in range(x-1, x+3):
-
-            x_val = x_iter
-            if x_iter < 0:
-                x_val = x_y_max
-            elif x_iter > x_y_max:
-                x_val = 0
-
-            tiles.append(Tile(z, x_val, y_val))
-
-    assert(len(tiles) == 16)
-
-    # set the crop bounds for each
-    if y == 0:
-        top_row_crop_bounds = (
-            (254, 0, 256, 2),
-            (0, 0, 256, 2),
-            (0, 0, 256, 2),
-            (0, 0, 2, 2),
-        )
-    else:
-        top_row_crop_bounds = (
-            (254, 254, 256, 256),
-            (0, 254, 256, 256),
-            (0, 254, 256, 256),
-            (0, 254, 2, 256),
-        )
-    mid_rows_crop_bounds = (
-        (254, 0, 256, 256),
-        None,
-        None,
-        (0, 0, 2, 256),
+
+def tiles_in_bbox(z, west, south, east, north):
+    """
+    Generate the tiles at zoom z that cover a lon/lat bbox
+
+    A bbox that crosses the antimeridian has west > east. The tiles are
+    generated lazily, row by row, since a large bbox at a high zoom
+    covers more tiles than fit in memory.
+    """
+    n = 2 ** z
+
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+
+    def tile_y(lat):
+        lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+        y = (1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n
+        return min(n - 1, max(0, int(y)))
+
+    min_x = tile_x(west)
+    max_x = tile_x(east)
+    if west > east:
+        max_x = min(max_x + n, min_x + n - 1)
+    for y in range(tile_y(north), tile_y(south) + 1):
+        for x in range(min_x, max_x + 1):
+            yield Tile(z, x % n, y)
+
+
+def parse_tile_path(path):
+    """Parse and validate a tile request path"""
+
+    match = TILE_PATH_RE.match(path)
+    if match is None:
+        return invalid_parse_result('Not found')
+    tilesize = match.group('tilesize')
+    return parse_tile_request(
+        match.group('tileset'),
+        int(tilesize) if tilesize else None,
+        int(match.group('z')),
+        int(match.group('x')),
+        int(match.group('y')),
+        match.group('output_format'),
     )
-    if y+1 == x_y_max:
-        bot_row_crop_bounds = (
-            (254, 254, 256, 256),
-            (0, 254, 256, 256),
-            (0, 254, 256, 256),
-            (0, 254, 2, 256),
-        )
-    else:
-        bot_row_crop_bounds = (
-            (254, 0, 256, 2),
-            (0, 0, 256, 2),
-            (0, 0, 256, 2),
-            (0, 0, 2, 2),
-        )
-
-    all_crop_bounds = (
-        list(top_row_crop_bounds) +
-        list(mid_rows_crop_bounds) +
-        list(mid_rows_crop_bounds) +
-        list(bot_row_crop_bounds))
-
-    for tile, loc, crop_bounds in zip(tiles, locations, all_crop_bounds):
-        tc = TileCoordinates(tile, ImageSpec(loc, crop_bounds))
-        tile_coordinates.append(tc)
-
-    return tile_coordinates
+
+
+def timing_key(index, tile):
+    # the same source tile can appear more than once in a plan, eg the
+    # row edges of the buffered tiles, so the plan position is included
+    return '%d:%s' % (index, tile)
+
+
+# the most source tiles fetched at once for a single output tile
+MAX_FETCH_CONCURRENCY = 16
 
 
 def fetch_tiles_single_thread(
-        tile_fetcher, tileset, all_tile_coords, timing_fetch):
+        tile_fetcher, tileset, all_tile_coords, timing_fetch,
+        tracer=NULL_TRACER):
     image_inputs = []
     # TODO support cache headers for 304 responses?
-    with time_block(timing_fetch, 'total'):
-        for tile_coords in all_tile_coords:
+    with time_block(timing_fetch, 'total'), tracer.span('fetch'):
+        for i, tile_coords in enumerate(all_tile_coords):
             tile = tile_coords.tile
-            with time_block(timing_fetch, str(tile)):
+            with time_block(timing_fetch, timing_key(i, tile)), \
+                    tracer.span('fetch-tile', tileset=tileset,
+                                tile=str(tile), index=i):
                 fetch_result = tile_fetcher(tileset, tile)
 
             image_input = ImageInput(
@@ -452,28 +1154,50 @@ def fetch_tiles_single_thread(
     return image_inputs
 
 
-def _time_and_fetch(tile_fetcher, tileset, tile_coords, timing_fetch, queue):
+def _time_and_fetch(tile_fetcher, tileset, index, tile_coords, timing_fetch,
+                    queue, tracer, parent_span):
+    tile = tile_coords.tile
     try:
-        with time_block(timing_fetch, str(tile_coords.tile)):
-            fetch_result = tile_fetcher(tileset, tile_coords.tile)
+        with time_block(timing_fetch, timing_key(index, tile)), \
+                tracer.span('fetch-tile', parent=parent_span,
+                            tileset=tileset, tile=str(tile), index=index):
+            fetch_result = tile_fetcher(tileset, tile)
     except Exception as e:
         fetch_result = e
     queue.put((fetch_result, tile_coords.image_spec))
 
 
+def _fetch_worker(tile_fetcher, tileset, work_queue, timing_fetch,
+                  results_queue, tracer, parent_span):
+    while True:
+        try:
+            index, tile_coords = work_queue.get_nowait()
+        except queue.Empty:
+            return
+        _time_and_fetch(tile_fetcher, tileset, index, tile_coords,
+                        timing_fetch, results_queue, tracer, parent_span)
+
+
 def fetch_tiles_multi_threaded(
-        tile_fetcher, tileset, all_tile_coords, timing_fetch):
+        tile_fetcher, tileset, all_tile_coords, timing_fetch,
+        tracer=NULL_TRACER, max_threads=MAX_FETCH_CONCURRENCY):
     image_inputs = []
     threads = []
+    work_queue = queue.Queue()
+    for i, tile_coords in enumerate(all_tile_coords):
+        work_queue.put((i, tile_coords))
     fetch_results_queue = queue.Queue(len(all_tile_coords))
     error = None
-    with time_block(timing_fetch, 'total'):
-        for tile_coords in all_tile_coords:
+    with time_block(timing_fetch, 'total'), \
+            tracer.span('fetch') as fetch_span:
+        # the larger tiles need up to 36 source tiles, which are fetched
+        # by at most max_threads threads
+        for i in range(min(max_threads, len(all_tile_coords))):
             thread_args = (
-                tile_fetcher, tileset, tile_coords, timing_fetch,
-                fetch_results_queue)
+                tile_fetcher, tileset, work_queue, timing_fetch,
+                fetch_results_queue, tracer, fetch_span)
             t = threading.Thread(
-                target=_time_and_fetch,
+                target=_fetch_worker,
                 args=thread_args)
             t.start()
             threads.append(t)
@@ -481,7 +1205,7 @@ def fetch_tiles_multi_threaded(
         for t in threads:
             t.join()
 
-        for i in range(len(threads)):
+        for i in range(len(all_tile_coords)):
             fetch_result, image_spec = fetch_results_queue.get()
             if isinstance(fetch_result, Exception):
                 error = fetch_result
@@ -495,7 +1219,72 @@ def fetch_tiles_multi_threaded(
             raise error
 
 
-def process_tile(coords_generator, tile_fetcher, image_reducer, tileset, tile):
+def _stream_output(image_reducer, image_state, timing_metadata,
+                   output_memo, memo_key):
+    # the output is only kept whole for the memo. The save timing is set
+    # once the last chunk was taken, so it includes sending the chunks
+    chunks = []
+    with time_block(timing_metadata, 'save'):
+        for chunk in image_reducer.finalize_stream(image_state):
+            if output_memo is not None:
+                chunks.append(chunk)
+            yield chunk
+    if output_memo is not None:
+        output_memo.put(memo_key, b''.join(chunks))
+
+
+def reduce_image_inputs(image_reducer, image_inputs, timing_metadata,
+                        tracer=NULL_TRACER, parent_span=None,
+                        output_memo=None, stream=False):
+    """
+    Reduce the inputs and encode the output
+
+    With stream, the png output is returned as an iterator of its chunks,
+    which encodes the image as it is consumed.
+    """
+    memo_key = None
+    timing_process = timing_metadata['process']
+    with time_block(timing_process, 'total'), \
+            tracer.span('process', parent=parent_span):
+        if output_memo is not None:
+            with tracer.span('memo-get'):
+                memo_key = output_memo.key(image_reducer, image_inputs)
+                image_bytes = output_memo.get(memo_key)
+            if image_bytes is not None:
+                return iter((image_bytes,)) if stream else image_bytes
+            uniform_color = output_memo.uniform_color(
+                image_reducer, image_inputs)
+        else:
+            uniform_color = None
+
+        if uniform_color is not None:
+            image_state = image_reducer.create_uniform_state(uniform_color)
+        else:
+            image_state = image_reducer.create_initial_state()
+            for i, image_input in enumerate(image_inputs):
+                with time_block(timing_process,
+                                timing_key(i, image_input.tile)), \
+                        tracer.span('reduce', tile=str(image_input.tile),
+                                    index=i):
+                    image_reducer.reduce(image_state, image_input)
+
+    if stream:
+        return _stream_output(image_reducer, image_state, timing_metadata,
+                              output_memo, memo_key)
+
+    with time_block(timing_metadata, 'save'), \
+            tracer.span('save', parent=parent_span):
+        image_bytes = image_reducer.finalize(image_state)
+
+    if output_memo is not None:
+        output_memo.put(memo_key, image_bytes)
+    return image_bytes
+
+
+def process_tile(coords_generator, tile_fetcher, image_reducer, tileset, tile,
+                 tracer=NULL_TRACER,
+                 max_fetch_concurrency=MAX_FETCH_CONCURRENCY,
+                 output_memo=None, stream=False):
     timing_fetch = {}
     timing_process = {}
     timing_metadata = dict(
@@ -503,21 +1292,167 @@ def process_tile(coords_generator, tile_fetcher, image_reducer, tileset, tile):
         process=timing_process,
     )
 
-    with time_block(timing_metadata, 'coords-gen'):
+    with time_block(timing_metadata, 'coords-gen'), \
+            tracer.span('coords-gen'):
         all_tile_coords = coords_generator(tile)
 
     # image_inputs = fetch_tiles_single_thread(
-    #     tile_fetcher, tileset, all_tile_coords, timing_fetch)
+    #     tile_fetcher, tileset, all_tile_coords, timing_fetch, tracer)
     image_inputs = fetch_tiles_multi_threaded(
-        tile_fetcher, tileset, all_tile_coords, timing_fetch)
+        tile_fetcher, tileset, all_tile_coords, timing_fetch, tracer,
+        max_fetch_concurrency)
 
-    with time_block(timing_process, 'total'):
-        image_state = image_reducer.create_initial_state()
-        for image_input in image_inputs:
-            with time_block(timing_process, str(image_input.tile)):
-                image_reducer.reduce(image_state, image_input)
+    image_bytes = reduce_image_inputs(
+        image_reducer, image_inputs, timing_metadata, tracer,
+        output_memo=output_memo, stream=stream)
 
-    with time_block(timing_metadata, 'save'):
-        image_bytes = image_reducer.finalize(image_state)
+    return image_bytes, timing_metadata, all_tile_coords
+
+
+def process_tiles(tile_plans, tile_fetcher, tracer=NULL_TRACER,
+                  max_fetch_concurrency=MAX_FETCH_CONCURRENCY,
+                  output_memo=None, skip_missing=False):
+    """
+    Render several output tiles, fetching the sources they share once
+
+    tile_plans are (tile, RenderPlan) pairs with the same source tileset.
+    Their coordinate plans are merged into the distinct source tiles, eg
+    (N+2)**2 rather than 9*N**2 for an NxN block of 260 tiles, which are
+    fetched together and then reduced into each output tile in turn.
+
+    Returns the (tile, image bytes) pairs in order, the timing metadata
+    with the process and save stages summed over the tiles, and the
+    number of source tiles fetched. With skip_missing, the image bytes of
+    the tiles with a missing source are None, rather than the missing
+    source failing them all.
+    """
+    timing_fetch = {}
+    timing_metadata = dict(
+        fetch=timing_fetch,
+        process=dict(total=0.0),
+        save=0.0,
+    )
+    if not tile_plans:
+        return [], timing_metadata, 0
+    source_tilesets = set(plan.source_tileset for tile, plan in tile_plans)
+    assert len(source_tilesets) == 1, 'Tiles must share the source tileset'
+    source_tileset, = source_tilesets
+
+    with time_block(timing_metadata, 'coords-gen'), \
+            tracer.span('coords-gen'):
+        all_tile_coords = [
+            plan.coords_generator(tile) for tile, plan in tile_plans]
+        source_tiles = OrderedDict(
+            (tile_coords.tile, None)
+            for tile_plan_coords in all_tile_coords
+            for tile_coords in tile_plan_coords)
+
+    def fetch_tile(tileset, tile):
+        try:
+            return tile_fetcher(tileset, tile)
+        except MissingTileException:
+            if not skip_missing:
+                raise
+            return FetchResult(None, tile)
+
+    image_inputs = fetch_tiles_multi_threaded(
+        fetch_tile, source_tileset,
+        [TileCoordinates(tile, None) for tile in source_tiles],
+        timing_fetch, tracer, max_fetch_concurrency)
+    source_bytes = dict(
+        (image_input.tile, image_input.image_bytes)
+        for image_input in image_inputs)
+
+    outputs = []
+    for (tile, plan), tile_plan_coords in zip(tile_plans, all_tile_coords):
+        if any(source_bytes[tile_coords.tile] is None
+               for tile_coords in tile_plan_coords):
+            outputs.append((tile, None))
+            continue
+        tile_timing = dict(process={})
+        image_bytes = reduce_image_inputs(
+            plan.image_reducer,
+            [ImageInput(source_bytes[tile_coords.tile],
+                        tile_coords.image_spec, tile_coords.tile)
+             for tile_coords in tile_plan_coords],
+            tile_timing, tracer, output_memo=output_memo)
+        timing_metadata['process']['total'] += tile_timing['process']['total']
+        timing_metadata['save'] += tile_timing.get('save', 0.0)
+        outputs.append((tile, image_bytes))
+    return outputs, timing_metadata, len(source_tiles)
+
+
+async def _time_and_fetch_async(
+        tile_fetcher, tileset, index, tile_coords, timing_fetch, tracer,
+        parent_span, semaphore):
+    tile = tile_coords.tile
+    # the time waiting for the semaphore is not part of the tile's fetch
+    async with semaphore:
+        with time_block(timing_fetch, timing_key(index, tile)), \
+                tracer.span('fetch-tile', parent=parent_span,
+                            tileset=tileset, tile=str(tile), index=index):
+            fetch_result = await tile_fetcher(tileset, tile)
+    return ImageInput(
+        fetch_result.image_bytes, tile_coords.image_spec, fetch_result.tile)
+
+
+async def fetch_tiles_async(
+        tile_fetcher, tileset, all_tile_coords, timing_fetch,
+        tracer=NULL_TRACER, parent_span=None,
+        max_concurrency=MAX_FETCH_CONCURRENCY):
+    # the spans of concurrent coroutines interleave on the loop thread,
+    # so parents are always passed explicitly here
+    fetch_span = tracer.span('fetch', parent=parent_span)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    with time_block(timing_fetch, 'total'), fetch_span:
+        futures = [
+            asyncio.ensure_future(_time_and_fetch_async(
+                tile_fetcher, tileset, i, tile_coords, timing_fetch,
+                tracer, fetch_span, semaphore))
+            for i, tile_coords in enumerate(all_tile_coords)
+        ]
+        try:
+            image_inputs = await asyncio.gather(*futures)
+        except Exception:
+            # the first error wins, there is no point in waiting for
+            # the rest of the fetches to complete
+            for future in futures:
+                future.cancel()
+            raise
+    return list(image_inputs)
+
+
+async def process_tile_async(
+        coords_generator, tile_fetcher, image_reducer, tileset, tile,
+        executor=None, tracer=NULL_TRACER, parent_span=None,
+        max_fetch_concurrency=MAX_FETCH_CONCURRENCY, output_memo=None):
+    """
+    asyncio variant of process_tile
+
+    The tile_fetcher must be a coroutine function. All source tiles are
+    fetched concurrently on the event loop, and the cpu bound
+    decode/encode work is run on the executor so that the loop is free
+    to service other requests in the meantime.
+    """
+
+    timing_fetch = {}
+    timing_process = {}
+    timing_metadata = dict(
+        fetch=timing_fetch,
+        process=timing_process,
+    )
+
+    with time_block(timing_metadata, 'coords-gen'), \
+            tracer.span('coords-gen', parent=parent_span):
+        all_tile_coords = coords_generator(tile)
+
+    image_inputs = await fetch_tiles_async(
+        tile_fetcher, tileset, all_tile_coords, timing_fetch, tracer,
+        parent_span, max_fetch_concurrency)
+
+    loop = asyncio.get_event_loop()
+    image_bytes = await loop.run_in_executor(
+        executor, reduce_image_inputs, image_reducer, image_inputs,
+        timing_metadata, tracer, parent_span, output_memo)
 
     return image_bytes, timing_metadata, all_tile_coords